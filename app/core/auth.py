@@ -1,18 +1,268 @@
-    
+
 # Author: Rajasekhar Palleti
 # QA
 
+import asyncio
+import hmac
+import threading
+import time
+
 import requests
+from requests.auth import AuthBase
+
+from app.core.metrics import metrics
 
 # Define constants for fixed values
 GRANT_TYPE = "password"
 CLIENT_ID = "resource_server"  # Replace with your actual client ID
 CLIENT_SECRET = "resource_server"  # Replace with your actual client secret
 
+REFRESH_MARGIN = 60  # seconds before expiry at which a token is renewed
+DEFAULT_EXPIRES_IN = 300  # used when Keycloak does not report expires_in
+AUTH_TIMEOUT = 30  # seconds
+
+
+def _token_url(tenant_code, environment):
+    # Determine the authentication URL based on the environment
+    if environment == "prod1":
+        return f"https://sso.sg.cropin.in/auth/realms/{tenant_code}/protocol/openid-connect/token"
+    if environment == "prod2":
+        return f"https://sso.africa.cropin.com/auth/realms/{tenant_code}/protocol/openid-connect/token"
+    raise ValueError("Invalid environment specified. Use 'prod1' or 'prod2'.")
+
+
+class _Token:
+    def __init__(self, access_token, expires_at, refresh_token=None, refresh_expires_at=float("inf")):
+        self.access_token = access_token
+        self.expires_at = expires_at
+        self.refresh_token = refresh_token
+        self.refresh_expires_at = refresh_expires_at
+
+    @classmethod
+    def from_response(cls, data, now):
+        refresh_expires_in = data.get("refresh_expires_in")
+        return cls(
+            data.get("access_token"),
+            now + float(data.get("expires_in") or DEFAULT_EXPIRES_IN),
+            data.get("refresh_token"),
+            # Keycloak reports 0 for offline tokens that never expire
+            now + float(refresh_expires_in) if refresh_expires_in else float("inf"),
+        )
+
+    def is_fresh(self, now):
+        return now < self.expires_at - REFRESH_MARGIN
+
+    def can_refresh(self, now):
+        return bool(self.refresh_token) and now < self.refresh_expires_at - REFRESH_MARGIN
+
+
+class TokenCache:
+    """
+    Access tokens per (tenant_code, username, environment).
+
+    A cached token is returned until it is within REFRESH_MARGIN seconds of expiry. It is
+    then renewed with the refresh_token grant, or with a new password login once the
+    refresh token has expired as well. Concurrent callers for the same key wait on one
+    per-key lock, so a burst of jobs for the same user logs in only once.
+    """
+
+    def __init__(self):
+        self._tokens = {}
+        self._credentials = {}
+        self._locks = {}
+        self._in_use = {}  # key -> number of running jobs using the token
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key):
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    def _request(self, tenant_code, environment, payload):
+        payload = dict(payload, client_id=CLIENT_ID, client_secret=CLIENT_SECRET)
+        # Send the POST request with x-www-form-urlencoded data
+        response = requests.post(_token_url(tenant_code, environment), data=payload, timeout=AUTH_TIMEOUT)
+        response.raise_for_status()  # Raise an exception for HTTP errors
+        return response.json()
+
+    def _new_password(self, key, password):
+        # A cached token is only handed out to callers that know the password it was issued for
+        known = self._credentials.get(key)
+        return bool(password) and (known is None or not hmac.compare_digest(password, known))
+
+    def get(self, tenant_code, username, password=None, environment="prod1", rejected=None):
+        """
+        Returns a valid access token, logging in or refreshing only when needed.
+
+        Args:
+            rejected (str): A token the API answered 401 to. It is renewed even if it
+                has not expired yet, unless another caller already replaced it.
+        """
+        key = (tenant_code, username, environment)
+        token = self._tokens.get(key)
+        if not self._new_password(key, password) and token and token.is_fresh(time.time()) and token.access_token != rejected:
+            return token.access_token
+
+        with self._key_lock(key):
+            now = time.time()
+            new_password = self._new_password(key, password)
+            token = self._tokens.get(key)
+            # Another caller may have renewed it while we waited for the lock
+            if not new_password and token and token.is_fresh(now) and token.access_token != rejected:
+                return token.access_token
+
+            data = None
+            if not new_password and token and token.can_refresh(now):
+                try:
+                    data = self._request(tenant_code, environment, {
+                        "grant_type": "refresh_token",
+                        "refresh_token": token.refresh_token,
+                    })
+                    metrics.incr("auth_token_refreshes")
+                except Exception as e:
+                    print(f"Token refresh failed for {username}, logging in again: {e}")
+
+            if data is None:
+                login_password = password or self._credentials.get(key)
+                if not login_password:
+                    raise Exception("Token expired and no credentials are available to log in again.")
+                data = self._request(tenant_code, environment, {
+                    "username": username,
+                    "password": login_password,
+                    "grant_type": GRANT_TYPE,
+                })
+                metrics.incr("auth_logins")
+                if data.get("access_token"):
+                    self._credentials[key] = login_password
+
+            if not data.get("access_token"):
+                raise Exception("Authentication failed: No token returned.")
+            token = _Token.from_response(data, now)
+            self._tokens[key] = token
+            return token.access_token
+
+    def seed(self, key, token, password=None):
+        """Adds a token obtained elsewhere (e.g. by the parent of a job process) unless a newer one is cached."""
+        with self._lock:
+            if password and key not in self._credentials:
+                self._credentials[key] = password
+            current = self._tokens.get(key)
+            if current is None or current.expires_at < token.expires_at:
+                self._tokens[key] = token
+
+    def snapshot(self, key):
+        return self._tokens.get(key)
+
+    # ---------------- Background refresh ----------------
+    def hold(self, key):
+        with self._lock:
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+
+    def release(self, key):
+        with self._lock:
+            remaining = self._in_use.get(key, 1) - 1
+            if remaining > 0:
+                self._in_use[key] = remaining
+            else:
+                self._in_use.pop(key, None)
+
+    def refresh_due(self):
+        """Renews the tokens of running jobs that are about to expire. Returns how many were renewed."""
+        with self._lock:
+            keys = list(self._in_use)
+        renewed = 0
+        for key in keys:
+            token = self._tokens.get(key)
+            if token is None or token.is_fresh(time.time()):
+                continue
+            tenant_code, username, environment = key
+            try:
+                self.get(tenant_code, username, environment=environment)
+                renewed += 1
+            except Exception as e:
+                print(f"Background token refresh failed for {username}: {e}")
+        return renewed
+
+
+token_cache = TokenCache()
+
+
+class TokenProvider:
+    """
+    Callable handed to scripts as config["token_provider"]; returns a valid token on every call.
+
+    It can be pickled into a job process: the token known when the job started goes
+    along, so the child only contacts Keycloak once that token needs renewing.
+    """
+
+    def __init__(self, tenant_code, username, password, environment):
+        self.key = (tenant_code, username, environment)
+        self.password = password
+        self._seed = None
+
+    def __call__(self, rejected=None):
+        tenant_code, username, environment = self.key
+        if self._seed is not None:
+            token_cache.seed(self.key, self._seed, self.password)
+            self._seed = None
+        return token_cache.get(tenant_code, username, self.password, environment, rejected=rejected)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_seed"] = token_cache.snapshot(self.key)
+        return state
+
+
+class TokenAuth(AuthBase):
+    """
+    requests auth that adds a fresh bearer token to every request.
+
+    A 401 response renews the token once and resends the request, so a job that
+    outlives its token keeps going.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def __call__(self, r):
+        r.headers["Authorization"] = f"Bearer {self.provider()}"
+        r.register_hook("response", self._handle_401)
+        return r
+
+    def _handle_401(self, r, **kwargs):
+        if r.status_code != 401 or getattr(r.request, "_token_retried", False):
+            return r
+        rejected = r.request.headers.get("Authorization", "")[len("Bearer "):]
+        token = self.provider(rejected=rejected)
+        if token == rejected:
+            # Fixed token, nothing to retry with
+            return r
+        retry = r.request.copy()
+        retry._token_retried = True
+        retry.headers["Authorization"] = f"Bearer {token}"
+        r.content  # release the connection of the failed response
+        r.close()
+        new_response = r.connection.send(retry, **kwargs)
+        new_response.history.append(r)
+        new_response.request = retry
+        return new_response
+
+
+def current_token(config):
+    """Token for a script: renewed through config["token_provider"] when available, else config["token"]."""
+    provider = config.get("token_provider")
+    if provider is not None:
+        return provider()
+    return config.get("token")
+
 
 def get_access_token(tenant_code, username, password, environment):
     """Fetch the access token using the tenant_code, username, password and environment.
 
+    Tokens are cached per (tenant_code, username, environment) and reused until
+    shortly before they expire.
+
     Args:
         tenant_code (str): The tenant code for the authentication.
         username (str): The username for the authentication.
@@ -24,29 +274,12 @@ def get_access_token(tenant_code, username, password, environment):
         str: The access token if successful, otherwise None.
     """
     try:
-        # Define the payload for the POST request
-        payload = {
-            "username": username,
-            "password": password,
-            "grant_type": GRANT_TYPE,
-            "client_id": CLIENT_ID,
-            "client_secret": CLIENT_SECRET,
-        }
-
-        # Determine the authentication URL based on the environment
-        if environment == "prod1":
-            auth_token_url = f"https://sso.sg.cropin.in/auth/realms/{tenant_code}/protocol/openid-connect/token"
-        elif environment == "prod2":
-            auth_token_url = f"https://sso.africa.cropin.com/auth/realms/{tenant_code}/protocol/openid-connect/token"
-        else:
-            raise ValueError("Invalid environment specified. Use 'prod1' or 'prod2'.")
-
-        # Send the POST request with x-www-form-urlencoded data
-        response = requests.post(auth_token_url, data=payload)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-
-        # Parse and return the access token
-        return response.json().get("access_token")
+        return token_cache.get(tenant_code, username, password, environment)
     except Exception as e:
         print(f"Failed to retrieve access token: {e}")
         raise e
+
+
+async def get_access_token_async(tenant_code, username, password, environment):
+    """Non-blocking get_access_token for the event loop; the HTTP call runs in a worker thread."""
+    return await asyncio.to_thread(get_access_token, tenant_code, username, password, environment)
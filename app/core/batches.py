@@ -0,0 +1,263 @@
+"""
+Batched requests for the scripts that call list endpoints (`.../batch`, `?ids=`).
+
+Sending one row per request to an endpoint that takes a list spends the whole
+rate limit on per-request overhead. Scripts cut their rows into batches of
+`batch_size_from(config)` IDs instead (config["batch_size"], set in the UI).
+
+A list endpoint usually rejects the whole request when one of its IDs is bad,
+which would mark every row of the batch failed. `bisect()` splits a failed
+batch in two and sends each half again, down to single IDs, so the valid IDs
+still go through and only the bad ones keep the error: k bad IDs in a batch of
+n cost about 2·k·log2(n) extra requests. Only errors the content of the batch
+can cause are split (4xx other than 401/403/408/429); a timeout, a 5xx after
+retries or an expired token fails the batch as a whole. `delete_ids()` sends
+a bulk `DELETE ...?ids=` that way and `write_outcomes()` writes what happened
+to each chunk into the output frame.
+
+`dispatch()` keeps several batches in flight on worker threads, under the
+same shared rate limiter, and hands their results back in batch order, so a
+script can record and write them exactly as it did when it sent one batch at
+a time (config["batches_in_flight"], set in the UI).
+
+Where the best batch size depends on how the API copes, `BatchController`
+chooses it, together with the number of batches kept in flight, from what the
+batches sent so far experienced (see its docstring). config["batch_size"] is
+then only the starting size and config["batches_in_flight"] the most batches
+in flight.
+
+Tunables (environment variables):
+    BATCH_MAX_SIZE        - upper bound for config["batch_size"] (default 1000)
+    BATCH_MAX_IN_FLIGHT   - batches in flight per job unless the job sets it (default 4)
+    BATCH_TARGET_LATENCY  - seconds a batch may take before the controller shrinks batches (default 10)
+    BATCH_FAILED_RATE     - share of FAILED IDs in a batch that shrinks batches (default 0.2)
+"""
+
+import collections
+import os
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import requests
+
+from app.core.metrics import metrics
+
+MAX_BATCH_SIZE = max(1, int(os.getenv("BATCH_MAX_SIZE", "1000") or 1000))
+MAX_IN_FLIGHT = max(1, int(os.getenv("BATCH_MAX_IN_FLIGHT", "4") or 4))
+TARGET_LATENCY = float(os.getenv("BATCH_TARGET_LATENCY", "10") or 10)
+FAILED_RATE = float(os.getenv("BATCH_FAILED_RATE", "0.2") or 0.2)
+
+# Client errors that say nothing about the IDs in the batch
+NOT_SPLIT = {401, 403, 408, 429}
+
+
+def batch_size_from(config, default):
+    """IDs per request for a job: config["batch_size"] if set, else the script's default."""
+    try:
+        value = int(config.get("batch_size") or default)
+    except (TypeError, ValueError):
+        value = default
+    return max(1, min(value, MAX_BATCH_SIZE))
+
+
+def in_flight_from(config, default=MAX_IN_FLIGHT):
+    """Batches in flight for a job: config["batches_in_flight"] if set, else `default`."""
+    try:
+        value = int(config.get("batches_in_flight") or default)
+    except (TypeError, ValueError):
+        value = default
+    return max(1, min(value, 64))
+
+
+def chunks(items, size):
+    """`items` cut into lists of at most `size`, in order."""
+    items = list(items)
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def splittable(error):
+    """Whether a failed batch request is worth splitting (see NOT_SPLIT)."""
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return status is not None and 400 <= status < 500 and status not in NOT_SPLIT
+
+
+def bisect(items, send, split=splittable, log=None):
+    """
+    Sends `items` with `send(items)`, splitting failed batches as described above.
+
+    Args:
+        items (list): The rows (or IDs) of one batch.
+        send (callable): Sends a list of items and returns the parsed response; raises on failure.
+        split (callable): Whether the exception of a failed request warrants splitting the batch.
+        log (callable): Optional log function, told about every split.
+
+    Returns:
+        list: (chunk, response, error) for consecutive chunks that together cover `items` in
+        order; `error` is None for the chunks that were sent successfully.
+    """
+    outcomes = []
+    pending = [list(items)]
+    while pending:
+        chunk = pending.pop()
+        try:
+            outcomes.append((chunk, send(chunk), None))
+        except Exception as e:
+            if len(chunk) > 1 and split(e):
+                middle = len(chunk) // 2
+                metrics.incr("batch_splits")
+                if log:
+                    reason = getattr(getattr(e, "response", None), "status_code", None) or e
+                    log(f"✂️ Batch of {len(chunk)} rejected ({reason}); retrying as {middle} + {len(chunk) - middle}")
+                pending.append(chunk[middle:])
+                pending.append(chunk[:middle])
+            else:
+                outcomes.append((chunk, None, e))
+    return outcomes
+
+
+def delete_ids(http, url, ids, rows, params=None, log=None, **kwargs):
+    """
+    DELETEs the IDs of `rows` as `url?ids=1,2,3`, bisecting rejected batches.
+
+    Args:
+        http (HttpClient): Client to send the requests with.
+        url (str): The bulk endpoint.
+        ids (Series): Cleaned IDs by row (see preflight.ids()).
+        rows (list): The rows of one batch.
+        params (dict): Other query parameters, e.g. {"enabled": "false"}.
+        log (callable): Optional log function, told about every split.
+        **kwargs: Passed on to `http.delete()` (headers, timeout).
+
+    Returns:
+        list: bisect()'s (chunk, response, error) outcomes.
+    """
+    def send(chunk):
+        query = urlencode({"ids": ",".join(ids[chunk]), **(params or {})}, safe=",")
+        response = http.delete(f"{url}?{query}", **kwargs)
+        if response.status_code not in (200, 204):
+            raise requests.HTTPError(f"{response.status_code}: {response.text}", response=response)
+        return response
+
+    return bisect(rows, send, log=log)
+
+
+def write_outcomes(df, outcomes, ids, ids_column, response_column,
+                   success="✅ Deleted", failed="❌ Failed", error="❌ Error"):
+    """
+    Writes delete_ids() outcomes into the output frame: the status on every row, the
+    IDs and response of each request on its first row. Returns the rows that failed.
+    """
+    failures = 0
+    for chunk, response, exception in outcomes:
+        if exception is None:
+            status, response_text = success, response.text
+        elif getattr(exception, "response", None) is not None:
+            status, response_text = f"{failed} ({exception.response.status_code})", exception.response.text
+            failures += len(chunk)
+        else:
+            status, response_text = error, str(exception)
+            failures += len(chunk)
+        df.loc[chunk, "Status"] = status
+        df.at[chunk[0], ids_column] = ",".join(ids[chunk])
+        df.at[chunk[0], response_column] = response_text
+    return failures
+
+
+def dispatch(batches, send, commit, in_flight=1):
+    """
+    Sends batches concurrently and commits their results in order.
+
+    Args:
+        batches (iterable): The batches, in the order their results are to be committed.
+        send (callable): Sends one batch and returns its result; runs on a worker thread,
+            so it must not touch shared state (the output frame, the result log).
+        commit (callable): `commit(batch, result)`, called on the calling thread once the
+            batch and every batch before it are done.
+        in_flight (int): Batches sent at the same time. The HttpClient used by `send`
+            should be created with at least this concurrency.
+    """
+    batches = iter(batches)
+    pending = collections.deque()  # (batch, future), in batch order
+    with ThreadPoolExecutor(max_workers=max(1, in_flight)) as executor:
+        while True:
+            for batch in batches:
+                pending.append((batch, executor.submit(send, batch)))
+                if len(pending) >= in_flight:
+                    break
+            if not pending:
+                return
+            batch, future = pending.popleft()
+            commit(batch, future.result())
+
+
+class BatchController:
+    """
+    Batch size and batches in flight for one job, tuned after every batch.
+
+    A batch is healthy when it was not throttled (429, 5xx or a connection
+    error), fewer than FAILED_RATE of its IDs came back FAILED and the server
+    answered within TARGET_LATENCY. Each healthy full-size batch grows the size
+    by half, up to `max_size`; while latency stays under half the target it also
+    adds a batch in flight, up to `max_in_flight`. A throttled batch halves both.
+    A slow batch shrinks the size in proportion to how late it was, and a batch
+    with many FAILED IDs halves it. Like TCP congestion control, it probes
+    upwards step by step and backs off at once.
+
+    Args:
+        size (int): Batch size to start with.
+        max_size (int): Largest batch size the endpoint accepts.
+        max_in_flight (int): Most batches sent at the same time.
+        target_latency (float): Seconds a batch may take.
+        log (callable): Optional log function, told about every change.
+    """
+
+    def __init__(self, size, max_size=MAX_BATCH_SIZE, max_in_flight=MAX_IN_FLIGHT,
+                 target_latency=TARGET_LATENCY, log=None):
+        self.max_size = max(1, max_size)
+        self.size = max(1, min(size, self.max_size))
+        self.max_in_flight = max(1, max_in_flight)
+        self.in_flight = 1
+        self.target_latency = target_latency
+        self.log = log
+        self.sizes = []  # size of every batch recorded
+
+    def record(self, size, latency=None, failed=0, throttled=False):
+        """
+        Adjusts the size and batches in flight to the outcome of one batch.
+
+        Args:
+            size (int): IDs in the batch.
+            latency (float): Seconds the server took to answer, or None when it did not.
+            failed (int): IDs the response marked FAILED.
+            throttled (bool): The batch got a 429/5xx or a connection error (or needed retries).
+        """
+        self.sizes.append(size)
+        metrics.observe("batch_size", size)
+        before = (self.size, self.in_flight)
+
+        if throttled:
+            self.size = max(1, self.size // 2)
+            self.in_flight = max(1, self.in_flight // 2)
+        elif failed > FAILED_RATE * size:
+            self.size = max(1, self.size // 2)
+        elif latency is not None and latency > self.target_latency:
+            self.size = max(1, self.size // 2, int(self.size * self.target_latency / latency))
+        else:
+            # A short last batch says nothing about how large batches could be
+            if size >= self.size:
+                self.size = min(self.max_size, max(self.size + 1, self.size * 3 // 2))
+            if latency is not None and latency < self.target_latency / 2:
+                self.in_flight = min(self.max_in_flight, self.in_flight + 1)
+
+        metrics.observe("batches_in_flight", self.in_flight)
+        if self.log and (self.size, self.in_flight) != before:
+            self.log(f"📏 Batch size {before[0]} → {self.size}, {self.in_flight} batches in flight")
+
+    def report(self):
+        """One line summing up the batch sizes used, for the end of the job log."""
+        if not self.sizes:
+            return "No batches were sent."
+        return (f"Sent {len(self.sizes)} batches of {min(self.sizes)}-{max(self.sizes)} IDs "
+                f"(median {statistics.median(self.sizes):g}); settled at {self.size} "
+                f"with {self.in_flight} in flight")
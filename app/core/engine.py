@@ -0,0 +1,504 @@
+"""
+Asyncio engine for scripts that update entities with GET -> modify -> PUT.
+
+The Update_* scripts fetch an entity, change its JSON and PUT it back as a
+multipart "dto". Run on threads, each row occupies a thread for two round
+trips, so throughput is capped by the thread count. `get_modify_put()` runs the
+rows on one event loop instead: up to `concurrency` rows are in flight at once
+(hundreds if the API allows it), all paced by the shared per-host rate limiter
+and retried under the same policy and per-job budget as `HttpClient`.
+
+A script supplies the rows and a `modify(entity, row)` callback that returns
+the JSON to PUT, returns None when nothing changed, or raises `SkipRow` to
+finish the row with its own status. Rows whose JSON is the same after
+`modify` as it was fetched are not PUT and end as "Unchanged". Results come back as
+(index, status, response, retries) tuples in input order; `stream_modify_put()`
+takes a row generator and hands each result to a callback instead, so a sheet
+never has to be materialised as a list of rows.
+
+The engine is started from the script's worker thread (or job process) with
+`asyncio.run`, so it never touches the server's event loop.
+
+The concurrency is an upper bound. How many requests are actually in flight
+is adjusted from their latency (`AdaptiveLimit`): while responses come back as
+fast as the best seen so far the limit grows, and when they slow down because
+the API starts queueing it shrinks, so a struggling region of IDs does not get
+hundreds of requests piled onto it.
+
+Tunables (environment variables):
+    ENGINE_CONCURRENCY          - max rows in flight per job unless config["concurrency"] is set (default 100)
+    ENGINE_MAX_CONCURRENCY      - upper bound for config["concurrency"] (default 500)
+    ENGINE_INITIAL_CONCURRENCY  - requests in flight before any latency was observed (default 10)
+"""
+
+import asyncio
+import collections
+import contextvars
+import json
+import math
+import os
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from app.core import ratelimit
+from app.core.fingerprint import UNCHANGED, fingerprint
+from app.core.http import DEFAULT_TIMEOUT
+from app.core.metrics import metrics
+from app.core.retry import RetryBudget, RetryPolicy
+
+DEFAULT_CONCURRENCY = max(1, int(os.getenv("ENGINE_CONCURRENCY", "100") or 100))
+MAX_CONCURRENCY = max(1, int(os.getenv("ENGINE_MAX_CONCURRENCY", "500") or 500))
+INITIAL_CONCURRENCY = max(1, int(os.getenv("ENGINE_INITIAL_CONCURRENCY", "10") or 10))
+
+LIMIT_SMOOTHING = 0.2  # weight of a new estimate in the concurrency limit
+LATENCY_WEIGHT = 0.1  # EWMA weight of a new latency sample
+MIN_GRADIENT = 0.5  # never shrink the limit by more than half per response
+
+_retries = contextvars.ContextVar("retries", default=0)
+
+
+class SkipRow(Exception):
+    """Raised by a modify callback to end a row without a PUT."""
+
+    def __init__(self, status, response=""):
+        super().__init__(status)
+        self.status = status
+        self.response = response
+
+
+def concurrency_from(config):
+    """Rows in flight for a job: config["concurrency"] if set, else ENGINE_CONCURRENCY."""
+    try:
+        value = int(config.get("concurrency") or DEFAULT_CONCURRENCY)
+    except (TypeError, ValueError):
+        value = DEFAULT_CONCURRENCY
+    return max(1, min(value, MAX_CONCURRENCY))
+
+
+class AdaptiveLimit:
+    """
+    Requests allowed in flight, adjusted per response with a latency gradient:
+
+        limit = limit * best_latency / recent_latency + sqrt(limit)
+
+    The sqrt term lets the limit keep probing upwards while latency is at its
+    best; a throttled response (429/5xx) or error counts as the minimum gradient.
+    Used from one event loop only.
+    """
+
+    def __init__(self, maximum, initial=INITIAL_CONCURRENCY):
+        self.maximum = maximum
+        self.limit = float(max(1, min(initial, maximum)))
+        self.in_flight = 0
+        self.best = None
+        self.recent = None
+        self._waiters = collections.deque()
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter  # the slot is handed over by _wake()
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self, latency=None, throttled=False):
+        self.in_flight -= 1
+        if throttled:
+            self._adjust(MIN_GRADIENT)
+        elif latency is not None:
+            self.recent = latency if self.recent is None else (
+                LATENCY_WEIGHT * latency + (1 - LATENCY_WEIGHT) * self.recent
+            )
+            self.best = self.recent if self.best is None else min(self.best, self.recent)
+            self._adjust(max(MIN_GRADIENT, min(1.0, self.best / self.recent)) if self.recent else 1.0)
+        self._wake()
+
+    def _adjust(self, gradient):
+        estimate = self.limit * gradient + math.sqrt(self.limit)
+        limit = (1 - LIMIT_SMOOTHING) * self.limit + LIMIT_SMOOTHING * estimate
+        self.limit = max(1.0, min(float(self.maximum), limit))
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+
+class Response:
+    """A fully read aiohttp response with the attributes the scripts know from requests."""
+
+    def __init__(self, status_code, url, headers, content):
+        self.status_code = status_code
+        self.url = url
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    @property
+    def is_error(self):
+        return self.status_code >= 400
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncHttpClient:
+    """
+    Coroutine counterpart of HttpClient: bearer token (renewed once on 401),
+    per-host rate limiting and idempotency-aware retries on an aiohttp session.
+
+    Retries are counted per asyncio task; `pop_retries()` returns the count of the
+    calling task, like HttpClient does per thread. Must be created inside the
+    event loop that uses it.
+    """
+
+    def __init__(self, config=None, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT,
+                 rate_limit=None, retry=None, retry_budget=None):
+        config = config or {}
+        self.provider = config.get("token_provider")
+        self.token = config.get("token")
+        self.rate_limit = rate_limit
+        self.retry = retry or RetryPolicy()
+        self.budget = RetryBudget() if retry_budget is None else RetryBudget(retry_budget)
+        self.limit = AdaptiveLimit(concurrency)
+        self._limiters = {}
+        connect_timeout, read_timeout = timeout
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=concurrency),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+        )
+
+    def _limiter(self, url):
+        if not self.rate_limit:
+            return None
+        host = urlsplit(url).netloc
+        if host not in self._limiters:
+            self._limiters[host] = ratelimit.limiter_for(url, self.rate_limit)
+        return self._limiters[host]
+
+    async def aclose(self):
+        await self.session.close()
+
+    async def _fetch(self, method, url, headers, files=None, **kwargs):
+        if files:
+            # Same shape as requests' files=: {"name": (filename, content, content_type)}.
+            # A FormData can only be sent once, so it is rebuilt for every attempt.
+            form = aiohttp.FormData()
+            for name, (filename, content, content_type) in files.items():
+                form.add_field(name, content, filename=filename, content_type=content_type)
+            kwargs["data"] = form
+        async with self.session.request(method, url, headers=headers, **kwargs) as resp:
+            return Response(resp.status, str(resp.url), resp.headers, await resp.read())
+
+    async def _token(self, rejected=None):
+        if self.provider is None:
+            return self.token
+        # The provider may log in over HTTP; keep that off the event loop
+        return await asyncio.to_thread(self.provider, rejected=rejected)
+
+    async def _send(self, limiter, method, url, headers, kwargs):
+        if limiter is not None:
+            await limiter.acquire_async()
+        await self.limit.acquire()
+        started = time.monotonic()
+        try:
+            response = await self._fetch(method, url, headers, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.limit.release(throttled=True)
+            if limiter is not None:
+                limiter.record(None)
+            raise
+        except BaseException:
+            self.limit.release()
+            raise
+        latency = time.monotonic() - started
+        self.limit.release(latency, throttled=response.status_code == 429 or response.status_code >= 500)
+        if limiter is not None:
+            limiter.record(
+                response.status_code,
+                latency,
+                ratelimit.parse_retry_after(response.headers.get("Retry-After")),
+            )
+        return response
+
+    async def _send_authenticated(self, limiter, method, url, headers, kwargs):
+        token = await self._token()
+        if token:
+            headers = dict(headers or {}, Authorization=f"Bearer {token}")
+        response = await self._send(limiter, method, url, headers, kwargs)
+        if response.status_code == 401 and token and self.provider is not None:
+            renewed = await self._token(rejected=token)
+            if renewed and renewed != token:
+                headers["Authorization"] = f"Bearer {renewed}"
+                response = await self._send(limiter, method, url, headers, kwargs)
+        return response
+
+    async def request(self, method, url, headers=None, idempotent=None, **kwargs):
+        limiter = self._limiter(url)
+        idempotent = self.retry.is_idempotent(method, headers, idempotent)
+
+        attempt = 1
+        while True:
+            response = error = None
+            try:
+                response = await self._send_authenticated(limiter, method, url, headers, kwargs)
+                retryable = idempotent and self.retry.should_retry_status(response.status_code)
+            except aiohttp.ConnectionTimeoutError as e:
+                # The request never reached the server, so even a POST is safe to resend
+                error, retryable = e, True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error, retryable = e, idempotent
+
+            if not retryable or attempt >= self.retry.max_attempts:
+                break
+            if not self.budget.take():
+                metrics.incr("http_retry_budget_exhausted")
+                break
+
+            retry_after = None
+            if response is not None:
+                retry_after = ratelimit.parse_retry_after(response.headers.get("Retry-After"))
+            _retries.set(_retries.get() + 1)
+            metrics.incr("http_retries")
+            await asyncio.sleep(self.retry.backoff(attempt, retry_after))
+            attempt += 1
+
+        if error is not None:
+            raise error
+        return response
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request("PUT", url, **kwargs)
+
+    def pop_retries(self):
+        retries = _retries.get()
+        _retries.set(0)
+        return retries
+
+
+def _failure(response):
+    return (
+        f"Failed: {response.status_code} Error for url: {response.url}",
+        f"{response.status_code} - {response.text[:300]}",
+    )
+
+
+async def _pipeline(http, items, get_url, put_url, modify, concurrency, headers, multipart, log, record):
+    """
+    read -> fetch -> patch -> put -> record, connected by bounded queues.
+
+    Only `concurrency` rows wait in each queue, so the reader stops pulling rows
+    while the API is the bottleneck and memory stays flat however long the sheet
+    is. Fetch and put each run `concurrency` workers; patch and record are
+    plain CPU work and run as one task each. A None on a queue tells the next
+    stage that one upstream worker has finished.
+    """
+    fetch_q = asyncio.Queue(concurrency)
+    patch_q = asyncio.Queue(concurrency)
+    put_q = asyncio.Queue(concurrency)
+    record_q = asyncio.Queue(concurrency)
+
+    async def read():
+        for position, item in enumerate(items):
+            await fetch_q.put((position, item))
+        for _ in range(concurrency):
+            await fetch_q.put(None)
+
+    async def fetch():
+        while (job := await fetch_q.get()) is not None:
+            position, (index, entity_id, row) = job
+            try:
+                resp = await http.get(get_url(entity_id), headers=headers)
+            except Exception as e:
+                log(f"❌ Failed: {entity_id} - {e}")
+                await record_q.put((position, (index, f"Failed: {e}", str(e), http.pop_retries())))
+                continue
+            if resp.is_error:
+                status, response = _failure(resp)
+                log(f"❌ Failed: {entity_id} - {status}")
+                await record_q.put((position, (index, status, response, http.pop_retries())))
+                continue
+            await patch_q.put((position, index, entity_id, row, resp, http.pop_retries()))
+        await patch_q.put(None)
+
+    async def patch():
+        for _ in range(concurrency):
+            while (job := await patch_q.get()) is not None:
+                position, index, entity_id, row, resp, retries = job
+                try:
+                    entity = resp.json()
+                    before = fingerprint(entity)
+                    entity = modify(entity, row)
+                except SkipRow as skip:
+                    log(f"{skip.status}: {entity_id}")
+                    await record_q.put((position, (index, skip.status, skip.response, retries)))
+                    continue
+                except Exception as e:
+                    log(f"❌ Failed: {entity_id} - {e}")
+                    await record_q.put((position, (index, f"Failed: {e}", str(e), retries)))
+                    continue
+                if entity is None or fingerprint(entity) == before:
+                    metrics.incr("puts_skipped_unchanged")
+                    log(f"{UNCHANGED}: {entity_id}")
+                    await record_q.put((position, (index, UNCHANGED, "", retries)))
+                    continue
+                await put_q.put((position, index, entity_id, json.dumps(entity), retries))
+        for _ in range(concurrency):
+            await put_q.put(None)
+
+    async def put():
+        while (job := await put_q.get()) is not None:
+            position, index, entity_id, dto, retries = job
+            if multipart:
+                body = {"files": {"dto": (None, dto, "application/json")}}
+            else:
+                body = {"data": dto, "headers": {"Content-Type": "application/json"}}
+            try:
+                resp = await http.put(put_url(entity_id) if callable(put_url) else put_url, **body)
+            except Exception as e:
+                log(f"❌ Failed: {entity_id} - {e}")
+                result = (index, f"Failed: {e}", str(e), retries + http.pop_retries())
+            else:
+                retries += http.pop_retries()
+                if resp.is_error:
+                    status, response = _failure(resp)
+                    log(f"❌ Failed: {entity_id} - {status}")
+                    result = (index, status, response, retries)
+                else:
+                    log(f"✅ Success: {entity_id}")
+                    result = (index, "Success", resp.text[:300], retries)
+            await record_q.put((position, result))
+        await record_q.put(None)
+
+    async def drain():
+        for _ in range(concurrency):
+            while (job := await record_q.get()) is not None:
+                record(*job)
+
+    await asyncio.gather(
+        read(),
+        *(fetch() for _ in range(concurrency)),
+        patch(),
+        *(put() for _ in range(concurrency)),
+        drain(),
+    )
+
+
+async def _run(items, get_url, put_url, modify, config, concurrency, rate_limit, headers, multipart, log, record):
+    http = AsyncHttpClient(config, concurrency=concurrency, rate_limit=rate_limit)
+    try:
+        await _pipeline(http, items, get_url, put_url, modify, concurrency, headers, multipart, log, record)
+    finally:
+        await http.aclose()
+    limit = int(http.limit.limit)
+    metrics.observe("engine_concurrency", limit)
+    log(f"ℹ️ Settled at {limit} requests in flight (max {concurrency})")
+
+
+def stream_modify_put(items, get_url, put_url, modify, config, record, concurrency=None, rate_limit=None,
+                      headers=None, multipart=True, log=print):
+    """
+    get_modify_put() for sheets that should not be held in memory twice.
+
+    `items` may be a generator; it is only read as fast as the API keeps up.
+    Instead of returning a list, every finished row is passed to
+    `record(position, (index, status, response, retries))` (position = order in `items`).
+    Rows are not grouped by entity, so an entity ID should appear only once.
+    """
+    concurrency = concurrency or concurrency_from(config)
+    asyncio.run(_run(items, get_url, put_url, modify, config, concurrency, rate_limit, headers, multipart, log, record))
+
+
+def group_by_entity(items, modify):
+    """
+    Merges rows that target the same entity into one item per entity.
+
+    Returns the grouped items, a modify callback that applies the rows of a
+    group one after another to the single fetched entity, and `expand(result)`
+    which turns the group's result back into one result per row. A row that
+    raises SkipRow (or returns None) keeps its own status; the other rows share
+    the status of the group's PUT. Retries are reported on the first row only.
+    """
+    groups = {}
+    for index, entity_id, row in items:
+        groups.setdefault(entity_id, []).append((index, row))
+    row_status = {}
+
+    def modify_group(entity, rows):
+        changed = False
+        for index, row in rows:
+            try:
+                updated = modify(entity, row)
+            except SkipRow as skip:
+                row_status[index] = (skip.status, skip.response)
+                continue
+            if updated is None:
+                row_status[index] = (UNCHANGED, "")
+                continue
+            entity, changed = updated, True
+        return entity if changed else None
+
+    def expand(result):
+        indices, status, response, retries = result
+        for n, index in enumerate(indices):
+            row_result = row_status.get(index, (status, response))
+            yield (index, *row_result, retries if n == 0 else 0)
+
+    grouped = [(tuple(index for index, _ in rows), entity_id, rows) for entity_id, rows in groups.items()]
+    return grouped, modify_group, expand
+
+
+def get_modify_put(items, get_url, put_url, modify, config, concurrency=None, rate_limit=None,
+                   headers=None, multipart=True, log=print, on_result=None):
+    """
+    Updates entities concurrently and returns [(index, status, response, retries), ...] in input order.
+
+    Rows with the same entity ID are grouped (see group_by_entity): the entity is
+    fetched once, every row is applied to it and it is PUT once. This also keeps
+    two rows from racing on the same entity.
+
+    Args:
+        items (list): (index, entity_id, row) per row to process.
+        get_url (callable): entity_id -> URL of the entity.
+        put_url (str or callable): URL the entity is PUT to (or entity_id -> URL).
+        modify (callable): (entity_json, row) -> JSON to PUT, or None when nothing changed.
+            May raise SkipRow to end the row with a custom status.
+        config (dict): The job config; supplies the token and optionally "concurrency".
+        concurrency (int): Entities in flight; defaults to concurrency_from(config).
+        rate_limit (float): Target requests per second for the API host.
+        headers (dict): Extra headers for the GET requests.
+        multipart (bool): PUT the JSON as a multipart "dto" field (default) or, if False, as the JSON body.
+        on_result (callable): Called with every row's (index, status, response, retries) as soon
+            as the row is finished, e.g. to append it to the job's ResultLog.
+    """
+    if not items:
+        return []
+    grouped, modify_group, expand = group_by_entity(items, modify)
+    positions = {index: position for position, (index, _, _) in enumerate(items)}
+    results = [None] * len(items)
+
+    def record(_, result):
+        for row_result in expand(result):
+            results[positions[row_result[0]]] = row_result
+            if on_result:
+                on_result(*row_result)
+
+    stream_modify_put(grouped, get_url, put_url, modify_group, config, record, concurrency=concurrency,
+                      rate_limit=rate_limit, headers=headers, multipart=multipart, log=log)
+    return results
@@ -0,0 +1,26 @@
+"""
+Content fingerprints for skipping no-op updates.
+
+Scripts that GET an entity, patch it and PUT it back take a fingerprint of the
+entity before patching and compare it with the patched one; when they match
+the PUT would not change anything and the row is reported as `UNCHANGED`.
+Re-running a partly applied sheet then only writes the rows that still differ.
+
+The fingerprint is a hash of canonical JSON (sorted keys, no whitespace), so
+key order and formatting in the API response do not matter. It must be taken
+before the entity is modified, as patching happens in place.
+"""
+
+import hashlib
+import json
+
+UNCHANGED = "Unchanged"
+
+
+def canonical_json(obj):
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def fingerprint(obj):
+    """Hex digest identifying the JSON content of `obj`."""
+    return hashlib.blake2b(canonical_json(obj).encode("utf-8"), digest_size=16).hexdigest()
@@ -0,0 +1,258 @@
+"""
+Shared HTTP client for app/scripts.
+
+The module-level `requests.get/put/...` helpers open a new TCP + TLS connection
+for every call. `HttpClient` sends everything through one keep-alive connection
+pool per server process instead: each thread of a script gets its own
+`requests.Session` (sessions are not thread-safe), but all sessions mount the
+same `HTTPAdapter`, so a connection opened by one request is reused by the next
+one, whichever thread sends it.
+
+The client also adds the bearer token (renewed mid-run through
+config["token_provider"] when available), applies a default timeout to every
+request and can open connections ahead of time with `warm_up()`; the server
+does that for the job's API hosts while the user is being authenticated.
+Clients created with a `rate_limit` pace their requests through the shared
+per-host limiter in app/core/ratelimit.py, never faster than that rate. Transient failures of idempotent
+requests are retried according to app/core/retry.py, within a retry budget per
+client (i.e. per job); `pop_retries()` tells a script how many retries the rows
+it processed on the calling thread needed.
+
+Tunables (environment variables):
+    HTTP_POOL_SIZE        - keep-alive connections kept per host (default 16)
+    HTTP_CONNECT_TIMEOUT  - default connect timeout in seconds (default 10)
+    HTTP_READ_TIMEOUT     - default read timeout in seconds (default 60)
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.core import ratelimit
+from app.core.auth import TokenAuth
+from app.core.metrics import metrics
+from app.core.retry import RetryBudget, RetryPolicy
+
+POOL_SIZE = max(1, int(os.getenv("HTTP_POOL_SIZE", "16") or 16))
+DEFAULT_TIMEOUT = (
+    float(os.getenv("HTTP_CONNECT_TIMEOUT", "10") or 10),
+    float(os.getenv("HTTP_READ_TIMEOUT", "60") or 60),
+)
+WARM_UP_TIMEOUT = 5  # seconds
+
+_adapter = None
+_adapter_lock = threading.Lock()
+
+
+def shared_adapter():
+    """The process-wide connection pool; created on first use (also in job processes)."""
+    global _adapter
+    with _adapter_lock:
+        if _adapter is None:
+            # No retries here: a retried POST could create records twice
+            _adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=0)
+        return _adapter
+
+
+def _origin(url):
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.netloc:
+        return None
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def config_urls(config):
+    """API URLs configured for a job (used to decide which hosts to warm up)."""
+    urls = []
+    for key in ("post_api_url", "secondary_api_url", "url"):
+        value = config.get(key)
+        if isinstance(value, str) and _origin(value.strip()):
+            urls.append(value.strip())
+    return urls
+
+
+class _StaticToken:
+    """Token provider for a fixed config["token"] (no renewal possible)."""
+
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, rejected=None):
+        return self.token
+
+
+class HttpClient:
+    """
+    Pooled, thread-safe replacement for the module-level requests functions.
+
+    Args:
+        config (dict): The job config; supplies "token_provider" or "token".
+        concurrency (int): Number of threads the script sends requests from.
+        timeout: Default timeout for requests that do not pass one.
+        rate_limit (float): Target requests per second per API host, or None for
+            no pacing. The actual rate backs off when the host struggles.
+        retry (RetryPolicy): How failed requests are retried.
+        retry_budget (int): Retries this client may spend in total.
+    """
+
+    def __init__(self, config=None, concurrency=1, timeout=DEFAULT_TIMEOUT, rate_limit=None,
+                 retry=None, retry_budget=None):
+        config = config or {}
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = timeout
+        self.rate_limit = rate_limit
+        self.retry = retry or RetryPolicy()
+        self.budget = RetryBudget() if retry_budget is None else RetryBudget(retry_budget)
+        provider = config.get("token_provider")
+        if provider is None and config.get("token"):
+            provider = _StaticToken(config.get("token"))
+        self.auth = TokenAuth(provider) if provider is not None else None
+        self._local = threading.local()
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+
+    def _limiter(self, url):
+        """This client's (i.e. this job's) limiter for the URL's host, or None without a rate_limit."""
+        if not self.rate_limit:
+            return None
+        host = urlsplit(url).netloc
+        with self._limiters_lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = self._limiters[host] = ratelimit.limiter_for(url, self.rate_limit)
+        return limiter
+
+    @property
+    def session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = shared_adapter()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._local.session = session
+        return session
+
+    def request(self, method, url, authenticate=True, idempotent=None, **kwargs):
+        """
+        Sends a request on the calling thread's pooled session, retrying transient failures.
+
+        Args:
+            authenticate (bool): Add the bearer token. Pass False for third-party
+                APIs (e.g. Google Maps) that must not receive it.
+            idempotent (bool): Whether the request may be sent twice. Defaults to
+                True for GET/PUT/DELETE and for requests with an Idempotency-Key header.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        if authenticate and self.auth is not None:
+            kwargs.setdefault("auth", self.auth)
+        limiter = self._limiter(url)
+        idempotent = self.retry.is_idempotent(method, kwargs.get("headers"), idempotent)
+
+        attempt = 1
+        while True:
+            response = error = None
+            try:
+                response = self._send(limiter, method, url, kwargs)
+                retryable = idempotent and self.retry.should_retry_status(response.status_code)
+            except requests.exceptions.ConnectTimeout as e:
+                # The request never reached the server, so even a POST is safe to resend
+                error, retryable = e, True
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error, retryable = e, idempotent
+
+            if not retryable or attempt >= self.retry.max_attempts:
+                break
+            if not self.budget.take():
+                metrics.incr("http_retry_budget_exhausted")
+                break
+
+            retry_after = None
+            if response is not None:
+                retry_after = ratelimit.parse_retry_after(response.headers.get("Retry-After"))
+                response.content  # hand the connection back to the pool
+            self._local.retries = self.retries_on_thread() + 1
+            metrics.incr("http_retries")
+            time.sleep(self.retry.backoff(attempt, retry_after))
+            attempt += 1
+
+        if error is not None:
+            raise error
+        return response
+
+    def _send(self, limiter, method, url, kwargs):
+        if limiter is None:
+            return self.session.request(method, url, **kwargs)
+
+        limiter.acquire()
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            limiter.record(None)
+            raise
+        limiter.record(
+            response.status_code,
+            time.monotonic() - started,
+            ratelimit.parse_retry_after(response.headers.get("Retry-After")),
+        )
+        return response
+
+    def retries_on_thread(self):
+        return getattr(self._local, "retries", 0)
+
+    def pop_retries(self):
+        """Returns the number of retries made on the calling thread since the last call, and resets it."""
+        retries = self.retries_on_thread()
+        self._local.retries = 0
+        return retries
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def warm_up(self, urls=None):
+        """Opens up to `concurrency` connections per host; see warm_up()."""
+        warm_up(urls or [], self.concurrency)
+
+
+def _open_connection(origin):
+    try:
+        # Any response will do; what matters is the TCP + TLS connection left in the pool
+        request = requests.Request("HEAD", origin).prepare()
+        # Same TLS/proxy settings as a Session would use, so the connection lands in the pool the job uses
+        settings = requests.Session().merge_environment_settings(origin, {}, None, None, None)
+        response = shared_adapter().send(request, timeout=WARM_UP_TIMEOUT, **settings)
+        # Reading the (empty) body hands the connection back to the pool instead of closing it
+        response.content
+    except requests.exceptions.RequestException:
+        pass
+
+
+def warm_up(urls, connections=1):
+    """
+    Opens keep-alive connections to the hosts of `urls` so the first requests of a
+    job skip DNS, TCP and TLS setup. Failures are ignored; the job will report them.
+    """
+    origins = {origin for origin in map(_origin, urls) if origin}
+    tasks = [origin for origin in origins for _ in range(max(1, min(connections, POOL_SIZE)))]
+    if not tasks:
+        return
+    with ThreadPoolExecutor(max_workers=len(tasks)) as ex:
+        list(ex.map(_open_connection, tasks))
@@ -0,0 +1,199 @@
+"""
+Job scheduler for script executions.
+
+Jobs submitted through /api/execute are queued here instead of being handed
+straight to FastAPI BackgroundTasks. A single dispatcher task pulls jobs off the
+queue (priority first, FIFO within a priority) and starts them while there is a
+free worker slot and the job's tenant is under its concurrency cap. Blocking
+script bodies run on the scheduler's own bounded thread pool, so long jobs never
+compete with the event loop for the default executor.
+
+Tunables (environment variables):
+    MAX_CONCURRENT_JOBS   - worker pool size (default 4)
+    MAX_JOBS_PER_TENANT   - running jobs allowed per tenant (default 2)
+    MAX_QUEUED_JOBS       - pending jobs accepted before new ones are rejected (default 100)
+"""
+
+import asyncio
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+DEFAULT_PRIORITY = "normal"
+
+
+class QueueFullError(Exception):
+    """Raised when the pending queue has reached MAX_QUEUED_JOBS."""
+
+
+class DuplicateJobError(Exception):
+    """Raised when a client already has a queued or running job."""
+
+
+@dataclass
+class Job:
+    client_id: str
+    tenant: str
+    priority: int
+    seq: int
+    func: Callable[..., Awaitable[Any]]
+    args: tuple = field(default_factory=tuple)
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+
+    @property
+    def sort_key(self):
+        return (self.priority, self.seq)
+
+
+def _env_int(name, default):
+    try:
+        return max(1, int(os.getenv(name, default)))
+    except ValueError:
+        return default
+
+
+class JobScheduler:
+    def __init__(self, max_workers=None, per_tenant_limit=None, max_queued=None):
+        self.max_workers = max_workers or _env_int("MAX_CONCURRENT_JOBS", 4)
+        self.per_tenant_limit = per_tenant_limit or _env_int("MAX_JOBS_PER_TENANT", 2)
+        self.max_queued = max_queued or _env_int("MAX_QUEUED_JOBS", 100)
+
+        # Pending jobs kept sorted by (priority, seq)
+        self.pending: List[Job] = []
+        # client_id -> running Job
+        self.running: Dict[str, Job] = {}
+        # tenant -> number of running jobs
+        self.tenant_running: Dict[str, int] = {}
+
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._tasks: set = set()
+
+    # ---------------- Lifecycle ----------------
+    def start(self):
+        # Event must be created inside the running loop (Python 3.9 binds it at construction)
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+        print(f"Job scheduler started: {self.max_workers} workers, "
+              f"{self.per_tenant_limit} per tenant, queue limit {self.max_queued}.")
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+        for task in list(self._tasks):
+            task.cancel()
+        self.executor.shutdown(wait=False)
+
+    # ---------------- Queue API ----------------
+    def submit(self, client_id: str, tenant: str, func, *args, priority: str = DEFAULT_PRIORITY) -> Job:
+        if self.has_job(client_id):
+            raise DuplicateJobError(f"Client {client_id} already has a job queued or running.")
+        if len(self.pending) >= self.max_queued:
+            raise QueueFullError(f"Job queue is full ({self.max_queued} pending). Try again later.")
+
+        job = Job(
+            client_id=client_id,
+            tenant=tenant or "default",
+            priority=PRIORITIES.get(str(priority).lower(), PRIORITIES[DEFAULT_PRIORITY]),
+            seq=next(self._seq),
+            func=func,
+            args=args,
+        )
+        self.pending.append(job)
+        self.pending.sort(key=lambda j: j.sort_key)
+        self._notify()
+        return job
+
+    def cancel(self, client_id: str) -> bool:
+        """Removes a queued (not yet started) job. Returns True if one was removed."""
+        for job in self.pending:
+            if job.client_id == client_id:
+                self.pending.remove(job)
+                return True
+        return False
+
+    def has_job(self, client_id: str) -> bool:
+        return self.is_queued(client_id) or client_id in self.running
+
+    def is_queued(self, client_id: str) -> bool:
+        return any(job.client_id == client_id for job in self.pending)
+
+    def queue_position(self, client_id: str) -> Optional[int]:
+        """1-based position in dispatch order, or None if the client has nothing queued."""
+        for position, job in enumerate(self.pending, start=1):
+            if job.client_id == client_id:
+                return position
+        return None
+
+    def status(self, client_id: str) -> dict:
+        position = self.queue_position(client_id)
+        if client_id in self.running:
+            state = "running"
+        elif position is not None:
+            state = "queued"
+        else:
+            state = "idle"
+        return {
+            "state": state,
+            "queue_position": position,
+            "queue_depth": len(self.pending),
+            "running_jobs": len(self.running),
+            "max_workers": self.max_workers,
+        }
+
+    # ---------------- Dispatching ----------------
+    def _notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _next_eligible(self) -> Optional[Job]:
+        for job in self.pending:
+            if self.tenant_running.get(job.tenant, 0) < self.per_tenant_limit:
+                return job
+        return None
+
+    async def _dispatch_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            while len(self.running) < self.max_workers:
+                job = self._next_eligible()
+                if job is None:
+                    break
+                self.pending.remove(job)
+                self.running[job.client_id] = job
+                self.tenant_running[job.tenant] = self.tenant_running.get(job.tenant, 0) + 1
+                job.started_at = time.time()
+
+                task = asyncio.create_task(self._run(job))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: Job):
+        try:
+            await job.func(*job.args)
+        except Exception as e:
+            print(f"Job for {job.client_id} raised: {e}")
+        finally:
+            self.running.pop(job.client_id, None)
+            remaining = self.tenant_running.get(job.tenant, 1) - 1
+            if remaining > 0:
+                self.tenant_running[job.tenant] = remaining
+            else:
+                self.tenant_running.pop(job.tenant, None)
+            self._notify()
+
+
+scheduler = JobScheduler()
@@ -0,0 +1,231 @@
+"""
+Per-client log store behind the SSE log stream.
+
+Every line gets a monotonically increasing event ID. The newest lines of a
+client are kept in a fixed-size in-memory ring buffer; lines pushed out of the
+buffer are appended to a gzip file in LOG_SPILL_DIR (in chunks, one gzip member
+per chunk), so the full history of a run can still be replayed without keeping
+it in RAM. Readers ask for everything after a given event ID, which is how SSE
+reconnects with `Last-Event-ID` resume without receiving the history twice.
+
+Within a client the event IDs are consecutive, so the distance between two IDs
+is a line count. A client's numbering starts above every ID handed out so far,
+which keeps IDs increasing across `clear()`: a cursor from a previous run can
+never hide lines of the next one. Clients that have not been touched for
+LOG_TTL_SECONDS are dropped by `evict_idle()` together with their spill file.
+
+Worker threads write lines straight into the store (it is thread-safe) and only
+ask the event loop to wake the client's SSE stream once per LOG_FLUSH_INTERVAL,
+or right away when LOG_FLUSH_LINES lines are waiting. The stream then sends
+everything new as one multi-line SSE frame of at most LOG_FRAME_LINES lines.
+A browser that falls more than LOG_MAX_LAG lines behind skips ahead: the
+skipped lines are replaced by a one-line summary, keeping JOB_ control lines.
+
+Tunables (environment variables):
+    LOG_BUFFER_LINES   - lines kept in memory per client (default 2000)
+    LOG_SPILL_DIR      - directory for compressed older lines (default "logs")
+    LOG_TTL_SECONDS    - idle time after which a client's logs are dropped (default 3600)
+    LOG_FLUSH_INTERVAL - seconds between stream wake-ups while a job logs (default 0.1)
+    LOG_FLUSH_LINES    - pending lines that trigger an immediate wake-up (default 200)
+    LOG_FRAME_LINES    - lines per SSE frame (default 200)
+    LOG_MAX_LAG        - lines a browser may fall behind before lines are skipped (default 5000)
+"""
+
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+BUFFER_LINES = max(1, int(os.getenv("LOG_BUFFER_LINES", "2000") or 2000))
+SPILL_DIR = os.getenv("LOG_SPILL_DIR", "logs")
+TTL_SECONDS = float(os.getenv("LOG_TTL_SECONDS", "3600") or 3600)
+FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "0.1") or 0.1)
+FLUSH_LINES = max(1, int(os.getenv("LOG_FLUSH_LINES", "200") or 200))
+FRAME_LINES = max(1, int(os.getenv("LOG_FRAME_LINES", "200") or 200))
+MAX_LAG = max(1, int(os.getenv("LOG_MAX_LAG", "5000") or 5000))
+
+CONTROL_PREFIX = "JOB_"  # JOB_COMPLETED:: / JOB_FAILED:: lines drive the UI and are never skipped
+
+SPILL_CHUNK = 500  # lines written to the spill file at once
+
+
+class _ClientLog:
+    def __init__(self, client_id: str, spill_dir: str, buffer_lines: int, first_id: int):
+        self.lines: deque = deque()
+        self.base_id = first_id - 1  # event IDs of this log are base_id + 1, base_id + 2, ...
+        self.last_id = self.base_id
+        self.buffer_lines = buffer_lines
+        # Lines pushed out of the ring buffer but not yet written to disk
+        self.to_spill: List[Tuple[int, str]] = []
+        self.spilled_ids = 0  # number of lines on disk
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", client_id)
+        self.spill_path = os.path.join(spill_dir, f"{safe_name}.log.gz")
+        self.touched = time.monotonic()
+
+    def append(self, message: str) -> int:
+        self.last_id += 1
+        self.lines.append((self.last_id, message))
+        if len(self.lines) > self.buffer_lines:
+            self.to_spill.append(self.lines.popleft())
+            if len(self.to_spill) >= SPILL_CHUNK:
+                self.flush_spill()
+        return self.last_id
+
+    def flush_spill(self):
+        if not self.to_spill:
+            return
+        os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+        # Appending opens a new gzip member; gzip.open reads them back as one stream
+        with gzip.open(self.spill_path, "at", encoding="utf-8") as f:
+            for event_id, message in self.to_spill:
+                f.write(json.dumps([event_id, message]) + "\n")
+        self.spilled_ids += len(self.to_spill)
+        self.to_spill = []
+
+    def read_spill(self, after: int, limit: int) -> List[Tuple[int, str]]:
+        result = []
+        if self.spilled_ids and os.path.exists(self.spill_path):
+            with gzip.open(self.spill_path, "rt", encoding="utf-8") as f:
+                for raw in f:
+                    event_id, message = json.loads(raw)
+                    if event_id > after:
+                        result.append((event_id, message))
+                        if len(result) >= limit:
+                            return result
+        for event_id, message in self.to_spill:
+            if event_id > after:
+                result.append((event_id, message))
+                if len(result) >= limit:
+                    break
+        return result
+
+    def discard(self):
+        self.lines.clear()
+        self.to_spill = []
+        self.spilled_ids = 0
+        try:
+            os.remove(self.spill_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Failed to delete {self.spill_path}. Reason: {e}")
+
+
+class LogStore:
+    def __init__(self, buffer_lines: int = BUFFER_LINES, spill_dir: str = SPILL_DIR, ttl: float = TTL_SECONDS):
+        self.buffer_lines = buffer_lines
+        self.spill_dir = spill_dir
+        self.ttl = ttl
+        self._clients: Dict[str, _ClientLog] = {}
+        self._lock = threading.Lock()
+        self._high_id = 0  # highest event ID handed out to any client
+
+    def _client(self, client_id: str) -> _ClientLog:
+        log = self._clients.get(client_id)
+        if log is None:
+            log = _ClientLog(client_id, self.spill_dir, self.buffer_lines, self._high_id + 1)
+            self._clients[client_id] = log
+        log.touched = time.monotonic()
+        return log
+
+    # ---------------- Writing ----------------
+    def append(self, client_id: str, message: str) -> int:
+        """Stores a line and returns its event ID."""
+        with self._lock:
+            event_id = self._client(client_id).append(message)
+            self._high_id = max(self._high_id, event_id)
+            return event_id
+
+    def extend(self, client_id: str, messages: List[str]) -> int:
+        """Stores several lines under one lock acquisition and returns the last event ID."""
+        with self._lock:
+            log = self._client(client_id)
+            for message in messages:
+                log.append(message)
+            self._high_id = max(self._high_id, log.last_id)
+            return log.last_id
+
+    def clear(self, client_id: str):
+        """Drops the history of a client. Event IDs are not reset."""
+        with self._lock:
+            log = self._clients.pop(client_id, None)
+        if log is not None:
+            log.discard()
+
+    # ---------------- Reading ----------------
+    def has_logs(self, client_id: str) -> bool:
+        with self._lock:
+            log = self._clients.get(client_id)
+            return bool(log and (log.lines or log.to_spill or log.spilled_ids))
+
+    def lag(self, client_id: str, after: int) -> int:
+        """Number of lines of the client after event ID `after`."""
+        with self._lock:
+            log = self._clients.get(client_id)
+            return log.last_id - max(after, log.base_id) if log else 0
+
+    def skip_to(self, client_id: str, after: int, keep: int) -> Tuple[int, int, List[Tuple[int, str]]]:
+        """
+        Moves a lagging cursor so that only the newest `keep` lines remain to be sent.
+
+        Returns (new_cursor, skipped_count, control_lines) where control_lines are the
+        JOB_ lines among the skipped ones that the ring buffer still holds.
+        """
+        with self._lock:
+            log = self._clients.get(client_id)
+            if log is None:
+                return after, 0, []
+            start = max(after, log.base_id)
+            new_cursor = max(start, log.last_id - keep)
+            control = [
+                item for item in log.lines
+                if start < item[0] <= new_cursor and item[1].startswith(CONTROL_PREFIX)
+            ]
+            return new_cursor, new_cursor - start, control
+
+    def read_since(self, client_id: str, after: int = 0, limit: int = 1000) -> List[Tuple[int, str]]:
+        """Returns up to `limit` (event_id, message) pairs with event_id > after, oldest first."""
+        with self._lock:
+            log = self._clients.get(client_id)
+            if log is None:
+                return []
+            log.touched = time.monotonic()
+            in_memory = [item for item in log.lines if item[0] > after]
+            oldest_in_memory = log.lines[0][0] if log.lines else None
+            # Only older lines than the ring buffer holds need the disk
+            needs_spill = (log.to_spill or log.spilled_ids) and (oldest_in_memory is None or after < oldest_in_memory - 1)
+            if needs_spill:
+                result = log.read_spill(after, limit)
+                if len(result) < limit:
+                    result.extend(in_memory[:limit - len(result)])
+                return result
+        return in_memory[:limit]
+
+    # ---------------- Housekeeping ----------------
+    def evict_idle(self, keep: Optional[set] = None) -> int:
+        """Drops clients idle for longer than the TTL, except those in `keep`. Returns how many were dropped."""
+        now = time.monotonic()
+        keep = keep or set()
+        with self._lock:
+            expired = [
+                client_id for client_id, log in self._clients.items()
+                if client_id not in keep and now - log.touched > self.ttl
+            ]
+            logs = [self._clients.pop(client_id) for client_id in expired]
+        for log in logs:
+            log.discard()
+        return len(logs)
+
+    def reset_spill_dir(self):
+        """Removes spill files left over from a previous server run."""
+        os.makedirs(self.spill_dir, exist_ok=True)
+        for filename in os.listdir(self.spill_dir):
+            if filename.endswith(".log.gz"):
+                try:
+                    os.remove(os.path.join(self.spill_dir, filename))
+                except OSError as e:
+                    print(f"Failed to delete {filename}. Reason: {e}")
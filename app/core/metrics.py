@@ -0,0 +1,54 @@
+"""
+In-process metrics registry, published through /api/metrics.
+
+Counters are plain running totals. Observations keep a bounded window of recent
+samples and are summarised (count, last, avg, p50, p95, max) on read.
+"""
+
+import threading
+from collections import deque
+
+WINDOW = 500  # samples kept per observed metric
+
+
+class Metrics:
+    def __init__(self, window=WINDOW):
+        self._lock = threading.Lock()
+        self._window = window
+        self._counters = {}
+        self._samples = {}
+        self._totals = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            if name not in self._samples:
+                self._samples[name] = deque(maxlen=self._window)
+                self._totals[name] = 0
+            self._samples[name].append(value)
+            self._totals[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            samples = {name: list(values) for name, values in self._samples.items()}
+            totals = dict(self._totals)
+
+        summaries = {}
+        for name, values in samples.items():
+            ordered = sorted(values)
+            summaries[name] = {
+                "count": totals[name],
+                "last": round(values[-1], 4),
+                "avg": round(sum(values) / len(values), 4),
+                "p50": round(ordered[len(ordered) // 2], 4),
+                "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4),
+                "max": round(ordered[-1], 4),
+            }
+        return {"counters": counters, "observations": summaries}
+
+
+metrics = Metrics()
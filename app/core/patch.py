@@ -0,0 +1,214 @@
+"""
+Declarative field patches for the farmer and asset update scripts.
+
+Update_{Farmer,Asset}_{Details,Additional_Attribute,Address} all read an ID
+column plus one value column per key configured in the UI (`attr_keys`), GET
+the entity, overwrite those keys and PUT the entity back. A script only
+describes where its values go:
+
+    PatchSpec(config.get("attr_keys", []), column_prefix="address_value_", target="address")
+
+and hands it to `run_patch()`, which runs the shared pipeline: the sheet is
+streamed in batches (`app.core.tables`), each batch is reduced to its IDs and
+cleaned values in one vectorized pass (`app.core.preflight`), the GET / patch / PUT stages of `app.core.engine` take it from
+there and every finished row is written to the output workbook in sheet order.
+Neither workbook is ever held in memory as a whole.
+
+The spec is compiled against the sheet header once, so per batch the pipeline
+only cleans a few columns instead of building a pandas Series per row.
+"""
+
+from app.core import preflight
+from app.core.engine import SkipRow, concurrency_from, stream_modify_put
+from app.core.results import ResultLog
+from app.core.tables import SheetReader, SheetWriter
+
+RESULT_COLUMNS = ["Status", "Response", "Retries"]
+
+
+class PatchSpec:
+    """
+    Where the configured keys are written in the entity JSON.
+
+    Args:
+        keys (list): Keys from the UI; the N-th key (1-based) takes its values from column `{column_prefix}N`.
+            Blank keys are ignored but keep their position.
+        column_prefix (str): Prefix of the value columns, e.g. "value_" or "additional_attribute_".
+        target (str): Key of the nested object to patch ("data", "address"), or None for the top level.
+        compare (bool): Only write a value when it differs from the current one as a stripped string.
+            When False every value is written as is, and only rows that leave the entity
+            exactly as it was skip the PUT.
+        key_columns (bool): Also accept a column named after the key itself when `{column_prefix}N` is missing.
+        missing_status (str): Row status when the entity has no `target` object.
+    """
+
+    def __init__(self, keys, column_prefix, target=None, compare=True, key_columns=False,
+                 missing_status="Failed: No valid data object"):
+        self.keys = {i: key.strip() for i, key in enumerate(keys or []) if key and key.strip()}
+        self.column_prefix = column_prefix
+        self.target = target
+        self.compare = compare
+        self.key_columns = key_columns
+        self.missing_status = missing_status
+
+    def compile(self, columns, log=print):
+        """Resolves every key to a column position of the sheet."""
+        columns = list(columns)
+        fields = []
+        for i, key in self.keys.items():
+            name = f"{self.column_prefix}{i + 1}"
+            if name not in columns and self.key_columns and key in columns:
+                name = key
+            if name in columns:
+                fields.append((key, columns.index(name)))
+            else:
+                log(f"⚠️ Column '{self.column_prefix}{i + 1}' missing in Excel for key '{key}'")
+        return CompiledPatch(self, fields)
+
+
+class CompiledPatch:
+    def __init__(self, spec, fields):
+        self.spec = spec
+        self.fields = fields  # [(key, column position), ...]
+
+    def values(self, frame):
+        """The cleaned values of every row of `frame`, as one tuple per row."""
+        columns = [preflight.text(frame.iloc[:, position]) for _, position in self.fields]
+        return zip(*columns) if columns else [()] * len(frame)
+
+    def apply(self, entity, values):
+        """Writes the values into the entity; returns None when nothing changed."""
+        target = entity
+        if self.spec.target is not None:
+            target = entity.get(self.spec.target)
+            if not isinstance(target, dict):
+                raise SkipRow(self.spec.missing_status)
+
+        changed = False
+        for (key, _), value in zip(self.fields, values):
+            if self.spec.compare:
+                current = target.get(key)
+                if current is None:
+                    current = ""
+                if str(current).strip() == value:
+                    continue
+            target[key] = value
+            changed = True
+        return entity if changed else None
+
+
+def find_id_column(columns, entity, log=print):
+    """`{entity}_id`, else a column that looks like an ID (farmerId, id, ...), else the first column."""
+    columns = list(columns)
+    id_col = f"{entity}_id"
+    if id_col in columns:
+        return id_col
+    possible = [c for c in columns if str(c).lower().replace('_', '') in [f"{entity}id", "id"]]
+    if possible:
+        log(f"ℹ️ Found ID column: {possible[0]}")
+        return possible[0]
+    log(f"⚠️ '{id_col}' column not found. Using first column: {columns[0]}")
+    return columns[0]
+
+
+def run_patch(input_excel_file, output_excel_file, config, spec, entity, default_url, rate_limit,
+              headers=None, log=print):
+    """
+    Runs a patch job end to end and writes the output workbook.
+
+    Args:
+        spec (PatchSpec): What to write where.
+        entity (str): "farmer" or "asset"; names the ID column and the log lines.
+        default_url (str): Collection URL used when the job has no post_api_url.
+            Entities are read from `{url}/{id}` and PUT to `{url}`.
+        rate_limit (float): The script's RATE_LIMIT.
+        headers (dict): Extra headers for the GET requests.
+    """
+    if not config.get("token"):
+        log("❌ No token provided in configuration.")
+        return
+
+    api_url = config.get("post_api_url")
+    if not api_url:
+        api_url = default_url
+        log(f"Using default {entity.title()} API URL: {api_url}")
+    api_url = api_url.rstrip('/')
+
+    if not spec.keys:
+        log("⚠️ No keys configured! Please enter at least one key in the UI.")
+
+    log(f"📘 Loading Excel file: {input_excel_file}")
+    try:
+        sheet = SheetReader(input_excel_file)
+    except Exception as e:
+        log(f"❌ Error reading Excel file: {e}")
+        return
+
+    with sheet:
+        keep = [position for position, name in enumerate(sheet.columns) if not str(name).startswith('Unnamed')]
+        columns = [sheet.columns[position] for position in keep]
+        id_position = columns.index(find_id_column(columns, entity, log))
+        patch = spec.compile(columns, log)
+
+        output_columns = columns + [name for name in RESULT_COLUMNS if name not in columns]
+        result_positions = [output_columns.index(name) for name in RESULT_COLUMNS]
+        writer = SheetWriter(output_excel_file, output_columns)
+        results = ResultLog(output_excel_file, input_excel_file, resume=config.get("resume"), sheet=sheet.name,
+                            job=config.get("client_id"))
+        if results.previous:
+            log(f"⏭️ Resuming: {results.done()} rows already succeeded and are skipped")
+        pending = {}  # position -> output row waiting for its result
+
+        def finish(position, status, response="", row_retries=0):
+            row = pending.pop(position)
+            for column, value in zip(result_positions, (status, str(response), row_retries)):
+                row[column] = value
+            writer.put(position, row)
+            results.record(position, **dict(zip(RESULT_COLUMNS, (status, str(response), row_retries))))
+
+        def rows():
+            for batch in sheet.batches():
+                batch = batch.iloc[:, keep]
+                entity_ids = preflight.ids(batch.iloc[:, id_position])
+                check = preflight.Preflight(batch)
+                check.reject(entity_ids == "", "Skipped: Empty ID")
+                # Rows that are not sent are finished before the batch's first request
+                clean = []
+                for position, cells, rejection in zip(batch.index, batch.itertuples(index=False, name=None), check.status):
+                    pending[position] = list(cells) + [""] * (len(output_columns) - len(cells))
+                    if results.succeeded(position):
+                        previous = results.previous[position]
+                        finish(position, previous.get("Status"), previous.get("Response") or "", previous.get("Retries") or 0)
+                    elif rejection:
+                        finish(position, rejection)
+                    else:
+                        clean.append(position)
+                yield from zip(clean, entity_ids[clean], patch.values(batch.loc[clean]))
+
+        def record(_, result):
+            finish(*result)
+
+        concurrency = concurrency_from(config)
+        size = f"~{sheet.size_hint} " if sheet.size_hint else ""
+        log(f"🔄 Starting processing {size}{entity}s with up to {concurrency} in flight. Updating Keys: {list(spec.keys.values())}")
+
+        stream_modify_put(
+            rows(),
+            get_url=lambda entity_id: f"{api_url}/{entity_id}",
+            put_url=api_url,
+            modify=patch.apply,
+            config=config,
+            record=record,
+            concurrency=concurrency,
+            rate_limit=rate_limit,
+            headers=headers,
+            log=log,
+        )
+
+    log(f"💾 Processed {writer.written} rows, saving...")
+    try:
+        writer.close()
+        results.close()
+        log(f"📁 Output saved to: {output_excel_file}")
+    except Exception as e:
+        log(f"Error saving file: {e}")
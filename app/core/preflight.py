@@ -0,0 +1,103 @@
+"""
+Vectorized normalization and validation of input rows before anything is sent.
+
+Scripts used to clean every cell inside their `iterrows` loop: `str(v).lower()
+== 'nan'` checks, `int(float(v))` coercion and a hand-written comma splitter
+per script. That is a Python call per cell, and the validation ran inside
+the HTTP workers. The helpers here do the same on whole columns with pandas
+string and numeric operations:
+
+    farmer_ids = ids(df["farmer_id"])     # 123.0 -> "123", NaN/blank -> ""
+    tag_ids = id_lists(df["tags"])        # "121, 122" -> [121, 122]
+    days = ints(df["no_of_days"])         # "3", 3.0, "3.7" -> 3; blank/invalid -> 0
+    recurring = bools(df["recuring"])     # true/1/yes/y -> True
+
+`Preflight` collects the rows of a frame that must not be sent. Each
+`reject(mask, status)` marks the rows of a boolean mask that are not rejected
+yet, so a row's status names the first check it failed. Their results are
+known before the first request (`rejected`, to be written to the output or
+result log straight away), and only the rows in `clean` go to the workers.
+"""
+
+import numpy as np
+import pandas as pd
+
+TRUE_VALUES = ("true", "1", "yes", "y")
+INTEGER = r"[+-]?\d+"
+
+
+def column(frame, name):
+    """`frame[name]`, or an all-empty column when the sheet does not have it."""
+    if name in frame.columns:
+        return frame[name]
+    return pd.Series(np.nan, index=frame.index, dtype=object)
+
+
+def text(series):
+    """Cells as stripped strings (object dtype); NaN and None become ""."""
+    return series.where(series.notna(), "").astype(str).str.strip().astype(object)
+
+
+def ids(series):
+    """
+    Cells as ID strings. Whole numbers lose the ".0" pandas gives them in a
+    column that also has blanks (123.0 -> "123"); NaN and blanks become "".
+    """
+    return text(series).str.replace(r"^([+-]?\d+)\.0*$", r"\1", regex=True)
+
+
+def id_lists(series):
+    """Comma-separated integer IDs ("121, 122") as lists of ints; parts that are not integers are dropped."""
+    parts = ids(series).str.split(",").explode().str.strip()
+    parts = parts[parts.str.fullmatch(INTEGER, na=False)]
+    lists = parts.astype("int64").groupby(level=0, sort=False).agg(list)
+    lists = lists.reindex(series.index)
+    return pd.Series([value if isinstance(value, list) else [] for value in lists], index=series.index, dtype=object)
+
+
+def ints(series, default=0):
+    """Cells as ints, truncating decimals; blanks and anything that is not a number become `default`."""
+    numbers = pd.to_numeric(text(series), errors="coerce").astype("float64")
+    numbers = numbers.where(np.isfinite(numbers), default)
+    return np.trunc(numbers).astype("int64")
+
+
+def bools(series):
+    """Cells as booleans: true/1/yes/y (any case) are True, everything else False."""
+    return ids(series).str.lower().isin(TRUE_VALUES)
+
+
+class Preflight:
+    """
+    The rejected rows of a frame (or batch) and why.
+
+    Args:
+        frame (DataFrame): The rows to check; its index identifies them.
+    """
+
+    def __init__(self, frame):
+        self.status = pd.Series("", index=frame.index, dtype=object)
+
+    def reject(self, mask, status):
+        """Rejects the rows of `mask` that are not rejected yet with `status`. Returns how many."""
+        mask = pd.Series(mask, index=self.status.index).astype(bool) & (self.status == "")
+        self.status[mask] = status
+        return int(mask.sum())
+
+    @property
+    def rejected(self):
+        """Status of every rejected row (index = row)."""
+        return self.status[self.status != ""]
+
+    @property
+    def clean(self):
+        """Index of the rows that passed every check."""
+        return self.status.index[(self.status == "").to_numpy()]
+
+    def summary(self):
+        """"N rows rejected (status: count, ...)" for the job log, or "" when none were."""
+        counts = self.rejected.value_counts()
+        if counts.empty:
+            return ""
+        details = ", ".join(f"{status}: {count}" for status, count in counts.items())
+        return f"{int(counts.sum())} rows rejected before sending ({details})"
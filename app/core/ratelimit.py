@@ -0,0 +1,212 @@
+"""
+Adaptive per-host rate limiting for script API calls.
+
+Scripts declare how fast they would like to go (`RATE_LIMIT`, requests per
+second) instead of sleeping between rows. Every API host gets one token bucket
+per server process that all jobs calling that host share. Each job also has a
+bucket of its own per host (`limiter_for()` returns it), filled at the job's
+declared rate and drawn before the shared one, so a job never goes faster than
+its script asks even when another job has the host running at 100 requests/s.
+The shared bucket's rate is adjusted AIMD-style from the responses it sees:
+
+    * 429 and 5xx responses, connection errors and timeouts cut the rate in half;
+      a `Retry-After` header additionally pauses the host for that long.
+    * Latency well above the host's best observed latency cuts it by 10%.
+    * Every other response adds a small fraction of the target back, up to the
+      highest target declared by the jobs using the host.
+
+In process mode each job process has its own buckets. Threads wait with
+`acquire()`, coroutines with `acquire_async()`; both draw from the same bucket.
+
+Tunables (environment variables):
+    RATE_LIMIT_MIN        - lowest rate a host is slowed down to, requests/s (default 0.2)
+    RATE_LIMIT_BURST      - seconds worth of requests a bucket can hold (default 1)
+"""
+
+import asyncio
+import email.utils
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+from app.core.metrics import metrics
+
+MIN_RATE = float(os.getenv("RATE_LIMIT_MIN", "0.2") or 0.2)
+BURST_SECONDS = float(os.getenv("RATE_LIMIT_BURST", "1") or 1)
+
+DECREASE_FACTOR = 0.5  # on 429 / 5xx / network errors
+LATENCY_DECREASE_FACTOR = 0.9  # on slow responses
+INCREASE_FRACTION = 0.05  # of the target, added per healthy response
+LATENCY_SLOW_FACTOR = 3  # "slow" = this many times the best observed latency ...
+LATENCY_SLOW_MIN = 1.0  # ... and at least this many seconds
+LATENCY_EWMA_WEIGHT = 0.2
+MAX_RETRY_AFTER = 120  # seconds; longer pauses are capped
+
+THROTTLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(0.0, seconds), MAX_RETRY_AFTER)
+
+
+class TokenBucket:
+    """A token bucket refilled at `rate` requests per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        capacity = max(1.0, self.rate * BURST_SECONDS)
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _take(self):
+        """Takes a token if one is available; otherwise returns the seconds to wait before trying again."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Blocks until the host may be called again."""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """acquire() for coroutines; waits without blocking the event loop."""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class HostLimiter(TokenBucket):
+    """The bucket of one API host, shared by every job calling it; its rate adapts to the responses."""
+
+    def __init__(self, host, target):
+        super().__init__(target)
+        self.host = host
+        self.target = target
+        self.latency = None  # EWMA
+        self.best_latency = None
+
+    def raise_target(self, target):
+        with self._lock:
+            if target > self.target:
+                self.target = target
+                self.rate = max(self.rate, target)
+
+    def _decrease(self, factor):
+        self.rate = max(MIN_RATE, self.rate * factor)
+        self.tokens = min(self.tokens, 1.0)
+
+    def record(self, status_code=None, latency=None, retry_after=None):
+        """
+        Feeds one outcome back into the bucket.
+
+        Args:
+            status_code (int): HTTP status, or None for a connection error / timeout.
+            latency (float): Seconds the request took.
+            retry_after (float): Seconds from a Retry-After header, if any.
+        """
+        with self._lock:
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+            if status_code is None or status_code in THROTTLE_STATUSES:
+                self._decrease(DECREASE_FACTOR)
+                metrics.incr("rate_limit_backoffs")
+                return
+
+            if latency is not None:
+                self.latency = latency if self.latency is None else (
+                    LATENCY_EWMA_WEIGHT * latency + (1 - LATENCY_EWMA_WEIGHT) * self.latency
+                )
+                self.best_latency = self.latency if self.best_latency is None else min(self.best_latency, self.latency)
+                if self.latency > max(LATENCY_SLOW_MIN, LATENCY_SLOW_FACTOR * self.best_latency):
+                    self._decrease(LATENCY_DECREASE_FACTOR)
+                    return
+
+            self.rate = min(self.target, self.rate + self.target * INCREASE_FRACTION)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "target": self.target,
+                "rate": round(self.rate, 3),
+                "latency": round(self.latency, 3) if self.latency is not None else None,
+                "paused": max(0.0, round(self.paused_until - time.monotonic(), 1)),
+            }
+
+
+class JobLimiter(TokenBucket):
+    """
+    One job's share of a host: a bucket at the job's own `target`, drawn before
+    the host's shared bucket. Outcomes are fed to the host, so every job backs off
+    when the host struggles, but none goes faster than it declared.
+    """
+
+    def __init__(self, host_limiter, target):
+        super().__init__(target)
+        self.host = host_limiter
+
+    def acquire(self):
+        super().acquire()
+        self.host.acquire()
+
+    async def acquire_async(self):
+        await super().acquire_async()
+        await self.host.acquire_async()
+
+    def record(self, status_code=None, latency=None, retry_after=None):
+        self.host.record(status_code, latency, retry_after)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter_for(url, target):
+    """
+    A new limiter for one job calling the URL's host at up to `target` requests/s.
+    Clients keep it for the whole job; it shares the host's bucket with other jobs.
+    """
+    host = urlsplit(url).netloc
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = _limiters[host] = HostLimiter(host, target)
+    # The shared bucket may grow to the fastest job's rate; each job stays under its own
+    limiter.raise_target(target)
+    return JobLimiter(limiter, target)
+
+
+def snapshot():
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.host: limiter.snapshot() for limiter in limiters}
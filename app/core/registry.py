@@ -0,0 +1,164 @@
+"""
+Registry of the automation scripts in app/scripts.
+
+Each script is loaded once and kept together with everything the server needs
+about it: the module, its `run` function, whether `run` accepts a log_callback,
+the docstring-derived description and the UI configuration (URLs and labels).
+`refresh()` only stats the files and reloads the ones whose mtime changed, so
+it is cheap enough to call on every /api/scripts request. The manifest served
+to the UI is cached along with an ETag that changes only when a script does.
+"""
+
+import ast
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+DEFAULT_CONFIG = {
+    "url": "https://cloud.cropin.in/services/master/api",
+    "label": "Api Url",
+    "requires_input": True
+}
+
+
+@dataclass
+class ScriptEntry:
+    name: str
+    path: str
+    mtime: float
+    module: Any = None
+    run: Optional[Callable] = None
+    accepts_log_callback: bool = False
+    load_error: Optional[str] = None
+    description: str = "No description available."
+    input_description: str = "Standard Excel Input."
+    config: Dict[str, Any] = field(default_factory=dict)
+
+    def manifest(self):
+        return {
+            "name": self.name,
+            "url": self.config["url"],
+            "label": self.config["label"],
+            "url2": self.config.get("url2"),
+            "label2": self.config.get("label2"),
+            "requires_input": self.config.get("requires_input", True),
+            "description": self.description,
+            "input_description": self.input_description
+        }
+
+
+def _parse_docstring(source):
+    """Splits the module docstring into (description, input_description) on 'Inputs:'."""
+    description = "No description available."
+    input_description = "Standard Excel Input."
+    docstring = ast.get_docstring(ast.parse(source))
+    if docstring:
+        parts = docstring.split("Inputs:")
+        description = parts[0].strip()
+        if len(parts) > 1:
+            input_description = parts[1].strip()
+    return description, input_description
+
+
+class ScriptRegistry:
+    def __init__(self, scripts_dir: str, configs: Optional[Dict[str, dict]] = None):
+        self.scripts_dir = scripts_dir
+        self.configs = configs or {}
+        self._entries: Dict[str, ScriptEntry] = {}
+        self._lock = threading.RLock()
+        self._manifest: List[dict] = []
+        self._etag = ""
+
+    # ---------------- Loading ----------------
+    def _load(self, name: str, path: str, mtime: float) -> ScriptEntry:
+        entry = ScriptEntry(
+            name=name,
+            path=path,
+            mtime=mtime,
+            config=self.configs.get(name, DEFAULT_CONFIG)
+        )
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry.description, entry.input_description = _parse_docstring(f.read())
+        except Exception as e:
+            print(f"Error parsing docstring for {name}: {e}")
+
+        try:
+            spec = importlib.util.spec_from_file_location(name[:-3], path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            entry.module = module
+            entry.run = getattr(module, "run", None)
+            if entry.run is not None:
+                entry.accepts_log_callback = "log_callback" in inspect.signature(entry.run).parameters
+        except Exception as e:
+            entry.load_error = str(e)
+            print(f"Error loading script {name}: {e}")
+        return entry
+
+    def refresh(self) -> bool:
+        """Reloads new or modified scripts and drops deleted ones. Returns True if anything changed."""
+        with self._lock:
+            seen = set()
+            changed = False
+            for filename in os.listdir(self.scripts_dir):
+                if not filename.endswith(".py") or filename == "__init__.py":
+                    continue
+                path = os.path.join(self.scripts_dir, filename)
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    continue
+                seen.add(filename)
+                current = self._entries.get(filename)
+                if current is None or current.mtime != mtime:
+                    self._entries[filename] = self._load(filename, path, mtime)
+                    changed = True
+
+            for filename in list(self._entries):
+                if filename not in seen:
+                    del self._entries[filename]
+                    changed = True
+
+            if changed or not self._etag:
+                self._rebuild_manifest()
+            return changed
+
+    def _rebuild_manifest(self):
+        manifest = [entry.manifest() for entry in self._entries.values()]
+        # Sort scripts alphabetically by name
+        manifest.sort(key=lambda x: x["name"])
+        self._manifest = manifest
+        digest = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode("utf-8")).hexdigest()
+        self._etag = f'"{digest}"'
+
+    # ---------------- Lookup ----------------
+    def get(self, name: str) -> Optional[ScriptEntry]:
+        """Returns the entry for a script file name, reloading it first if it changed on disk."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                # Unknown names (including paths) are never resolved outside scripts_dir
+                if os.path.basename(name) != name or not os.path.isfile(os.path.join(self.scripts_dir, name)):
+                    return None
+                self.refresh()
+                return self._entries.get(name)
+            try:
+                mtime = os.path.getmtime(entry.path)
+            except OSError:
+                self.refresh()
+                return self._entries.get(name)
+            if mtime != entry.mtime:
+                self._entries[name] = self._load(name, entry.path, mtime)
+                self._rebuild_manifest()
+            return self._entries[name]
+
+    def manifest(self):
+        """Returns (scripts, etag) for /api/scripts."""
+        with self._lock:
+            return self._manifest, self._etag
@@ -0,0 +1,236 @@
+"""
+Append-only result log of a job, which doubles as its checkpoint.
+
+Scripts used to either rewrite the whole output workbook after every batch
+(O(n²) I/O on big jobs) or write nothing until the end, so a crash lost every
+result. A `ResultLog` appends one compact JSON line per finished row instead:
+
+    {"row": 17, "Status": "✅ Deleted", "Retries": 0}
+
+`row` is the 0-based data row of the input table, as numbered by `SheetReader`
+(and `read_table()`, which agrees with it), and the other keys are the output
+columns to set on it; a later line for the same row wins. The first line names
+the input file, the sheet read (and a digest of its content), so the output can be
+rebuilt from the input plus the log at any time (`materialize()`):
+`/api/download` does so while a job is still running, and the server does so
+(`recover()`) when a script ended without finishing its output. The script
+writes its output once at the end and then `close()`s the log, which deletes it.
+
+A log belongs to one client's run of a script on one input: it is named after
+the output, the job (`config["client_id"]`) and the input's digest, so jobs of
+different clients running the same script at the same time keep separate logs
+and never resume each other's rows.
+
+The logs live in CHECKPOINT_DIR, which is not cleaned on startup, so a job
+that was stopped, failed or lost to a restart leaves its log behind. Running
+the same script on the same input with `resume` continues that log: rows it
+marks successful (`succeeded()`) are not sent again and keep their earlier
+result. This matters most for scripts that POST, where a re-run would create
+duplicates.
+
+Tunables (environment variables):
+    CHECKPOINT_DIR  - directory of the result logs / checkpoints (default "checkpoints")
+"""
+
+import glob
+import hashlib
+import json
+import os
+import re
+
+from app.core.fingerprint import UNCHANGED
+import pandas as pd
+
+from app.core.tables import SheetReader, write_table
+
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "checkpoints") or "checkpoints"
+SUFFIX = ".results.jsonl"
+
+# Statuses of rows that need not be sent again on resume
+DONE_PREFIXES = ("Success", "✅", UNCHANGED, "Skipped: Already Present")
+
+
+def _stem(output_path):
+    # Foo_Output.xlsx and Foo_Output.csv share their logs
+    return os.path.splitext(os.path.basename(output_path))[0]
+
+
+def _job_key(job):
+    return re.sub(r"[^A-Za-z0-9_-]", "_", str(job or "local"))[:64]
+
+
+def log_path(output_path, job, digest):
+    """The log of `job`'s run of the output's script on an input with content `digest`."""
+    return os.path.join(CHECKPOINT_DIR, f"{_stem(output_path)}.{_job_key(job)}.{digest}{SUFFIX}")
+
+
+def find_log(output_path, job=None):
+    """The most recently written log of the output (of `job`'s runs, if given), or None."""
+    pattern = f"{glob.escape(_stem(output_path))}.{_job_key(job) if job else '*'}.*{SUFFIX}"
+    paths = glob.glob(os.path.join(glob.escape(CHECKPOINT_DIR), pattern))
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def succeeded(columns):
+    """Whether logged result columns mark the row as done (any "Status"/"status" column)."""
+    for name, value in columns.items():
+        if name.lower() == "status" and isinstance(value, str):
+            return value.startswith(DONE_PREFIXES)
+    return False
+
+
+def _plain(value):
+    if value is None:
+        return None
+    if isinstance(value, float) and value != value:
+        return None
+    if hasattr(value, "item"):  # numpy scalars
+        return value.item()
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+class ResultLog:
+    """
+    Args:
+        output_path (str): The job's output file; names the log (see `log_path`).
+        input_path (str): The input table the row numbers refer to.
+        job (str): The client running the job (config["client_id"]).
+        resume (bool): Continue the log of an earlier run on the same input (config["resume"])
+            instead of starting a new one. Its results are in `previous`.
+        sheet (str): The sheet the rows were read from (`SheetReader.name`); None for the first sheet.
+    """
+
+    def __init__(self, output_path, input_path, resume=False, sheet=None, job=None):
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        digest = file_digest(input_path)
+        self.path = log_path(output_path, job, digest)
+        self.previous = {}
+        if resume:
+            self.previous = checkpoint(output_path, input_path, job, digest) or {}
+        self._file = open(self.path, "a" if self.previous else "w", encoding="utf-8")
+        self._write({"input": input_path, "sheet": sheet, "digest": digest})
+
+    def succeeded(self, row):
+        """Whether the row already succeeded in the run being resumed."""
+        return row in self.previous and succeeded(self.previous[row])
+
+    def done(self):
+        """Number of rows that will be skipped because they already succeeded."""
+        return sum(1 for columns in self.previous.values() if succeeded(columns))
+
+    def restore(self, frame):
+        """
+        Copies the earlier results of the rows of `frame` (index = input row) that
+        already succeeded into it. Returns those rows, which are not to be sent again.
+        """
+        rows = {row for row in frame.index if self.succeeded(row)}
+        for row in rows:
+            for name, value in self.previous[row].items():
+                if name not in frame.columns:
+                    frame[name] = None
+                elif frame[name].dtype != object:
+                    frame[name] = frame[name].astype(object)
+                frame.at[row, name] = value
+        return rows
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def record(self, row, **columns):
+        """Appends the result columns of one input row."""
+        entry = {"row": int(row)}
+        entry.update((name, _plain(value)) for name, value in columns.items())
+        self._write(entry)
+
+    def record_frame(self, frame, columns):
+        """Appends `columns` of every row of a finished batch (index = input row)."""
+        columns = [name for name in columns if name in frame.columns]
+        for row, values in zip(frame.index, frame[columns].itertuples(index=False, name=None)):
+            self.record(row, **dict(zip(columns, values)))
+
+    def close(self, keep=False):
+        """Closes the log; deletes it unless `keep` (call once the output file is written)."""
+        self._file.close()
+        if not keep:
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # A failed run keeps its log so the results so far can still be recovered
+        self.close(keep=exc_type is not None)
+
+
+def read_log(path):
+    """(header, {row: {column: value}}) from a result log; the header is its last {"input", "sheet", "digest"} line."""
+    results = {}
+    header = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break  # a line cut off by a crash ends the log
+            if "row" not in entry:
+                header = entry
+                continue
+            results.setdefault(entry.pop("row"), {}).update(entry)
+    return header, results
+
+
+def checkpoint(output_path, input_path, job=None, digest=None):
+    """
+    The logged results ({row: columns}) of `job`'s earlier run of this output on
+    the same input content, or None when there is none.
+    """
+    path = log_path(output_path, job, digest or file_digest(input_path))
+    if not os.path.exists(path):
+        return None
+    return read_log(path)[1]
+
+
+def materialize(path, target_path):
+    """
+    Writes the input table of the log at `path` with every logged result applied
+    to `target_path`. Returns the number of rows with a result.
+    """
+    header, results = read_log(path)
+    # Read the way the job read it, so the logged row numbers land on the same rows
+    with SheetReader(header["input"], header.get("sheet")) as sheet:
+        frames = list(sheet.batches())
+    df = pd.concat(frames) if frames else pd.DataFrame(columns=sheet.columns)
+    for name in {name for columns in results.values() for name in columns}:
+        df[name] = df[name].astype(object) if name in df.columns else None
+    for row, columns in results.items():
+        if row in df.index:
+            for name, value in columns.items():
+                df.at[row, name] = value
+    write_table(df, target_path)
+    return len(results)
+
+
+def recover(output_path, input_path, job=None):
+    """
+    After a job: a log that is still there means the script did not get to write
+    its output (or only part of it), so the output is rebuilt from the log. The
+    log stays as the checkpoint to resume from. Returns the number of recovered
+    rows, or None if there was nothing to recover.
+    """
+    if not input_path or not os.path.exists(input_path):
+        return None
+    path = log_path(output_path, job, file_digest(input_path))
+    if not os.path.exists(path):
+        return None
+    return materialize(path, output_path)
@@ -0,0 +1,78 @@
+"""
+Retry policy for script API calls.
+
+`HttpClient` resends requests that failed transiently (429, 5xx, connection
+errors, timeouts) with exponential backoff and full jitter, waiting at least as
+long as a `Retry-After` header asks for. Only idempotent requests are retried:
+GET, HEAD, OPTIONS, PUT and DELETE, and POSTs/PATCHes that carry an
+`Idempotency-Key` header or are sent with `idempotent=True`. Other requests are
+only resent when the connection could not be opened at all, because then the
+server never saw them.
+
+Each job gets a retry budget so an API outage cannot turn a large sheet into
+hours of backoff: once the budget is spent, failures are returned to the script
+as they are.
+
+Tunables (environment variables):
+    RETRY_MAX_ATTEMPTS  - attempts per request, including the first (default 3)
+    RETRY_BASE_DELAY    - backoff before the first retry in seconds, doubled per retry (default 0.5)
+    RETRY_MAX_DELAY     - upper bound for one backoff in seconds (default 30)
+    RETRY_BUDGET        - retries a single job may spend in total (default 200)
+"""
+
+import os
+import random
+import threading
+
+MAX_ATTEMPTS = max(1, int(os.getenv("RETRY_MAX_ATTEMPTS", "3") or 3))
+BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5") or 0.5)
+MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30") or 30)
+BUDGET = max(0, int(os.getenv("RETRY_BUDGET", "200") or 200))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+
+class RetryBudget:
+    """Retries left for one job; shared by all threads of the job."""
+
+    def __init__(self, limit=BUDGET):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.used >= self.limit:
+                return False
+            self.used += 1
+            return True
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_idempotent(self, method, headers=None, idempotent=None):
+        if idempotent is not None:
+            return idempotent
+        if method.upper() in IDEMPOTENT_METHODS:
+            return True
+        return any(name.lower() == IDEMPOTENCY_HEADER.lower() for name in (headers or {}))
+
+    def should_retry_status(self, status_code):
+        return status_code in RETRY_STATUSES
+
+    def backoff(self, retry, retry_after=None):
+        """Seconds to wait before retry number `retry` (1-based)."""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        delay = random.uniform(0, ceiling)  # full jitter
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+NO_RETRY = RetryPolicy(max_attempts=1)
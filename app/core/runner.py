@@ -0,0 +1,366 @@
+"""
+Subprocess execution mode for scripts.
+
+With JOB_EXECUTION_MODE=process every job's `module.run` executes in its own
+child process instead of a thread of the server process. Log lines are streamed
+back over a pipe, CPU time and resident memory are capped, and /api/stop is
+enforced by killing the child if it has not stopped on its own within
+STOP_GRACE_SECONDS. A runaway script (stuck socket, leaked worker threads,
+memory blow-up) therefore cannot degrade the uvicorn worker.
+
+Children are taken from a pool of pre-started workers that already have pandas,
+openpyxl, requests and every app/scripts module imported, so a job starts by
+handing its arguments to a warm interpreter. On POSIX the workers are forked
+from a forkserver that preloads the heavy libraries once; elsewhere they are
+spawned and warm themselves up while idle. Each worker runs exactly one job and
+is replaced in the background. The delay between job start and the script's
+first HTTP request is published as the `time_to_first_request_seconds` metric.
+
+Tunables (environment variables):
+    JOB_EXECUTION_MODE    - "thread" (default) or "process"
+    JOB_CPU_LIMIT_SECONDS - CPU seconds per job, 0 = unlimited (POSIX only)
+    JOB_MEMORY_LIMIT_MB   - resident memory per job, 0 = unlimited (Linux only)
+    STOP_GRACE_SECONDS    - time a stopped job gets to exit before it is killed (default 5)
+    WARM_POOL_SIZE        - idle pre-warmed workers kept ready, 0 disables the pool (default 2)
+"""
+
+import importlib
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from app.core.metrics import metrics
+from app.core.registry import ScriptRegistry
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+EXECUTION_MODE = os.getenv("JOB_EXECUTION_MODE", "thread").strip().lower()
+CPU_LIMIT_SECONDS = int(os.getenv("JOB_CPU_LIMIT_SECONDS", "0") or 0)
+MEMORY_LIMIT_MB = int(os.getenv("JOB_MEMORY_LIMIT_MB", "0") or 0)
+STOP_GRACE_SECONDS = float(os.getenv("STOP_GRACE_SECONDS", "5") or 5)
+WARM_POOL_SIZE = int(os.getenv("WARM_POOL_SIZE", "2") or 0)
+
+POLL_INTERVAL = 0.2  # seconds between supervisor checks
+KILL_WAIT = 2  # seconds between SIGTERM and SIGKILL
+
+STOPPED_MESSAGE = "Job Stopped by User"
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+PRELOAD_MODULES = ["pandas", "openpyxl", "requests", "app.core.http", "app.core.runner"]
+WARM_UP_CONNECTIONS = 4  # connections opened per API host when a job starts
+
+
+def use_subprocess():
+    return EXECUTION_MODE == "process"
+
+
+# ============================================================
+# CHILD SIDE
+# ============================================================
+# Scripts loaded while the worker is idle; reloaded only if their mtime changed
+_registry = ScriptRegistry(SCRIPTS_DIR)
+
+
+def _apply_limits(cpu_seconds):
+    if resource is None or not cpu_seconds:
+        return
+    # Count only the job itself, not the warm-up the worker did before it
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime) + cpu_seconds
+    # Soft limit sends SIGXCPU, hard limit one second later sends SIGKILL
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, soft + 1))
+
+
+def _warm_up():
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"Warm-up import of {name} failed: {e}")
+    _registry.refresh()
+
+
+def _report_first_request(send):
+    """Sends a one-off 'first_request' message right before the first HTTP call of the job."""
+    import requests
+
+    original_send = requests.Session.send
+    reported = threading.Event()
+
+    def send_and_report(session, request, **kwargs):
+        if not reported.is_set():
+            reported.set()
+            send("first_request", None)
+        return original_send(session, request, **kwargs)
+
+    requests.Session.send = send_and_report
+
+
+def _worker_main(conn, cancel_event, warm):
+    if warm:
+        _warm_up()
+        conn.send(("ready", None))
+
+    send_lock = threading.Lock()  # scripts log from several threads
+
+    def send(kind, payload):
+        with send_lock:
+            conn.send((kind, payload))
+
+    def log_callback(message):
+        # Soft stop, same behaviour as thread mode; the parent kills us if this is never reached
+        if cancel_event.is_set():
+            raise Exception(STOPPED_MESSAGE)
+        send("log", str(message))
+
+    try:
+        job = conn.recv()
+        _apply_limits(job["cpu_seconds"])
+        _report_first_request(send)
+
+        # Connect to the job's API hosts while the script reads its input
+        from app.core import http
+        threading.Thread(
+            target=http.warm_up,
+            args=(http.config_urls(job["config"]), WARM_UP_CONNECTIONS),
+            daemon=True
+        ).start()
+
+        entry = _registry.get(os.path.basename(job["script_path"]))
+        if entry is None or entry.load_error:
+            send("error", entry.load_error if entry else "Script not found")
+            return
+        if entry.run is None:
+            send("error", "Script does not have a 'run' function")
+            return
+
+        args = (job["input_path"], job["output_path"], job["config"])
+        if entry.accepts_log_callback:
+            entry.run(*args, log_callback=log_callback)
+        else:
+            entry.run(*args)
+        send("done", None)
+    except EOFError:
+        # Pool shut down before a job arrived
+        pass
+    except BaseException as e:
+        traceback.print_exc()
+        try:
+            send("error", str(e) or e.__class__.__name__)
+        except Exception:
+            pass
+    finally:
+        conn.close()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Do not wait on leaked non-daemon threads (e.g. ThreadPoolExecutor workers)
+        os._exit(0)
+
+
+# ============================================================
+# WARM POOL
+# ============================================================
+class _Worker:
+    def __init__(self, ctx, warm):
+        self.conn, child_conn = ctx.Pipe(duplex=True)
+        self.cancel_event = ctx.Event()
+        self.ready = False
+        self.proc = ctx.Process(target=_worker_main, args=(child_conn, self.cancel_event, warm), daemon=True)
+        self.proc.start()
+        child_conn.close()
+
+    def is_ready(self):
+        if not self.ready and self.conn.poll():
+            try:
+                self.ready = self.conn.recv()[0] == "ready"
+            except EOFError:
+                return False
+        return self.ready
+
+
+class WarmPool:
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle = []
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            self.ctx = multiprocessing.get_context("forkserver")
+            self.ctx.set_forkserver_preload(PRELOAD_MODULES)
+        else:
+            self.ctx = multiprocessing.get_context("spawn")
+
+    def start(self):
+        with self._lock:
+            self._fill()
+        print(f"Warm worker pool started: {self.size} workers ({self.ctx.get_start_method()}).")
+
+    def _fill(self):
+        self._idle = [w for w in self._idle if w.proc.is_alive()]
+        while len(self._idle) < self.size:
+            self._idle.append(_Worker(self.ctx, warm=True))
+
+    def acquire(self):
+        """Returns (worker, was_warm). Prefers workers that finished warming up."""
+        with self._lock:
+            self._idle = [w for w in self._idle if w.proc.is_alive()]
+            worker = next((w for w in self._idle if w.is_ready()), None)
+            if worker is None and self._idle:
+                worker = self._idle[0]
+            if worker is not None:
+                self._idle.remove(worker)
+                warm = worker.ready
+            else:
+                worker = _Worker(self.ctx, warm=False)
+                warm = False
+        # Replace it off the critical path of this job
+        threading.Thread(target=self._refill, daemon=True).start()
+        return worker, warm
+
+    def _refill(self):
+        with self._lock:
+            self._fill()
+
+    def shutdown(self):
+        with self._lock:
+            for worker in self._idle:
+                worker.proc.terminate()
+                worker.conn.close()
+            self._idle = []
+
+
+_pool = None
+
+
+def start_pool():
+    global _pool
+    if use_subprocess() and WARM_POOL_SIZE > 0 and _pool is None:
+        _pool = WarmPool(WARM_POOL_SIZE)
+        _pool.start()
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+# ============================================================
+# PARENT SIDE
+# ============================================================
+def _rss_mb(pid):
+    """Resident set size of a process in MB, or None where /proc is unavailable."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        return None
+    return None
+
+
+def _kill(proc):
+    if not proc.is_alive():
+        return
+    proc.terminate()
+    proc.join(KILL_WAIT)
+    if proc.is_alive():
+        proc.kill()
+        proc.join(KILL_WAIT)
+
+
+def _exit_reason(exitcode):
+    xcpu = getattr(signal, "SIGXCPU", None)
+    if xcpu is not None and exitcode == -xcpu:
+        return f"CPU time limit exceeded ({CPU_LIMIT_SECONDS}s)"
+    if exitcode == -getattr(signal, "SIGKILL", 9):
+        return "Process was killed"
+    return f"Script process exited unexpectedly (code {exitcode})"
+
+
+def run_in_subprocess(script_path, input_path, output_path, config, on_log, is_cancelled):
+    """
+    Runs `run(input_path, output_path, config, log_callback)` of the script in a child
+    process and blocks until it finishes. Meant to be called from a worker thread.
+
+    Args:
+        on_log (callable): receives every log line emitted by the script.
+        is_cancelled (callable): polled while the job runs; once True the child is
+            asked to stop and killed after STOP_GRACE_SECONDS.
+
+    Raises:
+        Exception: with the script's error message, the stop message, or the limit
+            that was exceeded.
+    """
+    started = time.monotonic()
+    if _pool is not None:
+        worker, warm = _pool.acquire()
+    else:
+        worker, warm = _Worker(multiprocessing.get_context("spawn"), warm=False), False
+    proc, conn = worker.proc, worker.conn
+
+    conn.send({
+        "script_path": script_path,
+        "input_path": input_path,
+        "output_path": output_path,
+        "config": config,
+        "cpu_seconds": CPU_LIMIT_SECONDS,
+    })
+    metrics.incr("jobs_started_warm" if warm else "jobs_started_cold")
+
+    finished = False
+    error = None
+    stop_deadline = None
+    next_rss_check = 0.0
+
+    try:
+        while True:
+            if conn.poll(POLL_INTERVAL):
+                try:
+                    kind, payload = conn.recv()
+                except EOFError:
+                    break
+                if kind == "log":
+                    on_log(payload)
+                elif kind == "first_request":
+                    elapsed = time.monotonic() - started
+                    metrics.observe("time_to_first_request_seconds", elapsed)
+                    on_log(f"⏱️ First API request sent {elapsed:.2f}s after job start ({'warm' if warm else 'cold'} worker)")
+                elif kind == "done":
+                    finished = True
+                elif kind == "error":
+                    error = payload
+            elif not proc.is_alive():
+                break
+
+            now = time.monotonic()
+            if stop_deadline is None and is_cancelled():
+                worker.cancel_event.set()
+                stop_deadline = now + STOP_GRACE_SECONDS
+            if stop_deadline is not None and now > stop_deadline:
+                _kill(proc)
+                raise Exception(STOPPED_MESSAGE)
+
+            if MEMORY_LIMIT_MB and now >= next_rss_check:
+                next_rss_check = now + POLL_INTERVAL
+                rss = _rss_mb(proc.pid)
+                if rss is not None and rss > MEMORY_LIMIT_MB:
+                    _kill(proc)
+                    raise Exception(f"Memory limit exceeded ({rss:.0f} MB > {MEMORY_LIMIT_MB} MB)")
+    finally:
+        proc.join(KILL_WAIT)
+        _kill(proc)
+        conn.close()
+
+    if error is not None:
+        raise Exception(error)
+    if not finished:
+        raise Exception(_exit_reason(proc.exitcode))
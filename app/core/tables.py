@@ -0,0 +1,299 @@
+"""
+Reading and writing the tables scripts work on: .xlsx, .csv and .parquet.
+
+The format of a file is taken from its extension (`table_format()`), so scripts
+call `read_table()` / `write_table()` or the streaming classes below and work
+the same whatever the user uploaded. XLSX parsing and `df.to_excel` are the
+slowest part of large jobs; CSV and Parquet skip both. Parquet needs pyarrow.
+
+`pd.read_excel` parses the whole workbook before the first row can be used and
+holds it in memory together with the job's output frame; a 300k-row CA sheet
+takes several hundred MB and tens of seconds before the first request is sent.
+`SheetReader` opens the workbook in openpyxl's read-only mode and yields the
+rows as DataFrames of `batch_size` rows, so a script can start calling the API
+after the first batch and memory stays proportional to the batch:
+
+    with SheetReader(input_excel_file) as sheet:
+        for batch in sheet.batches():
+            ...
+
+Batches look like slices of `pd.read_excel`'s frame: the same column names
+(blank headers become "Unnamed: N", duplicates "name.1"), empty cells as NaN,
+blank rows inside the sheet kept as all-NaN rows (trailing ones dropped) and an
+index that counts data rows across batches, so row N of a batch is row N of
+`read_table()`.
+
+CSV files are read with `pd.read_csv(chunksize=...)` and Parquet files one
+record batch at a time, with the same guarantees.
+
+`SheetWriter` is the output side. It writes rows as soon as they are finished
+(openpyxl's write-only mode for .xlsx); `put()` accepts rows out of order (as
+the async engine finishes them) and writes them in input order. Parquet cannot
+be appended row by row, so .parquet output is written when the writer closes.
+
+Tunables (environment variables):
+    TABLE_BATCH_SIZE  - rows per batch yielded by SheetReader.batches() (default 1000)
+"""
+
+import csv
+import math
+import os
+
+import openpyxl
+import pandas as pd
+
+BATCH_SIZE = max(1, int(os.getenv("TABLE_BATCH_SIZE", "1000") or 1000))
+
+XLSX = "xlsx"
+CSV = "csv"
+PARQUET = "parquet"
+
+MEDIA_TYPES = {
+    XLSX: "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    CSV: "text/csv",
+    PARQUET: "application/vnd.apache.parquet",
+}
+
+
+def table_format(path):
+    """"csv", "parquet" or "xlsx" (anything else is treated as a workbook)."""
+    extension = os.path.splitext(str(path))[1].lower().lstrip(".")
+    if extension == CSV:
+        return CSV
+    if extension in (PARQUET, "pq"):
+        return PARQUET
+    return XLSX
+
+
+def media_type(path):
+    return MEDIA_TYPES[table_format(path)]
+
+
+def output_format(requested, input_path=None):
+    """
+    The format a job writes: `requested` (config["output_format"]) if set,
+    else the format of the input file, else xlsx. Raises ValueError for unknown formats.
+    """
+    if requested:
+        requested = str(requested).lower().lstrip(".")
+        if requested not in MEDIA_TYPES:
+            raise ValueError(f"Unsupported output format '{requested}' (use one of {', '.join(MEDIA_TYPES)})")
+        return requested
+    return table_format(input_path) if input_path else XLSX
+
+
+def read_table(path):
+    """The whole table as one DataFrame, like pd.read_excel (first sheet) for any supported format."""
+    kind = table_format(path)
+    if kind == CSV:
+        return pd.read_csv(path)
+    if kind == PARQUET:
+        return pd.read_parquet(path)
+    return pd.read_excel(path)
+
+
+def write_table(df, path):
+    """Writes `df` without its index in the format given by the extension of `path`."""
+    kind = table_format(path)
+    if kind == CSV:
+        df.to_csv(path, index=False)
+    elif kind == PARQUET:
+        df.to_parquet(path, index=False)
+    else:
+        df.to_excel(path, index=False)
+
+
+def _header(cells):
+    columns = []
+    seen = {}
+    for i, name in enumerate(cells):
+        if name is None or (isinstance(name, str) and not name.strip()):
+            name = f"Unnamed: {i}"
+        base = name
+        while name in seen:
+            seen[base] += 1
+            name = f"{base}.{seen[base]}"
+        seen[name] = 0
+        columns.append(name)
+    return columns
+
+
+class SheetReader:
+    """
+    Reads one sheet of an .xlsx file (or a .csv / .parquet file) in batches.
+
+    Args:
+        path (str): The input file.
+        sheet_name (str): Sheet to read; the first sheet when None. Ignored for CSV and Parquet.
+        fallback_to_first (bool): Read the first sheet when `sheet_name` does not exist
+            instead of raising KeyError. `name` tells which sheet was opened (None for CSV and Parquet).
+    """
+
+    def __init__(self, path, sheet_name=None, fallback_to_first=False):
+        self.path = path
+        self.format = table_format(path)
+        self.rows_read = 0
+        self.workbook = None
+        self.name = None
+        if self.format == CSV:
+            self.columns = list(pd.read_csv(path, nrows=0).columns)
+            self.size_hint = None
+        elif self.format == PARQUET:
+            import pyarrow.parquet as pq
+
+            self._parquet = pq.ParquetFile(path)
+            self.columns = list(self._parquet.schema_arrow.names)
+            self.size_hint = self._parquet.metadata.num_rows
+        else:
+            self._open_workbook(path, sheet_name, fallback_to_first)
+
+    def _open_workbook(self, path, sheet_name, fallback_to_first):
+        self.workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            if sheet_name is None or (fallback_to_first and sheet_name not in self.workbook.sheetnames):
+                sheet = self.workbook.worksheets[0]
+            else:
+                sheet = self.workbook[sheet_name]
+            self.name = sheet.title
+            self._rows = sheet.iter_rows(values_only=True)
+            self.columns = _header(next(self._rows, ()))
+            # From the sheet's dimension record, which some writers leave out.
+            self.size_hint = sheet.max_row - 1 if sheet.max_row else None
+        except Exception:
+            self.workbook.close()
+            raise
+
+    def batches(self, batch_size=BATCH_SIZE):
+        if self.format == CSV:
+            for chunk in pd.read_csv(self.path, chunksize=batch_size):
+                self.rows_read += len(chunk)
+                yield chunk
+            return
+        if self.format == PARQUET:
+            for record_batch in self._parquet.iter_batches(batch_size=batch_size):
+                frame = record_batch.to_pandas()
+                frame.index = pd.RangeIndex(self.rows_read, self.rows_read + len(frame))
+                self.rows_read += len(frame)
+                yield frame
+            return
+
+        width = len(self.columns)
+        batch = []
+        blank = 0  # blank rows seen since the last row with a value
+        for values in self._rows:
+            if all(value is None for value in values):
+                blank += 1
+                continue
+            # Blank rows inside the sheet are kept as NaN rows, like pd.read_excel does;
+            # only the trailing ones are dropped
+            rows = [[math.nan] * width] * blank
+            blank = 0
+            if len(values) > width:
+                values = values[:width]
+            row = [math.nan if value is None else value for value in values]
+            row.extend([math.nan] * (width - len(row)))
+            rows.append(row)
+            for row in rows:
+                batch.append(row)
+                if len(batch) == batch_size:
+                    yield self._frame(batch)
+                    batch = []
+        if batch:
+            yield self._frame(batch)
+        self.close()
+
+    def _frame(self, rows):
+        start = self.rows_read
+        self.rows_read += len(rows)
+        return pd.DataFrame(rows, columns=self.columns, index=pd.RangeIndex(start, self.rows_read))
+
+    def close(self):
+        if self.workbook is not None:
+            self.workbook.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_batches(path, batch_size=BATCH_SIZE, sheet_name=None):
+    """Yields the rows of a sheet as DataFrames of up to `batch_size` rows."""
+    with SheetReader(path, sheet_name) as sheet:
+        yield from sheet.batches(batch_size)
+
+
+def _cell(value):
+    if value is None or value is pd.NA or value is pd.NaT:
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, (list, dict, set, tuple)):
+        return str(value)
+    return value
+
+
+class SheetWriter:
+    """
+    Writes an .xlsx, .csv or .parquet file (by the extension of `path`) row by row.
+
+    Use `write(frame)` for batches that are finished in order, or `put(position, values)`
+    for rows finished in any order; a row is held back until every earlier position
+    has been put. `close()` saves the file.
+    """
+
+    def __init__(self, path, columns, sheet_name="Sheet1"):
+        self.path = path
+        self.format = table_format(path)
+        self.columns = list(columns)
+        self.written = 0
+        self._pending = {}
+        if self.format == CSV:
+            self._file = open(path, "w", newline="", encoding="utf-8")
+            self._csv = csv.writer(self._file)
+            self._csv.writerow(self.columns)
+        elif self.format == PARQUET:
+            self._rows = []
+        else:
+            self.workbook = openpyxl.Workbook(write_only=True)
+            self.sheet = self.workbook.create_sheet(sheet_name)
+            self.sheet.append([_cell(name) for name in self.columns])
+
+    def _append(self, values):
+        if self.format == CSV:
+            self._csv.writerow([_cell(value) for value in values])
+        elif self.format == PARQUET:
+            self._rows.append(list(values))
+        else:
+            self.sheet.append([_cell(value) for value in values])
+        self.written += 1
+
+    def write(self, frame):
+        """Appends a batch; columns missing from `frame` are left empty."""
+        frame = frame.reindex(columns=self.columns)
+        for values in frame.itertuples(index=False, name=None):
+            self._append(values)
+
+    def put(self, position, values):
+        """Writes the row at `position` (0-based, counting rows of this writer) once all earlier rows are in."""
+        self._pending[position] = values
+        while self.written in self._pending:
+            self._append(self._pending.pop(self.written))
+
+    def close(self):
+        if self._pending:
+            raise ValueError(f"{len(self._pending)} rows were put without the rows before them")
+        if self.format == CSV:
+            self._file.close()
+        elif self.format == PARQUET:
+            pd.DataFrame(self._rows, columns=self.columns).to_parquet(self.path, index=False)
+        else:
+            self.workbook.save(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
@@ -1,20 +1,27 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, WebSocket, WebSocketDisconnect, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, WebSocket, WebSocketDisconnect, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse, Response
 import shutil
 import os
-import importlib.util
+import uuid
 from typing import List, Dict
 import json
-from app.core.auth import get_access_token
+from app.core.auth import get_access_token_async, token_cache, TokenProvider
+from app.core.jobs import scheduler, QueueFullError, DuplicateJobError
+from app.core import http, ratelimit, results, runner, tables
+from app.core.metrics import metrics
+from app.core.registry import ScriptRegistry
+from app.core import logstore
+from app.core.logstore import LogStore
 from openpyxl import load_workbook
 from openpyxl.worksheet.datavalidation import DataValidation
 import pandas as pd
 import asyncio
-import ast
+import threading
 
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 
 # ... existing imports ...
 
@@ -28,9 +35,170 @@ OUTPUT_DIR = "outputs"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Script UI configs (URL + Label + Input Requirement), keyed by script file name
+default_configs = {
+    "AddTagsWithNewAPI.py": {
+        "url": "https://cloud.cropin.in/services/master/api/tags",
+        "label": "Post Api Url",
+        "requires_input": True
+    },
+    "Update_Farmer_Details.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/farmers",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "Update_Asset_Details.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/assets",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "PR_Enablement.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/croppable-areas",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "PR_and_Weather_Enablement.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/croppable-areas",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "RefreshPlans.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/croppable-areas",
+        "label": "Base Api Url (Fixed in Script)",
+        "requires_input": True
+    },
+    "Update_Asset_Additional_Attribute.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/assets",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "Update_Farmer_Additional_Attribute.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/farmers",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "Add_Users.py": {
+        "url": "https://cloud.cropin.in/services/user/api/users/images",
+        "label": "User API Url",
+        "requires_input": True
+    },
+    "Area_Audit_Removal.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/croppable-areas",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "Update_Farmer_Tags.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/farmers",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "Update_Asset_Tags.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/assets",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "Update_Farmer_Address.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/farmers",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "Update_Asset_Address.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/assets",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "PR_Enablement_Bulk.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/croppable-areas/plot-risk/batch",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "Edit_Plans_in_Variety_with_or_without_recurring.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/plans",
+        "label": "Plan API URL",
+        "requires_input": True
+    },
+    "Area_Audit_To_CA.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/croppable-areas",
+        "label": "Croppable Area API URL",
+        "requires_input": True
+    },
+    "Add_Cropstages_to_Variety.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/varieties",
+        "label": "Variety API URL",
+        "url2": "https://cloud.cropin.in/services/farm/api/crop-stages",
+        "label2": "Crop Stage API URL",
+        "requires_input": True
+    },
+    "Add_Seed_Grades_to_Variety.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/varieties",
+        "label": "Variety API URL",
+        "url2": "https://cloud.cropin.in/services/farm/api/seed-grades",
+        "label2": "Seed Grade API URL",
+        "requires_input": True
+    },
+    "Add_Varieties_or_Sub_Varieties.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/varieties",
+        "label": "Variety API URL",
+        "requires_input": True
+    },
+    "Split_CAs.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/projects",
+        "label": "Base API URL",
+        "requires_input": True
+    },
+    "Enable_Cropin_Connect.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/acresquare/farmers-enable",
+        "label": "Enablement API URL",
+        "requires_input": True
+    },
+    "Delete_Users.py": {
+        "url": "https://cloud.cropin.in/services/user/api/users/bulk",
+        "label": "Delete API URL",
+        "requires_input": True
+    },
+    "Enable_Or_Disable_User.py": {
+        "url": "https://cloud.cropin.in/services/user/api/users",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "Bulk_Delete_Farmers.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/farmers/bulk",
+        "label": "Base Api Url",
+        "requires_input": True
+    },
+    "Bulk_Delete_Assets.py": {
+        "url": "https://cloud.cropin.in/services/farm/api/assets/bulk",
+        "label": "Base Api Url",
+        "requires_input": True
+    }
+}
+
+registry = ScriptRegistry(SCRIPTS_DIR, default_configs)
+
+LOG_EVICT_INTERVAL = 60  # seconds between idle-client log sweeps
+TOKEN_REFRESH_INTERVAL = 30  # seconds between checks for expiring job tokens
+WARM_UP_CONNECTIONS = 4  # connections opened per API host before a job starts (most threaded scripts use 4 workers)
+
+async def refresh_tokens():
+    # Renew the tokens of running jobs before they expire
+    while True:
+        await asyncio.sleep(TOKEN_REFRESH_INTERVAL)
+        try:
+            await asyncio.to_thread(token_cache.refresh_due)
+        except Exception as e:
+            print(f"Token refresh error: {e}")
+
+async def evict_idle_logs():
+    # Drop the logs of clients that went away without clearing their session
+    while True:
+        await asyncio.sleep(LOG_EVICT_INTERVAL)
+        dropped = manager.evict_idle()
+        if dropped:
+            print(f"Evicted logs of {dropped} idle clients.")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: Clean up temporary directories
+    # Startup: Clean up temporary directories (results.CHECKPOINT_DIR is kept so interrupted jobs can be resumed)
     print("Execute Clean up temporary directories...")
     dirs_to_clean = [UPLOAD_DIR, OUTPUT_DIR]
     for d in dirs_to_clean:
@@ -44,7 +212,23 @@ async def lifespan(app: FastAPI):
                         shutil.rmtree(file_path)
                 except Exception as e:
                     print(f"Failed to delete {file_path}. Reason: {e}")
+
+    # Spilled logs of the previous run are not resumable anymore
+    manager.store.reset_spill_dir()
+
+    # Load every script once; later refreshes only reload modified files
+    registry.refresh()
+
+    # Start the job dispatcher (and pre-warmed workers in process mode)
+    scheduler.start()
+    runner.start_pool()
+    evictor = asyncio.create_task(evict_idle_logs())
+    refresher = asyncio.create_task(refresh_tokens())
     yield
+    evictor.cancel()
+    refresher.cancel()
+    await scheduler.shutdown()
+    runner.shutdown_pool()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -65,14 +249,19 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # SSE Connection Manager
 class ConnectionManager:
     def __init__(self):
-        # Map client_id -> asyncio.Queue (for live streaming)
-        self.active_connections: Dict[str, asyncio.Queue] = {}
-        # Map client_id -> List[str] (for history/replay)
-        self.client_logs: Dict[str, List[str]] = {}
+        # Map client_id -> asyncio.Event of the current SSE stream (set when new lines arrive)
+        self.active_connections: Dict[str, asyncio.Event] = {}
+        # Bounded, disk-spilling history used for live streaming and replay
+        self.store = LogStore()
         # Set of client_ids with active running tasks
         self.active_tasks: set = set()
         # Set of client_ids that requested cancellation
         self.cancellation_requests: set = set()
+        # Wake-ups requested by worker threads: client_id -> lines published since the last one
+        self.pending_lines: Dict[str, int] = {}
+        self.wake_scheduled: set = set()
+        self.wake_lock = threading.Lock()
+        self.loop = None
 
     def mark_active(self, client_id: str):
         self.active_tasks.add(client_id)
@@ -96,58 +285,123 @@ class ConnectionManager:
         return client_id in self.active_tasks
 
     def clear_logs(self, client_id: str):
-        self.client_logs[client_id] = []
-
-    async def connect(self, client_id: str):
-        self.active_connections[client_id] = asyncio.Queue()
+        self.store.clear(client_id)
+
+    def evict_idle(self) -> int:
+        # Never drop the history of a client that is still running or watching
+        keep = self.active_tasks | set(self.active_connections) | set(scheduler.running)
+        return self.store.evict_idle(keep)
+
+    def connect(self, client_id: str) -> asyncio.Event:
+        # A new stream for the same client supersedes the previous one
+        self.loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        self.active_connections[client_id] = event
         print(f"Client {client_id} connected for SSE.")
-        
-        # Replay history immediately upon connection
-        if client_id in self.client_logs and self.client_logs[client_id]:
-            await self.active_connections[client_id].put("Connected to server (SSE) - Resuming session...")
-            for message in self.client_logs[client_id]:
-                await self.active_connections[client_id].put(message)
-        else:
-             self.client_logs[client_id] = []
-             await self.active_connections[client_id].put("Connected to server (SSE).")
+        return event
 
-    def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
+    def disconnect(self, client_id: str, event: asyncio.Event = None):
+        if client_id in self.active_connections and (event is None or self.active_connections[client_id] is event):
             del self.active_connections[client_id]
             print(f"Client {client_id} disconnected.")
 
     async def send_log(self, message: str, client_id: str):
-        # 1. Archive
-        if client_id not in self.client_logs:
-            self.client_logs[client_id] = []
-        self.client_logs[client_id].append(message)
-        
-        # 2. Stream if active
+        # 1. Archive (one stored line per text line, SSE frames are line based)
+        self.store.extend(client_id, str(message).splitlines() or [""])
+
+        # 2. Wake the stream if active
+        self.wake(client_id)
+
+    def publish(self, message: str, client_id: str):
+        """Thread-safe send_log for worker threads: stores the line and wakes the stream in batches."""
+        lines = str(message).splitlines() or [""]
+        self.store.extend(client_id, lines)
+        if client_id not in self.active_connections or self.loop is None:
+            return
+
+        with self.wake_lock:
+            pending = self.pending_lines.get(client_id, 0) + len(lines)
+            self.pending_lines[client_id] = pending
+            if pending >= logstore.FLUSH_LINES:
+                # Enough for a full frame, do not wait for the interval
+                self.pending_lines[client_id] = 0
+                callback = self.wake
+            elif client_id not in self.wake_scheduled:
+                self.wake_scheduled.add(client_id)
+                callback = self.wake_later
+            else:
+                return
+        try:
+            self.loop.call_soon_threadsafe(callback, client_id)
+        except RuntimeError:
+            # Loop already closed (server shutting down)
+            pass
+
+    def wake_later(self, client_id: str):
+        self.loop.call_later(logstore.FLUSH_INTERVAL, self.wake, client_id)
+
+    def wake(self, client_id: str):
+        with self.wake_lock:
+            self.wake_scheduled.discard(client_id)
+            self.pending_lines.pop(client_id, None)
         if client_id in self.active_connections:
-            await self.active_connections[client_id].put(message)
+            self.active_connections[client_id].set()
 
-    async def stream_logs(self, client_id: str):
+    async def stream_logs(self, client_id: str, event: asyncio.Event, last_event_id: int = 0):
         try:
-            queue = self.active_connections[client_id]
-            while True:
-                # Wait for message
-                message = await queue.get()
-                # Format as SSE event
-                yield f"data: {message}\n\n"
+            # Lines without an id do not move the browser's Last-Event-ID
+            if last_event_id:
+                yield "data: Connected to server (SSE) - Reconnected, sending missed logs...\n\n"
+            elif self.store.has_logs(client_id):
+                yield "data: Connected to server (SSE) - Resuming session...\n\n"
+            else:
+                yield "data: Connected to server (SSE).\n\n"
+
+            cursor = last_event_id
+            while self.active_connections.get(client_id) is event:
+                event.clear()
+
+                # Browser fell behind (or is replaying a long history): skip ahead but keep control lines
+                if self.store.lag(client_id, cursor) > logstore.MAX_LAG:
+                    cursor, skipped, control = self.store.skip_to(client_id, cursor, logstore.FRAME_LINES)
+                    lines = [f"... {skipped} log lines skipped, the browser could not keep up ..."]
+                    lines.extend(message for _, message in control)
+                    yield self.format_frame(cursor, lines)
+
+                batch = self.store.read_since(client_id, cursor, limit=logstore.FRAME_LINES)
+                if not batch:
+                    await event.wait()
+                    continue
+                cursor = batch[-1][0]
+                # One multi-line SSE event per batch; the browser splits it on newlines
+                yield self.format_frame(cursor, [message for _, message in batch])
         except asyncio.CancelledError:
-            self.disconnect(client_id)
             print(f"Stream cancelled for {client_id}")
+        finally:
+            self.disconnect(client_id, event)
+
+    @staticmethod
+    def format_frame(event_id: int, lines: List[str]) -> str:
+        data = "".join(f"data: {line}\n" for line in lines)
+        return f"id: {event_id}\n{data}\n"
 
 manager = ConnectionManager()
 
 @app.get("/api/logs/{client_id}")
-async def sse_endpoint(client_id: str):
-    await manager.connect(client_id)
-    return StreamingResponse(manager.stream_logs(client_id), media_type="text/event-stream")
+async def sse_endpoint(client_id: str, request: Request, last_event_id: int = 0):
+    # Browsers send Last-Event-ID when EventSource reconnects on its own
+    header = request.headers.get("last-event-id")
+    if header and header.isdigit():
+        last_event_id = int(header)
+    event = manager.connect(client_id)
+    return StreamingResponse(manager.stream_logs(client_id, event, last_event_id), media_type="text/event-stream")
 
 @app.get("/api/status/{client_id}")
 async def get_task_status(client_id: str):
-    return {"is_running": manager.is_active(client_id)}
+    # A queued job counts as running for the UI, it will start on its own
+    status = scheduler.status(client_id)
+    status["is_running"] = manager.is_active(client_id) or status["state"] == "queued"
+    return status
 
 @app.post("/api/clear_session/{client_id}")
 async def clear_session(client_id: str):
@@ -157,198 +411,31 @@ async def clear_session(client_id: str):
 
 @app.post("/api/stop/{client_id}")
 async def stop_execution(client_id: str):
+    if scheduler.cancel(client_id):
+        await manager.send_log("JOB_FAILED::Job cancelled before it started.", client_id)
+        return {"status": "stopped", "message": "Queued job removed."}
     if manager.is_active(client_id):
         manager.request_cancel(client_id)
         return {"status": "stopping", "message": "Stop requested. Process will terminate shortly."}
     return {"status": "ignored", "message": "No active process found."}
 
+@app.get("/api/metrics")
+async def get_metrics():
+    return dict(metrics.snapshot(), rate_limits=ratelimit.snapshot())
+
 @app.get("/")
 async def read_root():
     return FileResponse("static/index.html")
 
 @app.get("/api/scripts")
-async def list_scripts():
-    scripts = []
-    # Define default Configs (URL + Label + Input Requirement)
-    default_configs = {
-        "AddTagsWithNewAPI.py": {
-            "url": "https://cloud.cropin.in/services/master/api/tags",
-            "label": "Post Api Url",
-            "requires_input": True
-        },
-        "Update_Farmer_Details.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/farmers",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "Update_Asset_Details.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/assets",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "PR_Enablement.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/croppable-areas",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "PR_and_Weather_Enablement.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/croppable-areas",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "RefreshPlans.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/croppable-areas",
-            "label": "Base Api Url (Fixed in Script)",
-            "requires_input": True
-        },
-        "Update_Asset_Additional_Attribute.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/assets",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "Update_Farmer_Additional_Attribute.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/farmers",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "Add_Users.py": {
-            "url": "https://cloud.cropin.in/services/user/api/users/images",
-            "label": "User API Url",
-            "requires_input": True
-        },
-        "Area_Audit_Removal.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/croppable-areas",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "Update_Farmer_Tags.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/farmers",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "Update_Asset_Tags.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/assets",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "Update_Farmer_Address.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/farmers",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "Update_Asset_Address.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/assets",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "PR_Enablement_Bulk.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/croppable-areas/plot-risk/batch",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "Edit_Plans_in_Variety_with_or_without_recurring.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/plans",
-            "label": "Plan API URL",
-            "requires_input": True
-        },
-        "Area_Audit_To_CA.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/croppable-areas",
-            "label": "Croppable Area API URL",
-            "requires_input": True
-        },
-        "Add_Cropstages_to_Variety.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/varieties",
-            "label": "Variety API URL",
-            "url2": "https://cloud.cropin.in/services/farm/api/crop-stages",
-            "label2": "Crop Stage API URL",
-            "requires_input": True
-        },
-        "Add_Seed_Grades_to_Variety.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/varieties",
-            "label": "Variety API URL",
-            "url2": "https://cloud.cropin.in/services/farm/api/seed-grades",
-            "label2": "Seed Grade API URL",
-            "requires_input": True
-        },
-        "Add_Varieties_or_Sub_Varieties.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/varieties",
-            "label": "Variety API URL",
-            "requires_input": True
-        },
-        "Split_CAs.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/projects",
-            "label": "Base API URL",
-            "requires_input": True
-        },
-        "Enable_Cropin_Connect.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/acresquare/farmers-enable",
-            "label": "Enablement API URL",
-            "requires_input": True
-        },
-        "Delete_Users.py": {
-            "url": "https://cloud.cropin.in/services/user/api/users/bulk",
-            "label": "Delete API URL",
-            "requires_input": True
-        },
-        "Enable_Or_Disable_User.py": {
-            "url": "https://cloud.cropin.in/services/user/api/users",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "Bulk_Delete_Farmers.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/farmers/bulk",
-            "label": "Base Api Url",
-            "requires_input": True
-        },
-        "Bulk_Delete_Assets.py": {
-            "url": "https://cloud.cropin.in/services/farm/api/assets/bulk",
-            "label": "Base Api Url",
-            "requires_input": True
-        }
-    }
-    
-    for filename in os.listdir(SCRIPTS_DIR):
-        if filename.endswith(".py") and filename != "__init__.py":
-            # Extract docstring for details
-            filepath = os.path.join(SCRIPTS_DIR, filename)
-            description = "No description available."
-            input_description = "Standard Excel Input."
-            
-            try:
-                with open(filepath, "r", encoding="utf-8") as f:
-                    file_content = f.read()
-                    tree = ast.parse(file_content)
-                    docstring = ast.get_docstring(tree)
-                    
-                    if docstring:
-                        # Split by "Inputs:" to separate description and input details
-                        parts = docstring.split("Inputs:")
-                        description = parts[0].strip()
-                        if len(parts) > 1:
-                            input_description = parts[1].strip()
-            except Exception as e:
-                print(f"Error parsing docstring for {filename}: {e}")
-
-            config = default_configs.get(filename, {
-                "url": "https://cloud.cropin.in/services/master/api", 
-                "label": "Api Url",
-                "requires_input": True
-            })
-            scripts.append({
-                "name": filename, 
-                "url": config["url"],
-                "label": config["label"],
-                "url2": config.get("url2"),
-                "label2": config.get("label2"),
-                "requires_input": config.get("requires_input", True),
-                "description": description,
-                "input_description": input_description
-            })
-    
-    # Sort scripts alphabetically by name
-    scripts.sort(key=lambda x: x['name'])
-            
-    return {"scripts": scripts}
+async def list_scripts(request: Request):
+    # Only files whose mtime changed are reloaded
+    registry.refresh()
+    scripts, etag = registry.manifest()
+
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse({"scripts": scripts}, headers={"ETag": etag, "Cache-Control": "no-cache"})
 
 @app.get("/api/template/{script_name}")
 async def get_template(script_name: str):
@@ -373,12 +460,47 @@ async def upload_file(file: UploadFile = File(...)):
     return {"filename": file.filename, "server_path": input_filename}
 
 @app.get("/api/download/{filename}")
-async def download_result(filename: str):
+async def download_result(filename: str, client_id: str = None):
     file_path = os.path.join(OUTPUT_DIR, filename)
+    log_file = results.find_log(file_path, client_id)
+    if log_file and (not os.path.exists(file_path) or os.path.getmtime(log_file) > os.path.getmtime(file_path)):
+        # Job still running: build the output from its result log so far
+        snapshot_path = os.path.join(OUTPUT_DIR, f"snapshot_{uuid.uuid4().hex}_{filename}")
+        try:
+            await asyncio.to_thread(results.materialize, log_file, snapshot_path)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Could not build partial output: {e}")
+        return FileResponse(snapshot_path, filename=filename, media_type=tables.media_type(filename),
+                            background=BackgroundTask(os.remove, snapshot_path))
     if os.path.exists(file_path):
-        return FileResponse(file_path, filename=filename, media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        return FileResponse(file_path, filename=filename, media_type=tables.media_type(filename))
     raise HTTPException(status_code=404, detail="File not found")
 
+async def recover_output(output_path: str, input_path: str, client_id: str):
+    """Rebuilds the output of a script that stopped before writing it, from its result log."""
+    try:
+        recovered = await asyncio.to_thread(results.recover, output_path, input_path, client_id)
+    except Exception as e:
+        await manager.send_log(f"⚠️ Could not rebuild output from the result log: {e}", client_id)
+        return
+    if recovered is not None:
+        await manager.send_log(f"⚠️ Output rebuilt from the result log ({recovered} rows with results).", client_id)
+
+async def finish_job(input_path: str, output_path: str, output_filename: str, client_id: str):
+    await manager.send_log("Script execution finished.", client_id)
+    await recover_output(output_path, input_path, client_id)
+
+    if os.path.exists(output_path):
+        # Signal completion with filename
+        await manager.send_log(f"JOB_COMPLETED::{output_filename}", client_id)
+    else:
+         await manager.send_log("JOB_FAILED::Execution finished but no output file was generated.", client_id)
+
+def report_warm_up(future):
+    """Done callback of a connection warm-up: its failures are logged, not left unretrieved."""
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Connection warm-up failed: {future.exception()}")
+
 async def process_background_script(
     script_path: str,
     script_name: str,
@@ -388,6 +510,7 @@ async def process_background_script(
     config_dict: dict,
     client_id: str
 ):
+    token_provider = None
     try:
         manager.mark_active(client_id)
         
@@ -397,14 +520,26 @@ async def process_background_script(
         environment = config_dict.get("environment")
         tenant_code = config_dict.get("tenant_code")
         
+        # Open connections to the job's API hosts while the user is being authenticated
+        loop = asyncio.get_running_loop()
+        warm_up = None
+        if not runner.use_subprocess():
+            warm_up = loop.run_in_executor(None, http.warm_up, http.config_urls(config_dict), WARM_UP_CONNECTIONS)
+            warm_up.add_done_callback(report_warm_up)
+
         # Log Auth Start
         await manager.send_log(f"Authenticating user: {username}...", client_id)
 
         if username and password and tenant_code:
             try:
-                token = get_access_token(tenant_code, username, password, environment)
+                # Cached per tenant/user/environment; the login itself runs off the event loop
+                token = await get_access_token_async(tenant_code, username, password, environment)
                 if token:
                     config_dict["token"] = token
+                    # Scripts can call config["token_provider"]() for a token that is renewed mid-run
+                    token_provider = TokenProvider(tenant_code, username, password, environment)
+                    config_dict["token_provider"] = token_provider
+                    token_cache.hold(token_provider.key)
                     await manager.send_log("Authentication successful.", client_id)
                 else:
                     raise Exception("Authentication failed: No token returned.")
@@ -412,107 +547,153 @@ async def process_background_script(
                  await manager.send_log(f"JOB_FAILED::Authentication failed: {str(auth_err)}", client_id)
                  return
         
-        # Capture loop for threadsafe logging
         # Note: Since we are in async function, we can just use manager.send_log directly if we were running async.
         # But module.run is blocking, so we run it in a thread.
-        # The log_callback needs to schedule the coroutine on the loop.
-        
-        loop = asyncio.get_running_loop()
+        # The log_callback hands lines to manager.publish, which batches the wake-ups of the SSE stream.
+
+        def publish(message):
+            try:
+               manager.publish(message, client_id)
+            except Exception as e:
+               print(f"Log Error: {e}")
 
         # Define Log Callback
         def log_callback(message):
             # Check for cancellation
-            # print(f"DEBUG: Checking cancellation for {client_id}. Cancelled: {manager.is_cancelled(client_id)}. Msg: {message[:20]}") 
             if manager.is_cancelled(client_id):
-                print(f"DEBUG: Raising Stop Exception for {client_id}")
                 raise Exception("Job Stopped by User")
-
-            try:
-               asyncio.run_coroutine_threadsafe(manager.send_log(message, client_id), loop)
-            except Exception as e:
-               print(f"Log Error: {e}")
-
-        # Load script module dynamically
-        spec = importlib.util.spec_from_file_location("module.name", script_path)
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
-        
-        if hasattr(module, "run"):
+            publish(message)
+
+        if warm_up is not None:
+            # The job starts once its connections are open; a failed warm-up only costs that head start
+            await asyncio.wait([warm_up])
+
+        if runner.use_subprocess():
+            # Isolated child process: hard stop and resource limits are enforced by the runner
+            await manager.send_log(f"Starting execution of {script_name} (isolated process)...", client_id)
+            await loop.run_in_executor(
+                scheduler.executor,
+                runner.run_in_subprocess,
+                script_path,
+                input_path,
+                output_path,
+                config_dict,
+                publish,
+                lambda: manager.is_cancelled(client_id)
+            )
+            await finish_job(input_path, output_path, output_filename, client_id)
+            return
+
+        # Script module is compiled once and cached by the registry (reloaded only if its mtime changed)
+        entry = registry.get(script_name)
+        if entry is None or entry.load_error:
+            reason = entry.load_error if entry else "Script not found"
+            await manager.send_log(f"JOB_FAILED::Error: {reason}", client_id)
+            return
+
+        if entry.run is not None:
             await manager.send_log(f"Starting execution of {script_name}...", client_id)
             
             # Wrapper to inject callback if supported
             def run_wrapper():
-                # Check signature of run arguments
-                import inspect
-                sig = inspect.signature(module.run)
-                if 'log_callback' in sig.parameters:
-                     module.run(input_path, output_path, config_dict, log_callback=log_callback)
+                if entry.accepts_log_callback:
+                     entry.run(input_path, output_path, config_dict, log_callback=log_callback)
                 else:
-                     module.run(input_path, output_path, config_dict)
+                     entry.run(input_path, output_path, config_dict)
 
-            await asyncio.to_thread(run_wrapper)
-            
-            await manager.send_log("Script execution finished.", client_id)
-            
-            if os.path.exists(output_path):
-                # Signal completion with filename
-                await manager.send_log(f"JOB_COMPLETED::{output_filename}", client_id)
-            else:
-                 await manager.send_log("JOB_FAILED::Execution finished but no output file was generated.", client_id)
+            # Run on the scheduler's bounded pool rather than the default executor
+            await loop.run_in_executor(scheduler.executor, run_wrapper)
+            await finish_job(input_path, output_path, output_filename, client_id)
         else:
             await manager.send_log("JOB_FAILED::Script does not have a 'run' function", client_id)
 
     except Exception as e:
         import traceback
         traceback.print_exc()
+        await recover_output(output_path, input_path, client_id)
         await manager.send_log(f"JOB_FAILED::Error: {str(e)}", client_id)
     finally:
+        if token_provider is not None:
+            token_cache.release(token_provider.key)
         manager.mark_inactive(client_id)
 
 
 @app.post("/api/execute")
 async def execute_script(
-    background_tasks: BackgroundTasks,
     script_name: str = Form(...),
     input_filename: str = Form(None), # Optional now
     config: str = Form(...),
-    client_id: str = Form(...) # To send logs to the right client
+    client_id: str = Form(...), # To send logs to the right client
+    priority: str = Form("normal"), # high / normal / low
+    resume: bool = Form(False) # skip rows that succeeded in the last unfinished run on this input
 ):
+    if scheduler.has_job(client_id):
+        raise HTTPException(status_code=409, detail="A job is already queued or running for this session. Stop it first.")
+
     # Clear previous logs for this client since it's a new run
     manager.clear_logs(client_id)
 
-    script_path = os.path.join(SCRIPTS_DIR, script_name)
-    if not os.path.exists(script_path):
+    entry = registry.get(script_name)
+    if entry is None:
         raise HTTPException(status_code=404, detail="Script not found")
+    script_path = entry.path
 
     input_path = None
-    output_filename = f"{script_name.replace('.py', '')}_Output.xlsx"
-    
     if input_filename:
         input_path = os.path.join(UPLOAD_DIR, f"input_{input_filename}")
         if not os.path.exists(input_path):
             raise HTTPException(status_code=404, detail="Input file not found")
-        
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
 
     try:
         config_dict = json.loads(config)
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid config JSON")
 
-    # Add to background tasks
-    background_tasks.add_task(
-        process_background_script,
-        script_path,
-        script_name,
-        input_path,
-        output_path,
-        output_filename,
-        config_dict,
-        client_id
-    )
-    
-    return {"status": "queued", "message": "Script execution started in background"}
+    # Same format as the input unless the job asks for another one (e.g. xlsx to open it in Excel)
+    try:
+        output_format = tables.output_format(config_dict.get("output_format"), input_path)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    output_filename = f"{script_name.replace('.py', '')}_Output.{output_format}"
+    output_path = os.path.join(OUTPUT_DIR, output_filename)
+
+    # Result logs / checkpoints are kept per client, so concurrent jobs of the same script do not share one
+    config_dict["client_id"] = client_id
+
+    if resume:
+        if not input_path or await asyncio.to_thread(results.checkpoint, output_path, input_path, client_id) is None:
+            raise HTTPException(status_code=404, detail="No unfinished run of this script on this input to resume.")
+        config_dict["resume"] = True
+
+    # Hand over to the job scheduler
+    try:
+        scheduler.submit(
+            client_id,
+            config_dict.get("tenant_code"),
+            process_background_script,
+            script_path,
+            script_name,
+            input_path,
+            output_path,
+            output_filename,
+            config_dict,
+            client_id,
+            priority=priority
+        )
+    except DuplicateJobError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    # Let the dispatcher pick the job up if a worker is free right now
+    await asyncio.sleep(0)
+    status = scheduler.status(client_id)
+    if status["state"] == "queued":
+        message = f"Script queued at position {status['queue_position']} of {status['queue_depth']}"
+        await manager.send_log(f"⏳ {message}. Waiting for a free worker...", client_id)
+    else:
+        message = "Script execution started in background"
+    return {"status": "queued", "message": message, **status}
 
 if __name__ == "__main__":
     import uvicorn
@@ -4,12 +4,15 @@ Adds tags to entities in bulk using the Master API.
 Inputs:
 Excel file with Entity IDs and Tag Names.
 """
-import pandas as pd
-import requests
 
-import time
+from app.core.http import HttpClient
+from app.core.results import ResultLog
+from app.core.tables import read_table, write_table
 
-def post_data_to_api(post_api_url, access_token_bearer, input_excel_file, output_excel_file, log_callback=None):
+RATE_LIMIT = 5  # requests per second
+
+
+def post_data_to_api(post_api_url, http, input_excel_file, output_excel_file, log_callback=None, resume=False, job=None):
     def log(msg):
         if log_callback:
             log_callback(msg)
@@ -17,7 +20,7 @@ def post_data_to_api(post_api_url, access_token_bearer, input_excel_file, output
 
     # Read the Excel file
     try:
-        df = pd.read_excel(input_excel_file)
+        df = read_table(input_excel_file)
     except Exception as e:
         log(f"Failed to read input Excel file: {e}")
         return
@@ -26,14 +29,21 @@ def post_data_to_api(post_api_url, access_token_bearer, input_excel_file, output
     df['Status'] = ''
     df['Response'] = ''  # Add a column to store the full response
 
+    # Tags are created with POST: on resume, rows that already succeeded are not sent again
+    results = ResultLog(output_excel_file, input_excel_file, resume=resume, job=job)
+    done = results.restore(df)
+    if done:
+        log(f"⏭️ Resuming: {len(done)} tags were already added and are skipped")
+
     # Set up headers for the API request
     headers = {
-        'Authorization': f'Bearer {access_token_bearer}',
         'Content-Type': 'application/json'
     }
 
     # Iterate through each row in the Excel file
     for index, row in df.iterrows():
+        if index in done:
+            continue
         log(f"Processing iteration {index + 1}...")
 
         # Construct the payload from the row data
@@ -54,7 +64,7 @@ def post_data_to_api(post_api_url, access_token_bearer, input_excel_file, output
         # Make the POST request
         try:
             log(f"Adding Tag {row.iloc[0]} to the API ...")
-            response = requests.post(post_api_url, headers=headers, json=payload)
+            response = http.post(post_api_url, headers=headers, json=payload)
             # Record the status and full response of the request
             if response.status_code == 201:
                 df.at[index, 'Status'] = 'Success'
@@ -68,14 +78,14 @@ def post_data_to_api(post_api_url, access_token_bearer, input_excel_file, output
             df.at[index, 'Status'] = "Error"
             df.at[index, 'Response'] = str(e)
             log(f"Error processing {row.iloc[0]}: {e}")
-
-        # Wait for 0.5 second before the next iteration
-        time.sleep(0.5)
+        df.at[index, 'Retries'] = http.pop_retries()
+        results.record_frame(df.loc[[index]], ['Status', 'Response', 'Retries'])
 
     # Save the updated DataFrame with status to a new Excel file
     log("Saving updated DataFrame to a new Excel file...")
     try:
-        df.to_excel(output_excel_file, index=False)
+        write_table(df, output_excel_file)
+        results.close()
         log("File saved successfully.")
     except Exception as e:
         log(f"Error saving file: {e}")
@@ -102,4 +112,6 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
     
     log(f"Starting execution with API: {api_url}")
     
-    post_data_to_api(api_url, token, input_excel_file, output_excel_file, log_callback=log_callback)
+    http = HttpClient(config, rate_limit=RATE_LIMIT)
+    post_data_to_api(api_url, http, input_excel_file, output_excel_file, log_callback=log_callback,
+                     resume=config.get("resume"), job=config.get("client_id"))
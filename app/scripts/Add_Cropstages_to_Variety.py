@@ -4,10 +4,15 @@ Adds crop stages to a specific variety.
 Inputs:
 Excel file with Variety ID, Crop Stage Name, Description, and Days After Sowing.
 """
-import json
-import requests
 import pandas as pd
-import time
+
+from app.core.engine import SkipRow, get_modify_put
+from app.core.http import HttpClient
+from app.core.results import ResultLog
+from app.core.tables import read_table, write_table
+
+RATE_LIMIT = 5  # requests per second
+
 
 def run(input_excel, output_excel, config, log_callback=None):
     def log(msg):
@@ -30,17 +35,17 @@ def run(input_excel, output_excel, config, log_callback=None):
     # Let's stick to the logic of the user script which uses these hardcoded global vars
     # but adapted to the `run` method scope.
 
-    def fetch_crop_stages(token):
+    http = HttpClient(config, rate_limit=RATE_LIMIT)
+
+    def fetch_crop_stages():
         url = cropstage_url
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.get(url, headers=headers)
+        response = http.get(url)
         response.raise_for_status()
         return response.json()
 
-    def create_crop_stage(token, name, description, days_after_sowing):
+    def create_crop_stage(name, description, days_after_sowing):
         url = cropstage_url
         headers = {
-            "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
         }
         payload = {
@@ -48,39 +53,34 @@ def run(input_excel, output_excel, config, log_callback=None):
             "description": description,
             "daysAfterSowing": days_after_sowing
         }
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        return response.json()
-
-    def update_variety(token, variety_id, variety_data):
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-        
-        # NOTE: Just in case, I will try to be robust. 
-        # But let's check if variety_data has 'id'.
-        # For now, copying user logic.
-        
-        response = requests.put(f"{variety_url}", headers=headers, json=variety_data)
+        response = http.post(url, headers=headers, json=payload)
         response.raise_for_status()
         return response.json()
 
-    df = pd.read_excel(input_excel)
+    df = read_table(input_excel)
     df['Status'] = ''
     df['Response'] = ''
 
-    headers = {"Authorization": f"Bearer {token}"}
-    
+    # Each row's result is appended as it finishes; the output file is written once at the end
+    results = ResultLog(output_excel, input_excel, resume=config.get("resume"), job=config.get("client_id"))
+    done = results.restore(df)
+    if done:
+        log(f"⏭️ Resuming: {len(done)} rows already succeeded and are skipped")
+
     log("⏳ Fetching crop stages...")
     try:
-        crop_stages = fetch_crop_stages(token)
+        crop_stages = fetch_crop_stages()
         crop_stage_names = {stage['name'].lower(): stage for stage in crop_stages}
     except Exception as e:
         log(f"❌ Failed to fetch crop stages: {e}")
         return
 
+    # Resolve (and if needed create) the master crop stage of every row first,
+    # then add the stages per variety: one GET and one PUT per variety.
+    items = []
     for i, row in df.iterrows():
+        if i in done:
+            continue
         try:
             # Indices: 0=VarietyID, 1=CropStageName, 2=Description, 3=DaysAfterSowing
             # Be careful with indices if user changes columns. 
@@ -98,58 +98,71 @@ def run(input_excel, output_excel, config, log_callback=None):
                 log(f"\n⏳ Skipping row {i+2} due to missing data.")
                 continue
 
-            log(f"\n⏳ Processing Variety ID: {variety_id}, Crop Stage: {crop_stage_name}")
-
-            variety_response = requests.get(f"{variety_url}/{variety_id}", headers=headers)
-            variety_response.raise_for_status()
-            variety_data = variety_response.json()
-
             crop_stage_template = crop_stage_names.get(str(crop_stage_name).lower())
 
             if not crop_stage_template:
                 # create stage if missing in master
                 log(f"⚠️ Crop stage '{crop_stage_name}' does not exist. Creating...")
-                crop_stage_template = create_crop_stage(token, crop_stage_name, description, days_after_sowing)
+                crop_stage_template = create_crop_stage(crop_stage_name, description, days_after_sowing)
                 crop_stage_names[str(crop_stage_name).lower()] = crop_stage_template
-            else:
-                log(f"✅ Crop stage '{crop_stage_name}' found in master.")
-
-            # Check if stage already present in variety
-            existing_stages = variety_data.get("cropStages", [])
-            if any(stage['name'].lower() == str(crop_stage_name).lower() for stage in existing_stages):
-                log(f"⚠️ Crop stage '{crop_stage_name}' already added to variety. Skipping update.")
-                df.at[i, 'Status'] = "Skipped: Already Present"
-                df.at[i, 'Response'] = "Already Present" # Reduced JSON dump to avoid clutter in excel cell
-                continue
 
-            # Work on a copy to avoid mutating the master directly
-            stage_to_add = crop_stage_template.copy()
-
-            # If daysAfterSowing is missing/null/empty in the stage object, set it from Excel (if Excel provided it)
-            if pd.notna(days_after_sowing) and (
-                    stage_to_add.get('daysAfterSowing') is None or stage_to_add.get('daysAfterSowing') == ''):
-                # convert to int if possible, otherwise keep as-is
-                try:
-                    stage_value = int(days_after_sowing)
-                except (ValueError, TypeError):
-                    stage_value = days_after_sowing
-                stage_to_add['daysAfterSowing'] = stage_value
-
-            # append and update
-            variety_data.setdefault("cropStages", []).append(stage_to_add)
-            
-            
-            update_response = update_variety(token, variety_id, variety_data)
-            log(f"✅ Updated variety with new crop stage: {crop_stage_name}")
-            df.at[i, 'Status'] = "Success"
-            df.at[i, 'Response'] = "Updated Successfully"
+            items.append((i, variety_id, (crop_stage_name, crop_stage_template, days_after_sowing)))
 
         except Exception as e:
             log(f"❌ Failed to process row {i+2}: {str(e)}")
             df.at[i, 'Status'] = "Failed"
             df.at[i, 'Response'] = str(e)
-
-        time.sleep(0.5)
-
-    df.to_excel(output_excel, index=False)
+        finally:
+            df.at[i, 'Retries'] = http.pop_retries()
+            if df.at[i, 'Status']:
+                # Skipped or failed before reaching the variety
+                results.record(i, Status=df.at[i, 'Status'], Response=df.at[i, 'Response'], Retries=df.at[i, 'Retries'])
+
+    def add_crop_stage(variety_data, new_stage):
+        crop_stage_name, crop_stage_template, days_after_sowing = new_stage
+
+        # Check if stage already present in variety
+        existing_stages = variety_data.get("cropStages", [])
+        if any(stage['name'].lower() == str(crop_stage_name).lower() for stage in existing_stages):
+            log(f"⚠️ Crop stage '{crop_stage_name}' already added to variety. Skipping update.")
+            raise SkipRow("Skipped: Already Present", "Already Present")
+
+        # Work on a copy to avoid mutating the master directly
+        stage_to_add = crop_stage_template.copy()
+
+        # If daysAfterSowing is missing/null/empty in the stage object, set it from Excel (if Excel provided it)
+        if pd.notna(days_after_sowing) and (
+                stage_to_add.get('daysAfterSowing') is None or stage_to_add.get('daysAfterSowing') == ''):
+            # convert to int if possible, otherwise keep as-is
+            try:
+                stage_value = int(days_after_sowing)
+            except (ValueError, TypeError):
+                stage_value = days_after_sowing
+            stage_to_add['daysAfterSowing'] = stage_value
+
+        variety_data.setdefault("cropStages", []).append(stage_to_add)
+        return variety_data
+
+    def finish(i, status, response, retries):
+        df.at[i, 'Status'] = status
+        df.at[i, 'Response'] = "Updated Successfully" if status == "Success" else response  # Reduced JSON dump to avoid clutter in excel cell
+        df.at[i, 'Retries'] += retries
+        results.record(i, Status=df.at[i, 'Status'], Response=df.at[i, 'Response'], Retries=df.at[i, 'Retries'])
+
+    log(f"\n⏳ Adding {len(items)} crop stages to varieties...")
+    # NOTE: the variety is PUT to the base URL with the ID in the body, as in the user script
+    get_modify_put(
+        items,
+        get_url=lambda variety_id: f"{variety_url}/{variety_id}",
+        put_url=variety_url,
+        modify=add_crop_stage,
+        config=config,
+        rate_limit=RATE_LIMIT,
+        multipart=False,
+        log=log,
+        on_result=finish,
+    )
+
+    write_table(df, output_excel)
+    results.close()
     log(f"\n✅ Processing complete. Output saved to {output_excel}")
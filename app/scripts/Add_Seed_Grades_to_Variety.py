@@ -4,10 +4,15 @@ Adds seed grades to a specific variety.
 Inputs:
 Excel file with Variety ID, Seed Grade Name, and Description.
 """
-import json
-import requests
 import pandas as pd
-import time
+
+from app.core.engine import SkipRow, get_modify_put
+from app.core.http import HttpClient
+from app.core.results import ResultLog
+from app.core.tables import read_table, write_table
+
+RATE_LIMIT = 5  # requests per second
+
 
 def run(input_excel, output_excel, config, log_callback=None):
     def log(msg):
@@ -26,44 +31,31 @@ def run(input_excel, output_excel, config, log_callback=None):
     # seed_grade_url is the secondary URL
     seed_grade_url = config.get("secondary_api_url", "https://cloud.cropin.in/services/farm/api/seed-grades")
 
-    def fetch_seed_grade(token):
+    http = HttpClient(config, rate_limit=RATE_LIMIT)
+
+    def fetch_seed_grade():
         url = seed_grade_url
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.get(url, headers=headers)
+        response = http.get(url)
         response.raise_for_status()
         return response.json()
 
-    def create_seed_grade(token, name, description):
+    def create_seed_grade(name, description):
         url = seed_grade_url
         headers = {
-            "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
         }
         payload = {
             "name": name,
             "description": description
         }
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        return response.json()
-
-    def update_variety(token, variety_data):
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-        # Note: Previous scripts suggested `requests.put(f"{variety_url}", ...)` might work if ID is in body or specific API behavior.
-        # But commonly it is `requests.put(f"{variety_url}/{id}", ...)`
-        # The user provided script used: `response = requests.put(f"{variety_url}", headers=headers, json=variety_data)`
-        # I will respect that.
-        response = requests.put(f"{variety_url}", headers=headers, json=variety_data)
+        response = http.post(url, headers=headers, json=payload)
         response.raise_for_status()
         return response.json()
 
     log("⏳ Reading input file...")
     try:
         # Default to Sheet1 as per user script request, but pandas defaults to first sheet usually.
-        df = pd.read_excel(input_excel) 
+        df = read_table(input_excel) 
     except Exception as e:
         log(f"❌ Failed to read Excel file: {e}")
         return
@@ -71,17 +63,26 @@ def run(input_excel, output_excel, config, log_callback=None):
     df['Status'] = ''
     df['Response'] = ''
 
-    headers = {"Authorization": f"Bearer {token}"}
-    
+    # Each row's result is appended as it finishes; the output file is written once at the end
+    results = ResultLog(output_excel, input_excel, resume=config.get("resume"), job=config.get("client_id"))
+    done = results.restore(df)
+    if done:
+        log(f"⏭️ Resuming: {len(done)} rows already succeeded and are skipped")
+
     log("⏳ Fetching existing seed grades...")
     try:
-        seed_grade = fetch_seed_grade(token)
+        seed_grade = fetch_seed_grade()
         seed_grade_names = {seed['name'].lower(): seed for seed in seed_grade}
     except Exception as e:
         log(f"❌ Failed to fetch seed grades: {e}")
         return
 
+    # Resolve (and if needed create) the master seed grade of every row first,
+    # then add the grades per variety: one GET and one PUT per variety.
+    items = []
     for i, row in df.iterrows():
+        if i in done:
+            continue
         try:
             # Column mapping based on user script:
             # 0: Variety ID
@@ -98,43 +99,58 @@ def run(input_excel, output_excel, config, log_callback=None):
                 log(f"\n⏳ Skipping row {i+2} due to missing data.")
                 continue
 
-            log(f"\n⏳ Processing Variety ID: {variety_id}, Seed Grade: {seed_grade_name}")
-
-            variety_response = requests.get(f"{variety_url}/{variety_id}", headers=headers)
-            variety_response.raise_for_status()
-            variety_data = variety_response.json()
-
             seed_grade_to_add = seed_grade_names.get(str(seed_grade_name).lower())
 
             if not seed_grade_to_add:
                 log(f"⚠️ Seed Grade '{seed_grade_name}' does not exist. Creating...")
-                seed_grade_to_add = create_seed_grade(token, seed_grade_name, description)
+                seed_grade_to_add = create_seed_grade(seed_grade_name, description)
                 seed_grade_names[str(seed_grade_name).lower()] = seed_grade_to_add
-            else:
-                log(f"✅ Seed Grade '{seed_grade_name}' already exists.")
-
-            existing_stages = variety_data.get("seedGrades", [])
-            if any(seed['name'].lower() == str(seed_grade_name).lower() for seed in existing_stages):
-                log(f"⚠️ Seed Grade '{seed_grade_name}' already added to variety. Skipping update.")
-                df.at[i, 'Status'] = "Skipped: Already Present"
-                # Avoid dumping full JSON to excel cell
-                df.at[i, 'Response'] = "Already Present" 
-                continue
 
-            variety_data.setdefault("seedGrades", []).append(seed_grade_to_add)
-            
-            update_variety(token, variety_data)
-            
-            log(f"✅ Updated variety with new seed grade: {seed_grade_name}")
-            df.at[i, 'Status'] = "Success"
-            df.at[i, 'Response'] = "Updated Successfully"
+            items.append((i, variety_id, (seed_grade_name, seed_grade_to_add)))
 
         except Exception as e:
             log(f"❌ Failed to process row {i+2}: {str(e)}")
             df.at[i, 'Status'] = "Failed"
             df.at[i, 'Response'] = str(e)
-
-        time.sleep(0.5)
-
-    df.to_excel(output_excel, index=False)
+        finally:
+            df.at[i, 'Retries'] = http.pop_retries()
+            if df.at[i, 'Status']:
+                # Skipped or failed before reaching the variety
+                results.record(i, Status=df.at[i, 'Status'], Response=df.at[i, 'Response'], Retries=df.at[i, 'Retries'])
+
+    def add_seed_grade(variety_data, new_grade):
+        seed_grade_name, seed_grade_to_add = new_grade
+
+        existing_stages = variety_data.get("seedGrades", [])
+        if any(seed['name'].lower() == str(seed_grade_name).lower() for seed in existing_stages):
+            log(f"⚠️ Seed Grade '{seed_grade_name}' already added to variety. Skipping update.")
+            raise SkipRow("Skipped: Already Present", "Already Present")
+
+        variety_data.setdefault("seedGrades", []).append(seed_grade_to_add)
+        return variety_data
+
+    def finish(i, status, response, retries):
+        df.at[i, 'Status'] = status
+        # Avoid dumping full JSON to excel cell
+        df.at[i, 'Response'] = "Updated Successfully" if status == "Success" else response
+        df.at[i, 'Retries'] += retries
+        results.record(i, Status=df.at[i, 'Status'], Response=df.at[i, 'Response'], Retries=df.at[i, 'Retries'])
+
+    log(f"\n⏳ Adding {len(items)} seed grades to varieties...")
+    # The user provided script used: `requests.put(f"{variety_url}", headers=headers, json=variety_data)`
+    # I will respect that.
+    get_modify_put(
+        items,
+        get_url=lambda variety_id: f"{variety_url}/{variety_id}",
+        put_url=variety_url,
+        modify=add_seed_grade,
+        config=config,
+        rate_limit=RATE_LIMIT,
+        multipart=False,
+        log=log,
+        on_result=finish,
+    )
+
+    write_table(df, output_excel)
+    results.close()
     log(f"\n✅ Processing complete. Output saved to {output_excel}")
@@ -6,9 +6,14 @@ Excel file with User details (Name, Email, Role, etc.).
 """
 import pandas as pd
 
-import requests
 import json
-import time
+
+from app.core.http import HttpClient
+from app.core.results import ResultLog
+from app.core.tables import read_table, write_table
+
+RATE_LIMIT = 2  # requests per second
+
 
 def run(input_excel_file, output_excel_file, config, log_callback=None):
     def log(msg):
@@ -27,6 +32,8 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         user_api_url = "https://cloud.cropin.in/services/user/api/users/images"
         log(f"Using default User API URL: {user_api_url}")
     
+    http = HttpClient(config, rate_limit=RATE_LIMIT)
+
     # We use x_api_key field for Google Maps API Key
     google_api_key = config.get("x_api_key")
     if not google_api_key:
@@ -40,7 +47,8 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         params = {"address": address, "key": api_key}
 
         try:
-            response = requests.get(base_url, params=params)
+            # Third-party API: never send the Cropin token
+            response = http.get(base_url, params=params, authenticate=False)
             data = response.json()
 
             if data["status"] != "OK":
@@ -98,7 +106,7 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
     # Processing Excel
     log(f"📂 Loading input Excel file: {input_excel_file}")
     try:
-        df = pd.read_excel(input_excel_file)
+        df = read_table(input_excel_file)
     except Exception as e:
         log(f"❌ Error reading Excel file: {e}")
         return
@@ -112,9 +120,18 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
             df[col] = ""
         df[col] = df[col].astype(str)
 
-    log(f"🔄 Processing {len(df)} rows...")
+    # Users are created with POST: on resume, rows that already succeeded are not sent again
+    results = ResultLog(output_excel_file, input_excel_file, resume=config.get("resume"),
+                        job=config.get("client_id"))
+    done = results.restore(df)
+    if done:
+        log(f"⏭️ Resuming: {len(done)} users were already created and are skipped")
+
+    log(f"🔄 Processing {len(df) - len(done)} rows...")
 
     for index, row in df.iterrows():
+        if index in done:
+            continue
         try:
             # Column mapping based on user's code (assuming standard order 0-11)
             # 0: User Name, 1: Manager IDs, 2: Contact, 3: roleId, 4: Email, 5: CountryCode, 6: Location Name
@@ -198,11 +215,10 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
             # putting it in `[]` creates `[['id']]`. 
             # I'll stick to user logic.
 
-            headers = {'Authorization': f'Bearer {token}'}
             multipart_data = {"dto": (None, json.dumps(user_payload), "application/json")}
             
             log(f"🚀 Creating User: {user_name}")
-            resp = requests.post(user_api_url, headers=headers, files=multipart_data)
+            resp = http.post(user_api_url, files=multipart_data)
             
             if resp.status_code == 201:
                 log(f"✅ Created: {user_name}")
@@ -217,11 +233,13 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
             log(f"❌ Error row {index}: {e}")
             df.at[index, 'Status'] = "Error"
             df.at[index, 'Response'] = str(e)
+        finally:
+            df.at[index, 'Retries'] = http.pop_retries()
+            results.record_frame(df.loc[[index]], ["Status", "Response", "User_response", "Retries"])
             
-        time.sleep(1)
-
     try:
-        df.to_excel(output_excel_file, index=False)
+        write_table(df, output_excel_file)
+        results.close()
         log(f"💾 Output saved to: {output_excel_file}")
     except Exception as e:
         log(f"Error saving output: {e}")
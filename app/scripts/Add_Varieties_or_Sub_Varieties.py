@@ -5,9 +5,14 @@ Inputs:
 Excel file with NE Lat, NE Lng, SW Lat, SW Lng, Country, Lat, Lng, Coords JSON, Loc Name, Yield, Yield Unit, Ref Unit, CropID, ParentID, Name, Nickname, HarvestDays.
 """
 import pandas as pd
-import requests
 import json
-import time
+
+from app.core.http import HttpClient
+from app.core.results import ResultLog
+from app.core.tables import read_table, write_table
+
+RATE_LIMIT = 5  # requests per second
+
 
 def run(input_excel_file, output_excel_file, config, log_callback=None):
     def log(msg):
@@ -21,12 +26,14 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         log("No token provided in configuration.")
         return
 
+    http = HttpClient(config, rate_limit=RATE_LIMIT)
+
     post_api_url = config.get("post_api_url", "https://cloud.cropin.in/services/farm/api/varieties")
 
     # 2. Read Excel
     log(f"Loading input Excel file: {input_excel_file}")
     try:
-        df = pd.read_excel(input_excel_file)
+        df = read_table(input_excel_file)
     except Exception as e:
         log(f"Error reading Excel file: {e}")
         return
@@ -35,14 +42,22 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
     df['Status'] = ''
     df['Response'] = ''
 
+    # Varieties are created with POST: on resume, rows that already succeeded are not sent again
+    results = ResultLog(output_excel_file, input_excel_file, resume=config.get("resume"),
+                        job=config.get("client_id"))
+    done = results.restore(df)
+    if done:
+        log(f"Resuming: {len(done)} varieties were already added and are skipped")
+
     headers = {
-        'Authorization': f'Bearer {token}',
         'Content-Type': 'application/json'
     }
 
-    log(f"Processing {len(df)} rows...")
+    log(f"Processing {len(df) - len(done)} rows...")
 
     for index, row in df.iterrows():
+        if index in done:
+            continue
         try:
 
             # Mapping based on user provided ilocs:
@@ -146,7 +161,7 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
                 payload['parentId'] = parent_id
 
             log(f"Adding variety: {name}...")
-            response = requests.post(post_api_url, headers=headers, json=payload)
+            response = http.post(post_api_url, headers=headers, json=payload)
 
             if response.status_code == 201:
                 df.at[index, 'Status'] = 'Success'
@@ -161,11 +176,13 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
             log(f"Error row {index+1}: {e}")
             df.at[index, 'Status'] = "Error"
             df.at[index, 'Response'] = str(e)
+        finally:
+            df.at[index, 'Retries'] = http.pop_retries()
+            results.record_frame(df.loc[[index]], ['Status', 'Response', 'Retries'])
             
-        time.sleep(0.5)
-
     try:
-        df.to_excel(output_excel_file, index=False)
+        write_table(df, output_excel_file)
+        results.close()
         log(f"Output saved to: {output_excel_file}")
     except Exception as e:
         log(f"Error saving output: {e}")
@@ -4,10 +4,13 @@ Removes area audits for specified croppable areas.
 Inputs:
 Excel file with Croppable Area IDs (`ca_id`).
 """
-import pandas as pd
-import requests
 
-import time
+from app.core import preflight
+from app.core.http import HttpClient
+from app.core.tables import read_table, write_table
+
+RATE_LIMIT = 2  # requests per second
+
 
 def run(input_excel_file, output_excel_file, config, log_callback=None):
     def log(msg):
@@ -21,6 +24,8 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         log("❌ No token provided in configuration.")
         return
 
+    http = HttpClient(config, rate_limit=RATE_LIMIT)
+
     # Base URL from config
     # Users provided example: https://cloud.cropin.in/services/farm/api/croppable-areas/{ca_id}/area-audit
     # The config should ideally provide: https://cloud.cropin.in/services/farm/api/croppable-areas
@@ -33,7 +38,7 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
 
     log(f"📂 Loading input file: {input_excel_file}")
     try:
-        df = pd.read_excel(input_excel_file)
+        df = read_table(input_excel_file)
     except Exception as e:
         log(f"❌ Error reading Excel file: {e}")
         return
@@ -45,7 +50,6 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         df[col] = df[col].astype(str)
 
     headers = {
-        "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
     }
 
@@ -56,12 +60,9 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
     success_count = 0
     failure_count = 0
 
-    for index, row in df.iterrows():
-        ca_id = str(row.get("ca_id", "")).strip()
-
-        if not ca_id or ca_id.lower() == 'nan':
-            # Skip empty
-            continue
+    # Rows without a CA ID are skipped
+    ca_ids = preflight.ids(preflight.column(df, "ca_id"))
+    for index, ca_id in ca_ids[ca_ids != ""].items():
 
         # Construct URL: base/{ca_id}/area-audit
         # Assuming base ends with 'croppable-areas' or user provides root. 
@@ -74,7 +75,7 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         log(f"Processing {ca_id}...")
 
         try:
-            response = requests.delete(url, headers=headers)
+            response = http.delete(url, headers=headers)
             status_code = response.status_code
 
             if status_code == 200:
@@ -94,10 +95,10 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
             df.at[index, "Response"] = str(e)
             failure_count += 1
 
-        time.sleep(1) # Rate limit protection
+        df.at[index, "Retries"] = http.pop_retries()
 
     try:
-        df.to_excel(output_excel_file, index=False)
+        write_table(df, output_excel_file)
         log(f"💾 Completed. Success: {success_count}, Failures: {failure_count}. Saved to {output_excel_file}")
     except Exception as e:
         log(f"Error saving output: {e}")
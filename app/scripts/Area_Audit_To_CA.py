@@ -13,7 +13,14 @@ Excel file with CA_id, CA_Name, area_Audit_DTO, Latitude, Longitude, and audited
 import json
 import requests
 import pandas as pd
-import time
+
+from app.core.fingerprint import UNCHANGED, fingerprint
+from app.core.http import HttpClient
+from app.core.results import ResultLog
+from app.core.tables import SheetReader, SheetWriter
+
+RATE_LIMIT = 5  # requests per second
+
 
 # ============================================================
 # GEOINFO NORMALIZATION
@@ -75,6 +82,8 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         log("❌ Token missing. Exiting.")
         return
 
+    http = HttpClient(config, rate_limit=RATE_LIMIT)
+
     # Use configured URL or default
     api_url = config.get("post_api_url")
     if not api_url:
@@ -84,157 +93,181 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         log(f"Using configured API URL: {api_url}")
 
     headers = {
-        "Authorization": f"Bearer {token}",
         "Content-Type": "application/json",
         "channel": "mobile"
     }
 
     log(f"📘 Loading Excel file: {input_excel_file}")
     try:
-        df = pd.read_excel(input_excel_file)
+        sheet = SheetReader(input_excel_file)
     except Exception as e:
         log(f"❌ Error reading Excel file: {e}")
         return
 
     # Ensure output columns exist
-    for col in ["Status", "CA_Response"]:
-        if col not in df.columns:
-            df[col] = ""
+    output_columns = sheet.columns + [col for col in ["Status", "CA_Response", "Retries"] if col not in sheet.columns]
+    writer = SheetWriter(output_excel_file, output_columns)
+    results = ResultLog(output_excel_file, input_excel_file, resume=config.get("resume"), sheet=sheet.name,
+                        job=config.get("client_id"))
+    if results.previous:
+        log(f"⏭️ Resuming: {results.done()} rows already succeeded and are skipped")
 
     # Replace NaNs with empty string for safety in text fields, but be careful with numbers
     # df = df.fillna("") # Optional, may mess up numeric checks if not careful, sticking to per-row checks
 
-    log(f"\n[INFO] Starting to process {len(df)} rows")
+    size = f" ~{sheet.size_hint}" if sheet.size_hint else ""
+    log(f"\n[INFO] Starting to process{size} rows")
 
-    for index, row in df.iterrows():
-        # Try to use named columns if they exist, else fallback to indices as per original script
-        # Original: 0=CA_id, 1=CA_Name, 2=area_Audit_DTO, 3=Latitude, 4=Longitude, 5=audited_count
-        
-        try:
-             # Flexible column retrieval
-            if "CA_id" in row: CA_id = row["CA_id"]
-            else: CA_id = row.iloc[0]
-
-            if "CA_Name" in row: CA_Name = row["CA_Name"]
-            else: CA_Name = row.iloc[1]
+    # The sheet is streamed: each batch is processed and written out before the next is read
+    for batch in sheet.batches():
+        for col in ["Status", "CA_Response"]:
+            if col not in batch.columns:
+                batch[col] = ""
 
-            if "area_Audit_DTO" in row: area_Audit_DTO = row["area_Audit_DTO"]
-            else: area_Audit_DTO = row.iloc[2]
-            
-            if "Latitude" in row: Latitude = row["Latitude"]
-            else: Latitude = row.iloc[3]
+        done = results.restore(batch)
 
-            if "Longitude" in row: Longitude = row["Longitude"]
-            else: Longitude = row.iloc[4]
+        for index, row in batch.iterrows():
+            if index in done:
+                continue
+            # Try to use named columns if they exist, else fallback to indices as per original script
+            # Original: 0=CA_id, 1=CA_Name, 2=area_Audit_DTO, 3=Latitude, 4=Longitude, 5=audited_count
+        
+            try:
+                 # Flexible column retrieval
+                if "CA_id" in row: CA_id = row["CA_id"]
+                else: CA_id = row.iloc[0]
 
-            if "audited_count" in row: audited_count = row["audited_count"]
-            else: audited_count = row.iloc[5]
+                if "CA_Name" in row: CA_Name = row["CA_Name"]
+                else: CA_Name = row.iloc[1]
 
-            # Convert types if necessary (pandas might infer float for count)
-            # CA_id might be UUID string
+                if "area_Audit_DTO" in row: area_Audit_DTO = row["area_Audit_DTO"]
+                else: area_Audit_DTO = row.iloc[2]
             
-            # Basic validation
-            if pd.isna(CA_id) or pd.isna(area_Audit_DTO) or str(CA_id).strip() == "":
-                df.at[index, "Status"] = "Skipped: Missing Data"
-                continue
+                if "Latitude" in row: Latitude = row["Latitude"]
+                else: Latitude = row.iloc[3]
 
-            # Normalize geoInfo
-            try:
-                # Ensure area_Audit_DTO is string
-                geo_info_str = str(area_Audit_DTO) if not isinstance(area_Audit_DTO, (dict, list)) else json.dumps(area_Audit_DTO)
-                geo_info = normalize_geo_info(geo_info_str)
-            except Exception as e:
-                df.at[index, "Status"] = f"Invalid GeoInfo: {e}"
-                continue
-
-            log(f"🔄 Processing CA_ID: {CA_id} ({CA_Name})")
+                if "Longitude" in row: Longitude = row["Longitude"]
+                else: Longitude = row.iloc[4]
 
-            # ---------------- GET CA ----------------
-            get_endpoint = f"{api_url}/{CA_id}"
-            # log(f"GET {get_endpoint}")
-            get_response = requests.get(get_endpoint, headers=headers)
+                if "audited_count" in row: audited_count = row["audited_count"]
+                else: audited_count = row.iloc[5]
 
-            if get_response.status_code != 200:
-                df.at[index, "Status"] = f"GET Failed: {get_response.status_code}"
-                # Handle truncated response text in Excel
-                df.at[index, "CA_Response"] = get_response.text[:30000] 
-                log(f"❌ GET Failed for {CA_Name}")
-                continue
+                # Convert types if necessary (pandas might infer float for count)
+                # CA_id might be UUID string
             
-            log(f"✅ Fetched CA data for {CA_Name}")
-            CA_data = get_response.json()
+                # Basic validation
+                if pd.isna(CA_id) or pd.isna(area_Audit_DTO) or str(CA_id).strip() == "":
+                    batch.at[index, "Status"] = "Skipped: Missing Data"
+                    continue
+
+                # Normalize geoInfo
+                try:
+                    # Ensure area_Audit_DTO is string
+                    geo_info_str = str(area_Audit_DTO) if not isinstance(area_Audit_DTO, (dict, list)) else json.dumps(area_Audit_DTO)
+                    geo_info = normalize_geo_info(geo_info_str)
+                except Exception as e:
+                    batch.at[index, "Status"] = f"Invalid GeoInfo: {e}"
+                    continue
+
+                log(f"🔄 Processing CA_ID: {CA_id} ({CA_Name})")
+
+                # ---------------- GET CA ----------------
+                get_endpoint = f"{api_url}/{CA_id}"
+                # log(f"GET {get_endpoint}")
+                get_response = http.get(get_endpoint, headers=headers)
+
+                if get_response.status_code != 200:
+                    batch.at[index, "Status"] = f"GET Failed: {get_response.status_code}"
+                    # Handle truncated response text in Excel
+                    batch.at[index, "CA_Response"] = get_response.text[:30000] 
+                    log(f"❌ GET Failed for {CA_Name}")
+                    continue
+            
+                log(f"✅ Fetched CA data for {CA_Name}")
+                CA_data = get_response.json()
+                before = fingerprint(CA_data)
+
+                # ---------------- PREPARE PAYLOAD ----------------
+                try:
+                    audit_count_val = float(audited_count)
+                except:
+                    audit_count_val = 0.0
+
+                # Get unit from config (default to Hectare)
+                unit_val = config.get("unit", "Hectare")
+
+                areaAudit = {
+                    "id": None,
+                    "geoInfo": geo_info,
+                    "latitude": Latitude,
+                    "longitude": Longitude,
+                    "altitude": None
+                }
 
-            # ---------------- PREPARE PAYLOAD ----------------
-            try:
-                audit_count_val = float(audited_count)
-            except:
-                audit_count_val = 0.0
-
-            # Get unit from config (default to Hectare)
-            unit_val = config.get("unit", "Hectare")
-
-            areaAudit = {
-                "id": None,
-                "geoInfo": geo_info,
-                "latitude": Latitude,
-                "longitude": Longitude,
-                "altitude": None
-            }
-
-            auditedArea = {
-                "count": audit_count_val,
-                "unit": unit_val
-            }
-
-            CA_data["areaAudit"] = areaAudit
-            CA_data["auditedArea"] = auditedArea
-            # Resetting lat/long at root level as per user script
-            CA_data["latitude"] = None
-            CA_data["longitude"] = None
+                auditedArea = {
+                    "count": audit_count_val,
+                    "unit": unit_val
+                }
+
+                CA_data["areaAudit"] = areaAudit
+                CA_data["auditedArea"] = auditedArea
+                # Resetting lat/long at root level as per user script
+                CA_data["latitude"] = None
+                CA_data["longitude"] = None
             
-            # CA_data["cropAudited"] = True  # Logic moved to config
-            force_crop_audited = config.get("force_crop_audited", "none")
+                # CA_data["cropAudited"] = True  # Logic moved to config
+                force_crop_audited = config.get("force_crop_audited", "none")
             
-            if force_crop_audited == "true":
-                CA_data["cropAudited"] = True
-            elif force_crop_audited == "false":
-                CA_data["cropAudited"] = False
-            # if "none", do nothing (don't send/don't override)
-
-            # ---------------- PUT UPDATE ----------------
-            put_endpoint = f"{api_url}/area-audit"
-            # log(f"PUT {put_endpoint}")
+                if force_crop_audited == "true":
+                    CA_data["cropAudited"] = True
+                elif force_crop_audited == "false":
+                    CA_data["cropAudited"] = False
+                # if "none", do nothing (don't send/don't override)
+
+                if fingerprint(CA_data) == before:
+                    batch.at[index, "Status"] = UNCHANGED
+                    log(f"⏭️ Area audit already up to date for {CA_Name}")
+                    continue
+
+                # ---------------- PUT UPDATE ----------------
+                put_endpoint = f"{api_url}/area-audit"
+                # log(f"PUT {put_endpoint}")
             
-            put_response = requests.put(
-                put_endpoint,
-                headers=headers,
-                data=json.dumps(CA_data)
-            )
-
-            if put_response.status_code != 200:
-                df.at[index, "Status"] = f"PUT Failed: {put_response.status_code}"
-                df.at[index, "CA_Response"] = put_response.text[:30000]
-                log(f"❌ PUT Failed: {put_response.status_code}")
-                continue
-
-            df.at[index, "Status"] = "Success"
-            df.at[index, "CA_Response"] = put_response.text[:30000]
-            log(f"✅ Updated area audit for {CA_Name}")
-
-        except requests.exceptions.RequestException as e:
-            df.at[index, "Status"] = f"Request Failed: {e}"
-            df.at[index, "CA_Response"] = str(e)
-            log(f"❌ Request Exception: {e}")
-        except Exception as e:
-            df.at[index, "Status"] = f"Error: {e}"
-            log(f"❌ Error: {e}")
+                put_response = http.put(
+                    put_endpoint,
+                    headers=headers,
+                    data=json.dumps(CA_data)
+                )
+
+                if put_response.status_code != 200:
+                    batch.at[index, "Status"] = f"PUT Failed: {put_response.status_code}"
+                    batch.at[index, "CA_Response"] = put_response.text[:30000]
+                    log(f"❌ PUT Failed: {put_response.status_code}")
+                    continue
+
+                batch.at[index, "Status"] = "Success"
+                batch.at[index, "CA_Response"] = put_response.text[:30000]
+                log(f"✅ Updated area audit for {CA_Name}")
+
+            except requests.exceptions.RequestException as e:
+                batch.at[index, "Status"] = f"Request Failed: {e}"
+                batch.at[index, "CA_Response"] = str(e)
+                log(f"❌ Request Exception: {e}")
+            except Exception as e:
+                batch.at[index, "Status"] = f"Error: {e}"
+                log(f"❌ Error: {e}")
+            finally:
+                batch.at[index, "Retries"] = http.pop_retries()
+                # Logged as soon as the row is done, so a crash mid-batch loses at most this row
+                results.record(index, **{col: batch.at[index, col] for col in ["Status", "CA_Response", "Retries"]})
 
-        time.sleep(0.5)
+        writer.write(batch)
 
     # Save output
-    log(f"\n💾 Saving output to: {output_excel_file}")
+    log(f"\n💾 Saving {writer.written} rows to: {output_excel_file}")
     try:
-        df.to_excel(output_excel_file, index=False)
+        writer.close()
+        results.close()
         log(f"🎯 Done. Output saved.")
     except Exception as e:
         log(f"❌ Error saving file: {e}")
@@ -4,9 +4,15 @@ Bulk delete assets using Excel input (100 IDs per batch).
 Inputs:
 Excel file with 'asset_id' column.
 """
-import pandas as pd
-import requests
-import time
+
+from app.core import preflight
+from app.core.batches import chunks, delete_ids, dispatch, in_flight_from, write_outcomes
+from app.core.http import HttpClient
+from app.core.results import ResultLog
+from app.core.tables import read_table, write_table
+
+RATE_LIMIT = 1  # batch requests per second
+
 
 def run(input_excel_file, output_excel_file, config, log_callback=None):
     def log(msg):
@@ -14,14 +20,15 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
             log_callback(msg)
         print(msg)
 
-    delay_time = 2 # seconds
-
     # Configuration
     token = config.get("token")
     if not token:
         log("❌ No token provided in configuration.")
         return
 
+    in_flight = in_flight_from(config)
+    http = HttpClient(config, concurrency=in_flight, rate_limit=RATE_LIMIT)
+
     api_url = config.get("post_api_url")
     if not api_url:
         api_url = "https://cloud.cropin.in/services/farm/api/assets/bulk"
@@ -34,7 +41,7 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
 
     try:
         # Load Excel
-        df = pd.read_excel(input_excel_file)
+        df = read_table(input_excel_file)
         
         if "asset_id" not in df.columns:
             # Try case-insensitive matching
@@ -50,67 +57,52 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
             if col not in df.columns:
                 df[col] = ""
 
-        # Clean IDs
-        df_clean = df.dropna(subset=["asset_id"])
-        
-        # Convert to int then str to remove decimals if any, then back to str
-        try:
-             # Handle cases where asset_id might be non-numeric
-            df.loc[df_clean.index, "asset_id"] = df.loc[df_clean.index, "asset_id"].astype(str).str.replace(r'\.0$', '', regex=True)
-        except Exception as e:
-            log(f"⚠️ Warning during ID formatting: {e}")
-
-        # Identify rows that have asset_id
-        valid_indices = df[df["asset_id"].notna() & (df["asset_id"].astype(str).str.strip() != "")].index.tolist()
-        
-        asset_ids = df.loc[valid_indices, "asset_id"].astype(str).tolist()
+        # Clean IDs (123.0 -> "123") and keep the rows that have one
+        ids = preflight.ids(df["asset_id"])
+        valid_indices = ids.index[ids != ""].tolist()
+
+        # Results are appended per batch; the output file is written once at the end
+        results = ResultLog(output_excel_file, input_excel_file, resume=config.get("resume"),
+                            job=config.get("client_id"))
+        done = results.restore(df)
+        if done:
+            log(f"⏭️ Resuming: {len(done)} rows already deleted")
+            valid_indices = [index for index in valid_indices if index not in done]
+
+        asset_ids = ids[valid_indices].tolist()
 
         log(f"🚀 Total Assets to Delete: {len(asset_ids)}")
         
         headers = {
-            "Authorization": f"Bearer {token}",
             "Accept": "application/json"
         }
 
-        for i in range(0, len(asset_ids), BATCH_SIZE):
-            batch_slice_ids = asset_ids[i:i + BATCH_SIZE]
-            batch_indices = valid_indices[i:i + BATCH_SIZE]
-            
-            ids_param = ",".join(batch_slice_ids)
-
-            log(f"\n🗑️ Deleting batch {i // BATCH_SIZE + 1}")
-
-            try:
-                response = requests.delete(
-                    api_url,
-                    headers=headers,
-                    params={"ids": ids_param},
-                    timeout=60
-                )
-
-                status_code = response.status_code
-                response_text = response.text
-
-                if status_code in [200, 204]:
-                    status = "✅ Deleted"
-                    log(f"✅ Batch {i // BATCH_SIZE + 1} deleted successfully")
-                else:
-                    status = f"❌ Failed ({status_code})"
-                    log(f"❌ Batch {i // BATCH_SIZE + 1} delete failed: {status_code}")
-
-            except Exception as e:
-                status = "❌ Error"
-                response_text = str(e)
-                log(f"❌ Exception occurred in batch {i // BATCH_SIZE + 1}: {e}")
-
-            # Update rows for this batch
-            df.loc[batch_indices, "Status"] = status
-            df.loc[batch_indices[0], "Processed_IDs"] = ids_param
-            df.loc[batch_indices[0], "API_Response"] = response_text
-
-            # Live save to output
-            df.to_excel(output_excel_file, index=False)
-            time.sleep(delay_time)
+        def delete_batch(batch):
+            """Runs on a worker thread: the batch's outcomes and the retries they needed."""
+            number, batch_indices = batch
+            log(f"\n🗑️ Deleting batch {number}")
+            # A rejected batch is split until the offending IDs are found; the others are still deleted
+            outcomes = delete_ids(http, api_url, ids, batch_indices, log=log, headers=headers, timeout=60)
+            return outcomes, http.pop_retries()
+
+        def commit(batch, result):
+            number, batch_indices = batch
+            outcomes, retries = result
+            failed = write_outcomes(df, outcomes, ids, "Processed_IDs", "API_Response")
+            if failed:
+                log(f"❌ Batch {number}: {failed} of {len(batch_indices)} IDs could not be deleted")
+            else:
+                log(f"✅ Batch {number} deleted successfully")
+            df.loc[batch_indices[0], "Retries"] = retries
+
+            results.record_frame(df.loc[batch_indices], ["Status", "Processed_IDs", "API_Response", "Retries"])
+
+        # Several batches are sent at once; their results are committed in batch order
+        log(f"📦 Sending up to {in_flight} batches at a time")
+        dispatch(enumerate(chunks(valid_indices, BATCH_SIZE), 1), delete_batch, commit, in_flight)
+
+        write_table(df, output_excel_file)
+        results.close()
 
         log(f"\n🎯 Process completed. Output saved to: {output_excel_file}")
 
@@ -7,16 +7,18 @@ Inputs:
 Excel file with a 'user_id' column.
 """
 
-import pandas as pd
-import requests
-import time
+from app.core import preflight
+from app.core.batches import delete_ids, dispatch, in_flight_from, write_outcomes
+from app.core.http import HttpClient
+from app.core.results import ResultLog
+from app.core.tables import read_table, write_table
 
 # =========================
 # CONFIGURATION
 # =========================
 DEFAULT_API_URL = "https://cloud.cropin.in/services/user/api/users/bulk"
 BATCH_SIZE = 50
-DELAY_SECONDS = 5 # Delay between batches to avoid rate limiting
+RATE_LIMIT = 0.5  # batch requests per second
 
 def run(input_excel, output_excel, config, log_callback=None):
     """
@@ -32,6 +34,9 @@ def run(input_excel, output_excel, config, log_callback=None):
         log("❌ Error: Authorization token missing in configuration.")
         return
 
+    in_flight = in_flight_from(config)
+    http = HttpClient(config, concurrency=in_flight, rate_limit=RATE_LIMIT)
+
     # Determine API URL
     api_url = config.get("url")
     if not api_url:
@@ -41,13 +46,12 @@ def run(input_excel, output_excel, config, log_callback=None):
         log(f"ℹ️ Using configured API URL: {api_url}")
 
     headers = {
-        "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
     }
 
     log(f"Reading input file: {input_excel}")
     try:
-        df = pd.read_excel(input_excel)
+        df = read_table(input_excel)
     except Exception as e:
          log(f"❌ Failed to read Excel file: {e}")
          return
@@ -56,12 +60,8 @@ def run(input_excel, output_excel, config, log_callback=None):
         log("❌ Excel must contain 'user_id' column")
         return
 
-    # Clean IDs
-    try:
-        df["user_id"] = df["user_id"].dropna().astype(int).astype(str)
-    except Exception as e:
-        log(f"❌ Error converting user_id to integer/string: {e}")
-        return
+    # Clean IDs (123.0 -> "123"); rows without one are not sent
+    ids = preflight.ids(df["user_id"])
 
     # Add result columns
     for col in ["Status", "Processed_User_Ids", "API_Response"]:
@@ -72,50 +72,48 @@ def run(input_excel, output_excel, config, log_callback=None):
     total = len(df)
     log(f"Total rows to process: {total}")
 
-    for i in range(0, total, BATCH_SIZE):
-        batch_df = df.iloc[i:i + BATCH_SIZE]
-        user_ids = batch_df["user_id"].tolist()
-        
-        if not user_ids:
-            continue
+    # Results are appended per batch; the output file is written once at the end
+    results = ResultLog(output_excel, input_excel, resume=config.get("resume"), job=config.get("client_id"))
+    done = results.restore(df)
+    if done:
+        log(f"⏭️ Resuming: {len(done)} users were already disabled and are skipped")
 
-        ids_param = ",".join(user_ids)
-        batch_num = (i // BATCH_SIZE) + 1
+    batches = []
+    for i in range(0, total, BATCH_SIZE):
+        rows = [index for index in df.index[i:i + BATCH_SIZE] if ids[index] and index not in done]
+        if rows:
+            batches.append(((i // BATCH_SIZE) + 1, i, rows))
 
+    def disable_batch(batch):
+        """Runs on a worker thread: the batch's outcomes and the retries they needed."""
+        batch_num, i, rows = batch
         log(f"🔁 Processing Batch {batch_num} (Rows {i+2} to {min(i+BATCH_SIZE+1, total+1)})")
-        log(f"👥 User IDs count: {len(user_ids)}")
-
-        try:
-            response = requests.delete(
-                f"{api_url}?ids={ids_param}&enabled=false",
-                headers=headers,
-                timeout=30
-            )
-
-            status = "Success" if response.status_code in (200, 204) else f"Failed ({response.status_code})"
-            response_text = response.text
-            
-            if status == "Success":
-                 log(f"✅ Batch {batch_num} Successful")
-            else:
-                 log(f"❌ Batch {batch_num} Failed: {response.status_code} - {response.text}")
-
-        except Exception as e:
-            status = "Error"
-            response_text = str(e)
-            log(f"❌ Batch {batch_num} Exception: {e}")
-
-        # Write result only in first row of batch
-        first_index = batch_df.index[0]
-        df.at[first_index, "Status"] = status
-        df.at[first_index, "Processed_User_Ids"] = ids_param
-        df.at[first_index, "API_Response"] = response_text
-        
-        time.sleep(DELAY_SECONDS)
+        log(f"👥 User IDs count: {len(rows)}")
+        # A rejected batch is split until the offending IDs are found; the other users are still disabled
+        outcomes = delete_ids(http, api_url, ids, rows, params={"enabled": "false"}, log=log,
+                              headers=headers, timeout=30)
+        return outcomes, http.pop_retries()
+
+    def commit(batch, result):
+        batch_num, _, rows = batch
+        outcomes, retries = result
+        failed = write_outcomes(df, outcomes, ids, "Processed_User_Ids", "API_Response",
+                                success="Success", failed="Failed", error="Error")
+        if failed:
+            log(f"❌ Batch {batch_num}: {failed} of {len(rows)} users could not be disabled")
+        else:
+            log(f"✅ Batch {batch_num} Successful")
+        df.at[rows[0], "Retries"] = retries
+        results.record_frame(df.loc[rows], ["Status", "Processed_User_Ids", "API_Response", "Retries"])
+
+    # Several batches are sent at once; their results are committed in batch order
+    log(f"📦 Sending up to {in_flight} batches at a time")
+    dispatch(batches, disable_batch, commit, in_flight)
 
     log("Saving output file...")
     try:
-        df.to_excel(output_excel, index=False)
+        write_table(df, output_excel)
+        results.close()
         log("✅ Process completed successfully.")
     except Exception as e:
         log(f"❌ Failed to save output file: {e}")
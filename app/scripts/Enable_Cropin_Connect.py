@@ -1,24 +1,26 @@
 # Author: Rajasekhar Palleti
-# Script: Cropin Connect (AcreSquare) Enablement – Batch of 100 with UserRole validation
+# Script: Cropin Connect (AcreSquare) Enablement – Batches of 100 per UserRole
 
 """
 This script enables Cropin Connect (AcreSquare) for farmers in batches of 100.
-It validates that each batch belongs to the same User Role ID before processing.
+Farmers are grouped by User Role ID and each batch holds farmers of one role,
+whatever the order of the sheet.
 Inputs:
 Excel file with 'farmer_id' and 'userRoleId' columns.
 """
 
-import pandas as pd
-import requests
-import time
-import os
+from app.core import preflight
+from app.core.batches import chunks, dispatch, in_flight_from
+from app.core.http import HttpClient
+from app.core.results import ResultLog
+from app.core.tables import read_table, write_table
 
 # =========================
 # CONFIG
 # =========================
 API_URL = "https://cloud.cropin.in/services/farm/api/acresquare/farmers-enable"
 BATCH_SIZE = 100
-DELAY = 5  # seconds
+RATE_LIMIT = 0.5  # batch requests per second
 
 def run(input_excel, output_excel, config, log_callback=None):
     """
@@ -34,14 +36,16 @@ def run(input_excel, output_excel, config, log_callback=None):
         log("❌ Error: Authorization token missing in configuration.")
         return
 
+    in_flight = in_flight_from(config)
+    http = HttpClient(config, concurrency=in_flight, rate_limit=RATE_LIMIT)
+
     headers = {
-        "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
     }
 
     log(f"Reading input file: {input_excel}")
     try:
-        df = pd.read_excel(input_excel)
+        df = read_table(input_excel)
     except Exception as e:
          log(f"❌ Failed to read Excel file: {e}")
          return
@@ -62,70 +66,88 @@ def run(input_excel, output_excel, config, log_callback=None):
     total_rows = len(df)
     log(f"Total rows to process: {total_rows}")
 
-    for start in range(0, total_rows, BATCH_SIZE):
-        batch_df = df.iloc[start:start + BATCH_SIZE]
-        batch_index = batch_df.index
+    # Results are appended per batch; the output file is written once at the end
+    results = ResultLog(output_excel, input_excel, resume=config.get("resume"), job=config.get("client_id"))
+    done = results.restore(df)
+    if done:
+        log(f"⏭️ Resuming: {len(done)} farmers were already enabled and are skipped")
+
+    # Determine API URL
+    base_url = config.get("url")
+    if not base_url:
+        base_url = API_URL
+        log("ℹ️ Using default API URL.")
+    else:
+        log(f"ℹ️ Using configured API URL: {base_url}")
+
+    # Rows without a usable farmer or role ID are not sent
+    farmer_ids = preflight.ids(df["farmer_id"])
+    role_ids = preflight.ids(df["userRoleId"])
+    check = preflight.Preflight(df)
+    check.reject(farmer_ids == "", "Missing farmer_id")
+    check.reject(~farmer_ids.str.fullmatch(preflight.INTEGER), "Invalid farmer_id")
+    check.reject(role_ids == "", "Missing userRoleId")
+    check.reject(~role_ids.str.fullmatch(preflight.INTEGER), "Invalid userRoleId")
+    rejected = check.rejected
+    df.loc[rejected.index, "Status"] = "Skipped"
+    df.loc[rejected.index, "Response"] = rejected
+    if check.summary():
+        log(f"⚠️ {check.summary()}")
+        results.record_frame(df.loc[rejected.index], ["Status", "Response"])
+
+    # ---- One stream of full batches per User Role ID, in order of first appearance ----
+    batches = []
+    sent = [index for index in check.clean if index not in done]
+    for user_role_id, group in df.loc[sent].groupby(role_ids[sent].astype(int), sort=False):
+        group_batches = chunks(group.index, BATCH_SIZE)
+        log(f"👥 UserRoleId {user_role_id}: {len(group)} farmers in {len(group_batches)} batches")
+        for number, batch_index in enumerate(group_batches, 1):
+            batches.append((user_role_id, number, len(group_batches), batch_index,
+                            farmer_ids[batch_index].astype(int).tolist()))
+
+    def enable(batch):
+        """Runs on a worker thread: (Status, Response, retries) of the batch."""
+        user_role_id, number, count, _, batch_farmer_ids = batch
+        log(f"🚀 Processing UserRoleId {user_role_id} batch {number}/{count}")
+        log(f"👥 Farmers count: {len(batch_farmer_ids)} | UserRoleId: {user_role_id}")
 
-        # Clean data: drop NaN, convert to int
         try:
-            farmer_ids = batch_df["farmer_id"].dropna().astype(int).tolist()
-            role_ids = batch_df["userRoleId"].dropna().astype(int).unique().tolist()
-        except Exception as e:
-            log(f"❌ Error processing batch starting at row {start}: {e}")
-            continue
-
-        if not farmer_ids:
-            continue
-
-        # ---- Validation: Same User Role ID ----
-        if len(role_ids) != 1:
-            msg = f"❌ Multiple UserRoleIds found in batch starting row {start+2}: {role_ids}. Batch skipped."
-            log(msg)
-            df.loc[batch_index, "Status"] = "Skipped"
-            df.loc[batch_index, "Response"] = msg
-            continue
-
-        user_role_id = role_ids[0]
-        payload = farmer_ids
-
-        # Determine API URL
-        base_url = config.get("url")
-        if not base_url:
-            base_url = API_URL
-            log("ℹ️ Using default API URL.")
-        else:
-            log(f"ℹ️ Using configured API URL: {base_url}")
-
-        log(f"🚀 Processing batch rows {start + 2} to {start + 1 + len(batch_df)}")
-        log(f"👥 Farmers count: {len(farmer_ids)} | UserRoleId: {user_role_id}")
-
-        try:
-            response = requests.post(
+            response = http.post(
                 f"{base_url}?userRoleId={user_role_id}",
                 headers=headers,
-                json=payload,
-                timeout=30
+                json=batch_farmer_ids,
+                timeout=30,
+                idempotent=True  # enabling already enabled farmers changes nothing, so a resend is safe
             )
 
             if response.status_code in [200, 201, 204]:
-                df.loc[batch_index, "Status"] = "Success"
-                df.loc[batch_index, "Response"] = response.text
                 log("✅ Enablement successful")
-            else:
-                df.loc[batch_index, "Status"] = f"Failed ({response.status_code})"
-                df.loc[batch_index, "Response"] = response.text
-                log(f"❌ API Failed: {response.status_code} - {response.text}")
+                return "Success", response.text, http.pop_retries()
+            log(f"❌ API Failed: {response.status_code} - {response.text}")
+            return f"Failed ({response.status_code})", response.text, http.pop_retries()
 
         except Exception as e:
-            df.loc[batch_index, "Status"] = "Error"
-            df.loc[batch_index, "Response"] = str(e)
             log(f"❌ Exception: {e}")
-
-        time.sleep(DELAY)
+            return "Error", str(e), http.pop_retries()
+
+    def commit(batch, result):
+        batch_index = batch[3]
+        status, response_text, retries = result
+        df.loc[batch_index, "Status"] = status
+        df.loc[batch_index, "Response"] = response_text
+        # Retries of the batch's request on its first row only
+        df.loc[batch_index, "Retries"] = 0
+        df.at[batch_index[0], "Retries"] = retries
+        results.record_frame(df.loc[batch_index], ["Status", "Response", "Retries"])
+
+    # Several batches are sent at once; their results are committed in batch order
+    log(f"📦 Sending up to {in_flight} batches at a time")
+    dispatch(batches, enable, commit, in_flight)
 
     log("Saving output file...")
     try:
-        df.to_excel(output_excel, index=False)
+        write_table(df, output_excel)
+        results.close()
         log("✅ Process completed successfully.")
     except Exception as e:
         log(f"❌ Failed to save output file: {e}")
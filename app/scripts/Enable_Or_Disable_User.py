@@ -10,9 +10,12 @@ Required Columns in Excel:
 """
 
 import pandas as pd
-import requests
-import time
-import os
+
+from app.core.http import HttpClient
+from app.core.tables import read_table, write_table
+
+RATE_LIMIT = 5  # requests per second
+
 
 # The 'run' function is the entry point called by the main application
 def run(input_excel_path, output_excel_path, config, log_callback=None):
@@ -37,12 +40,13 @@ def run(input_excel_path, output_excel_path, config, log_callback=None):
          api_base_url = "https://cloud.cropin.in/services/user/api/users"
          log(f"⚠️ API URL not provided. Using default: {api_base_url}")
     token = config.get("token")
+    if not token:
+        log("❌ Error: Authorization token missing in configuration.")
+        return
 
-    # Delay to avoid rate limiting
-    delay_time = 0.2 #To avoid rate limiting
+    http = HttpClient(config, rate_limit=RATE_LIMIT)
 
     headers = {
-        "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
     }
 
@@ -52,7 +56,7 @@ def run(input_excel_path, output_excel_path, config, log_callback=None):
     # We'll use default (first sheet) to be more robust, or "Sheet1".
     # Let's stick to default behavior (first sheet) which is usually what users expect if they just upload a file.
     try:
-        df = pd.read_excel(input_excel_path)
+        df = read_table(input_excel_path)
     except Exception as e:
         log(f"❌ Error reading input file: {e}")
         return
@@ -93,7 +97,7 @@ def run(input_excel_path, output_excel_path, config, log_callback=None):
         log(f"🔄 Processing row {index + 1}/{total_rows} | UserID: {u_id} | enableFlag: {enable_flag_str}")
 
         try:
-            response = requests.put(url, headers=headers)
+            response = http.put(url, headers=headers)
 
             if response.status_code in [200, 204]:
                 df.at[index, "Status"] = "✅ Success"
@@ -109,11 +113,11 @@ def run(input_excel_path, output_excel_path, config, log_callback=None):
             df.at[index, "Response"] = str(e)
             log(f"❌ Exception for User {u_id}: {e}")
 
-        time.sleep(delay_time)
+        df.at[index, "Retries"] = http.pop_retries()
 
     log("💾 Saving output Excel...")
     try:
-        df.to_excel(output_excel_path, index=False)
+        write_table(df, output_excel_path)
         log(f"✅ File saved: {output_excel_path}")
     except Exception as e:
         log(f"❌ Error saving output file: {e}")
@@ -4,10 +4,23 @@ Enables Plot Risk in bulk (batch mode) for multiple areas.
 Inputs:
 Excel file with croppable_area_id. Supports batch processing.
 """
+import collections
+import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import pandas as pd
 import requests
-import time
-import json
+
+from app.core import preflight
+from app.core.batches import BatchController, batch_size_from, in_flight_from
+from app.core.http import HttpClient
+from app.core.results import ResultLog
+from app.core.tables import SheetReader, SheetWriter
+
+RATE_LIMIT = 0.5  # batch requests per second
+BATCH_SIZE = 25  # croppable areas in the first batch; later batches are sized by the controller
+MAX_BATCH_SIZE = 500  # largest batch sent to the plot-risk endpoint
+
 
 def run(input_excel_file, output_excel_file, config, log_callback=None):
     def log(msg):
@@ -24,6 +37,9 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         return
     log("✅ Access token loaded")
 
+    max_in_flight = in_flight_from(config)
+    http = HttpClient(config, concurrency=max_in_flight, rate_limit=RATE_LIMIT)
+
     # =========================
     # API CONFIG
     # =========================
@@ -37,7 +53,6 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         log(f"Using configured URL: {plot_risk_url}")
 
     headers = {
-        "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
     }
 
@@ -46,16 +61,14 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
     # =========================
     log(f"📘 Loading Excel file: {input_excel_file}")
     try:
-        # User requested sheet_name="result". Tying to use it, falling back to 0 if fails?
-        # User requirement seemed specific. Let's try explicit first.
-        try:
-             df = pd.read_excel(input_excel_file, sheet_name="result")
-        except:
-             log("⚠️ Sheet 'result' not found. Loading first sheet.")
-             df = pd.read_excel(input_excel_file)
+        # User requested sheet_name="result"; the workbook is opened once and
+        # the first sheet is used when there is no such sheet.
+        sheet = SheetReader(input_excel_file, sheet_name="result", fallback_to_first=True)
     except Exception as e:
         log(f"❌ Error reading Excel file: {e}")
         return
+    if sheet.name not in (None, "result"):
+        log("⚠️ Sheet 'result' not found. Loading first sheet.")
 
     # =========================
     # ENSURE REQUIRED COLUMNS
@@ -67,103 +80,142 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         "Plot_risk_response"
     ]
 
-    for col in required_columns:
-        if col not in df.columns:
-            df[col] = ""
-        df[col] = df[col].astype(str)
-
-    BATCH_SIZE = 25
+    output_columns = sheet.columns + [col for col in required_columns + ["Retries"] if col not in sheet.columns]
+    writer = SheetWriter(output_excel_file, output_columns)
+    results = ResultLog(output_excel_file, input_excel_file, resume=config.get("resume"), sheet=sheet.name,
+                        job=config.get("client_id"))
+    if results.previous:
+        log(f"⏭️ Resuming: {results.done()} rows already succeeded and are skipped")
 
     # =========================
     # BATCH PROCESSING
     # =========================
-    for start in range(0, len(df), BATCH_SIZE):
-        end = start + BATCH_SIZE
-        batch_df = df.iloc[start:end]
-
-        payload = []
-        index_map = {}
-
-        for index, row in batch_df.iterrows():
-            # Try finding column by name first, else first column
-            if "croppable_area_id" in df.columns:
-                 croppable_area_id = str(row["croppable_area_id"]).strip()
-            # fallback to camelCase if present
-            elif "croppableAreaId" in df.columns:
-                 croppable_area_id = str(row["croppableAreaId"]).strip()
+    # The sheet is read in chunks as rows are needed. Rows are sent in batches
+    # whose size and number in flight the controller adapts to how the API
+    # copes; a chunk is written out once all of its rows are done.
+    controller = BatchController(batch_size_from(config, BATCH_SIZE), max_size=MAX_BATCH_SIZE,
+                                 max_in_flight=max_in_flight, log=log)
+    use_farmer_id = config.get("use_farmer_id", "no") == "yes"
+    chunks_read = iter(sheet.batches())
+    frames = collections.deque()  # [chunk, rows still to finish], in sheet order
+    queue = collections.deque()  # (frame, row, payload item) waiting to be sent
+
+    def read_rows(count):
+        """Reads chunks until `count` rows are waiting to be sent (or the sheet ends)."""
+        while len(queue) < count:
+            batch_df = next(chunks_read, None)
+            if batch_df is None:
+                return
+            for col in required_columns:
+                if col not in batch_df.columns:
+                    batch_df[col] = ""
+                batch_df[col] = batch_df[col].astype(str)
+            done = results.restore(batch_df)
+
+            # Try finding column by name first (or its camelCase variant), else first column
+            if "croppable_area_id" in batch_df.columns:
+                ca_ids = preflight.ids(batch_df["croppable_area_id"])
+            elif "croppableAreaId" in batch_df.columns:
+                ca_ids = preflight.ids(batch_df["croppableAreaId"])
             else:
-                 croppable_area_id = str(row.iloc[0]).strip()
-            
-            # Handle NaN/Empty
-            if not croppable_area_id or croppable_area_id.lower() == 'nan':
-                continue
+                ca_ids = preflight.ids(batch_df.iloc[:, 0])
 
             # Determine Farmer ID based on config and excel
-            farmer_id = None
-            use_farmer_id_config = config.get("use_farmer_id", "no")
-
-            if use_farmer_id_config == "yes":
-                if 'farmer_id' in df.columns:
-                    val = str(row['farmer_id']).strip()
-                    if val and val.lower() != 'nan':
-                        farmer_id = val
-            
-            payload.append({
-                "croppableAreaId": croppable_area_id,
-                "farmerId": farmer_id
-            })
-            index_map[croppable_area_id] = index
-
-        if not payload:
-            continue
-
-        log(f"📡 Sending batch {start + 1} → {min(end, len(df))} (Size: {len(payload)})")
-
+            if use_farmer_id and "farmer_id" in batch_df.columns:
+                farmer_ids = preflight.ids(batch_df["farmer_id"])
+                farmer_ids = farmer_ids.where(farmer_ids != "", None)
+            else:
+                farmer_ids = pd.Series([None] * len(batch_df), index=batch_df.index, dtype=object)
+
+            # Rows without a CA ID are not sent; their status is logged right away
+            check = preflight.Preflight(batch_df)
+            check.reject(ca_ids == "", "Skipped: Empty ID")
+            skipped = check.rejected.drop(list(done), errors="ignore")
+            if not skipped.empty:
+                batch_df.loc[skipped.index, "status"] = skipped
+                batch_df.loc[skipped.index, "Retries"] = 0
+                results.record_frame(batch_df.loc[skipped.index], required_columns + ["Retries"])
+
+            sent = [idx for idx in check.clean if idx not in done]
+            frame = [batch_df, len(sent)]
+            frames.append(frame)
+            for idx in sent:
+                queue.append((frame, idx, {"croppableAreaId": ca_ids[idx], "farmerId": farmer_ids[idx]}))
+
+    def write_finished():
+        while frames and frames[0][1] == 0:
+            writer.write(frames.popleft()[0])
+
+    def send(payload):
+        """Posts one batch (on a worker thread); returns (response JSON, error, latency, retries)."""
         try:
-            response = requests.post(plot_risk_url, headers=headers, json=payload)
+            response = http.post(plot_risk_url, headers=headers, json=payload)
             response.raise_for_status()
-            response_json = response.json()
-
-            # Save full response for all rows in batch
-            for idx in batch_df.index:
-                df.at[idx, "Plot_risk_response"] = json.dumps(response_json)
-
-            sr_plot_details = response_json.get("srPlotDetails", {})
-
-            # Handle each returned CA
-            for ca_id, details in sr_plot_details.items():
-                row_idx = index_map.get(ca_id)
-                if row_idx is None:
+            return response.json(), None, response.elapsed.total_seconds(), http.pop_retries()
+        except requests.exceptions.RequestException as e:
+            latency = e.response.elapsed.total_seconds() if e.response is not None else None
+            return None, e, latency, http.pop_retries()
+
+    def finish(rows, response_json, error, latency, retries):
+        failed = 0
+        if error is not None:
+            log(f"❌ Batch failed: {error}")
+            for frame, idx, _ in rows:
+                frame[0].at[idx, "status"] = "❌ Failed"
+                frame[0].at[idx, "Failed in Response"] = str(error)
+                frame[0].at[idx, "srPlotid"] = "N/A"
+        else:
+            # Map each returned CA back to its rows; IDs not returned failed
+            sr_plot_details = response_json.get("srPlotDetails") or {}
+            for frame, idx, item in rows:
+                batch_df = frame[0]
+                details = sr_plot_details.get(item["croppableAreaId"])
+                if details is None:
+                    batch_df.at[idx, "status"] = "❌ Failed"
+                    batch_df.at[idx, "Failed in Response"] = "No response from API"
+                    batch_df.at[idx, "srPlotid"] = "N/A"
                     continue
-
-                df.at[row_idx, "srPlotid"] = details.get("srPlotId", "N/A")
-
+                batch_df.at[idx, "Plot_risk_response"] = json.dumps(details)
+                batch_df.at[idx, "srPlotid"] = details.get("srPlotId", "N/A")
                 if details.get("status") == "FAILED":
-                    df.at[row_idx, "status"] = "❌ Failed"
-                    df.at[row_idx, "Failed in Response"] = details.get("message", "Failed")
+                    failed += 1
+                    batch_df.at[idx, "status"] = "❌ Failed"
+                    batch_df.at[idx, "Failed in Response"] = details.get("message", "Failed")
                 else:
-                    df.at[row_idx, "status"] = "✅ Success"
-                    df.at[row_idx, "Failed in Response"] = "✅ Success"
-
-            # Handle IDs not returned in response
-            returned_ids = set(sr_plot_details.keys())
-            for ca_id, idx in index_map.items():
-                if ca_id not in returned_ids:
-                    df.at[idx, "status"] = "❌ Failed"
-                    df.at[idx, "Failed in Response"] = "No response from API"
-                    df.at[idx, "srPlotid"] = "N/A"
-
-            log("✅ Batch completed")
-
-        except requests.exceptions.RequestException as e:
-            log(f"❌ Batch failed: {e}")
-            for idx in batch_df.index:
-                df.at[idx, "status"] = "❌ Failed"
-                df.at[idx, "Failed in Response"] = str(e)
-                df.at[idx, "srPlotid"] = "N/A"
-        
-        # User script had specific sleep
-        time.sleep(5)  
+                    batch_df.at[idx, "status"] = "✅ Success"
+                    batch_df.at[idx, "Failed in Response"] = "✅ Success"
+            log(f"✅ Batch of {len(rows)} completed ({failed} FAILED, {latency:.1f}s)")
+
+        # Retries, 429/5xx and dropped connections mean the API is struggling
+        status = error.response.status_code if getattr(error, "response", None) is not None else None
+        throttled = (bool(retries) or status == 429 or (status or 0) >= 500
+                     or isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)))
+        controller.record(len(rows), latency, failed, throttled)
+
+        # The batch's retries are reported on its first row only
+        for n, (frame, idx, _) in enumerate(rows):
+            frame[0].at[idx, "Retries"] = retries if n == 0 else 0
+            results.record(idx, **{col: frame[0].at[idx, col] for col in required_columns + ["Retries"]})
+            frame[1] -= 1
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        in_flight = {}
+        while True:
+            while len(in_flight) < controller.in_flight:
+                read_rows(controller.size)
+                if not queue:
+                    break
+                rows = [queue.popleft() for _ in range(min(controller.size, len(queue)))]
+                log(f"📡 Sending batch {rows[0][1] + 1} → {rows[-1][1] + 1} (Size: {len(rows)})")
+                in_flight[executor.submit(send, [item for _, _, item in rows])] = rows
+            write_finished()
+            if not in_flight:
+                break
+            completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in completed:
+                finish(in_flight.pop(future), *future.result())
+
+    log(f"📏 {controller.report()}")
 
     # =========================
     # SAVE EXCEL
@@ -171,7 +223,8 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
     log("💾 Writing results to Excel...")
     try:
         # Saving to the dedicated output file from the runner framework
-        df.to_excel(output_excel_file, index=False)
+        writer.close()
+        results.close()
         log(f"🎯 Done. Excel updated successfully at: {output_excel_file}")
     except Exception as e:
         log(f"❌ Error saving output: {e}")
@@ -2,13 +2,23 @@
 Enables both Plot Risk and Weather services for croppable areas.
 
 Inputs:
-Excel file with croppable_area_id and optionally farmer_id.
+Excel file with croppable_area_id and optionally farmer_id. The areas are sent
+to both batch endpoints in batches.
 """
-import pandas as pd
-import requests
-import time
 import json
 
+import pandas as pd
+
+from app.core import preflight
+from app.core.batches import batch_size_from, bisect, chunks
+from app.core.http import HttpClient
+from app.core.results import ResultLog
+from app.core.tables import read_table, write_table
+
+RATE_LIMIT = 2  # batch requests per second
+BATCH_SIZE = 100  # croppable areas per request, unless the job sets a batch size
+
+
 def run(input_excel_file, output_excel_file, config, log_callback=None):
     def log(msg):
         if log_callback:
@@ -23,6 +33,8 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         log("❌ Failed to retrieve access token. Process terminated.")
         return
 
+    http = HttpClient(config, rate_limit=RATE_LIMIT)
+
     if not base_url:
         base_url = "https://cloud.cropin.in/services/farm/api/croppable-areas"
         log(f"No API URL provided, using default base: {base_url}")
@@ -33,13 +45,12 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
     sustainability_url = f"{base_url}/sustainability/batch?features=WEATHER"
 
     headers = {
-        "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
     }
 
     log("Reading Excel file...")
     try:
-        df = pd.read_excel(input_excel_file)
+        df = read_table(input_excel_file)
     except Exception as e:
         log(f"Error reading Excel file: {e}")
         return
@@ -51,118 +62,109 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
             df[col] = ""
         df[col] = df[col].astype(str)
 
-    # Function to extract srPlotId
-    def extract_sr_plot_id(response_json):
-        if "srPlotDetails" in response_json:
-            for details in response_json["srPlotDetails"].values():
-                return details.get("srPlotId")
-
-        for key, value in response_json.items():
-            if isinstance(value, list):
-                for item in value:
-                    if "srPlotId" in item:
-                        return item["srPlotId"]
-        return "N/A"
-
-    # Iterate over rows
-    for index, row in df.iterrows():
-        try:
-            # Flexible reading for croppable_area_id
-            if 'croppable_area_id' in df.columns:
-                 croppable_area_id = str(row['croppable_area_id']).strip()
-            else:
-                 croppable_area_id = str(row.iloc[0]).strip()
-            
-            if not croppable_area_id or croppable_area_id.lower() == 'nan':
-                 log(f"Skipping empty row {index + 1}")
-                 continue
-
-            # Determine Farmer ID based on config and excel
-            farmer_id = None
-            use_farmer_id_config = config.get("use_farmer_id", "no")
-            
-            if use_farmer_id_config == "yes":
-                if 'farmer_id' in df.columns:
-                    val = str(row['farmer_id']).strip()
-                    if val and val.lower() != 'nan':
-                        farmer_id = val
-            
-            log(f"🔄 Processing row {index + 1}: CroppableAreaId = {croppable_area_id}, FarmerId = {farmer_id}")
-
-            # Construct payloads
-            plot_risk_payload = [{"croppableAreaId": croppable_area_id, "farmerId": farmer_id}]
-            sustainability_payload = [croppable_area_id]
-
-            # 1. Send Plot Risk API request
-            log(f"📡 Sending Plot Risk API request for CroppableAreaId: {croppable_area_id}")
-            plot_risk_response = None
-            plot_risk_json = {}
-            try:
-                plot_risk_response = requests.post(plot_risk_url, json=plot_risk_payload, headers=headers)
-                plot_risk_response.raise_for_status()
-                plot_risk_json = plot_risk_response.json()
-                
-                df.at[index, "Plot_risk_response"] = json.dumps(plot_risk_json)
-                df.at[index, "srPlotid"] = extract_sr_plot_id(plot_risk_json)
-                log(f"✅ Extracted srPlotId: {df.at[index, 'srPlotid']}")
-            except requests.exceptions.RequestException as req_err:
-                error_message = str(req_err)
-                df.at[index, "Plot_risk_response"] = error_message
-                df.at[index, "srPlotid"] = "N/A"
-                log(f"❌ Plot Risk API request failed: {error_message}")
-                # We define plot_risk_response as mock object with status code 0 if failed, to handle check later
-                class MockResponse:
-                    status_code = 0
-                if plot_risk_response is None: plot_risk_response = MockResponse()
-
-            time.sleep(0.5)
-
-            # 2. Send Weather API request
-            log(f"📡 Sending Weather API request for CroppableAreaId: {croppable_area_id}")
-            sustainability_response = None
-            try:
-                sustainability_response = requests.post(sustainability_url, json=sustainability_payload, headers=headers)
-                sustainability_response.raise_for_status()
-                sustainability_json = sustainability_response.json()
-                df.at[index, "Weather_response"] = json.dumps(sustainability_json)
-            except requests.exceptions.RequestException as req_err:
-                error_message = str(req_err)
-                df.at[index, "Weather_response"] = error_message
-                log(f"❌ Weather API request failed: {error_message}")
-                class MockResponse:
-                    status_code = 0
-                if sustainability_response is None: sustainability_response = MockResponse()
-
-            # Update status column based on BOTH calls
-            if (plot_risk_response.status_code == 200 and sustainability_response.status_code == 200):
-                df.at[index, "status"] = "✅ Success"
-            else:
-                df.at[index, "status"] = "❌ Failed"
-
-            # Check if Failed in response of plotrisk API
-            sr_plot_details = plot_risk_json.get("srPlotDetails", {})
-            failed_found = False
-            for key, value in sr_plot_details.items():
-                if value.get("status") == "FAILED":
-                    failed_found = True
-                    msg = value.get('message', 'No message provided')
-                    log(f"❌ Status for {key}: {value['status']} - {msg}")
+    # Results are appended per batch; the output file is written once at the end
+    results = ResultLog(output_excel_file, input_excel_file, resume=config.get("resume"),
+                        job=config.get("client_id"))
+    done = results.restore(df)
+    if done:
+        log(f"⏭️ Resuming: {len(done)} croppable areas already enabled and are skipped")
+
+    # Flexible reading for croppable_area_id
+    if 'croppable_area_id' in df.columns:
+        ca_ids = preflight.ids(df['croppable_area_id'])
+    else:
+        ca_ids = preflight.ids(df.iloc[:, 0])
+
+    # Determine Farmer ID based on config and excel
+    if config.get("use_farmer_id", "no") == "yes" and 'farmer_id' in df.columns:
+        farmer_ids = preflight.ids(df['farmer_id'])
+        farmer_ids = farmer_ids.where(farmer_ids != "", None)
+    else:
+        farmer_ids = pd.Series([None] * len(df), index=df.index, dtype=object)
+
+    check = preflight.Preflight(df)
+    check.reject(ca_ids == "", "Skipped: Empty ID")
+    df.loc[check.rejected.index, "status"] = check.rejected
+    if not check.rejected.empty:
+        log(check.summary())
+        results.record_frame(df.loc[check.rejected.index], ["status"])
+
+    def send_plot_risk(rows):
+        payload = [{"croppableAreaId": ca_ids[index], "farmerId": farmer_ids[index]} for index in rows]
+        response = http.post(plot_risk_url, json=payload, headers=headers)
+        response.raise_for_status()
+        return response.json()
+
+    def send_weather(rows):
+        response = http.post(sustainability_url, json=[ca_ids[index] for index in rows], headers=headers)
+        response.raise_for_status()
+        return response.json()
+
+    # Both services take the croppable areas in batches; a rejected batch is split to find the bad IDs
+    batch_size = batch_size_from(config, BATCH_SIZE)
+    sent = [index for index in check.clean if index not in done]
+    batches = chunks(sent, batch_size)
+    log(f"🔄 Enabling Plot Risk and Weather for {len(sent)} croppable areas in {len(batches)} batches of up to {batch_size}")
+
+    for number, batch in enumerate(batches, 1):
+        enabled = set()  # rows both services accepted
+
+        # 1. Plot Risk
+        log(f"📡 Sending Plot Risk batch {number}/{len(batches)} (Size: {len(batch)})")
+        for rows, plot_risk_json, error in bisect(batch, send_plot_risk, log=log):
+            if error is not None:
+                log(f"❌ Plot Risk API request failed for {len(rows)} croppable areas: {error}")
+                df.loc[rows, "Plot_risk_response"] = str(error)
+                df.loc[rows, "srPlotid"] = "N/A"
+                continue
+
+            # Map the per-ID details back to the rows
+            sr_plot_details = plot_risk_json.get("srPlotDetails") or {}
+            for index in rows:
+                details = sr_plot_details.get(ca_ids[index])
+                if details is None:
+                    df.at[index, "srPlotid"] = "N/A"
+                    df.at[index, "Failed in Response"] = "No response from API"
+                    continue
+                df.at[index, "Plot_risk_response"] = json.dumps(details)
+                df.at[index, "srPlotid"] = details.get("srPlotId", "N/A")
+                if details.get("status") == "FAILED":
+                    msg = details.get('message', 'No message provided')
+                    log(f"❌ Status for {ca_ids[index]}: {details['status']} - {msg}")
                     df.at[index, "Failed in Response"] = f"❌ Failed: {msg}"
-            
-            if not failed_found:
-                df.at[index, "Failed in Response"] = "✅ Success"
-
-        except Exception as e:
-            error_message = str(e)
-            df.at[index, "status"] = f"⚠️ Error: {error_message}"
-            log(f"⚠️ Error in row {index + 1}: {error_message}")
+                else:
+                    enabled.add(index)
+                    df.at[index, "Failed in Response"] = "✅ Success"
+
+        # 2. Weather
+        log(f"📡 Sending Weather batch {number}/{len(batches)} (Size: {len(batch)})")
+        for rows, weather_json, error in bisect(batch, send_weather, log=log):
+            if error is not None:
+                log(f"❌ Weather API request failed for {len(rows)} croppable areas: {error}")
+                df.loc[rows, "Weather_response"] = str(error)
+                enabled.difference_update(rows)
+                continue
+            if isinstance(weather_json, dict) and all(ca_ids[index] in weather_json for index in rows):
+                # Keyed by ID: each area keeps its own entry
+                for index in rows:
+                    df.at[index, "Weather_response"] = json.dumps(weather_json[ca_ids[index]])
+            else:
+                # One response for the whole request: stored once, on its first row
+                df.loc[rows, "Weather_response"] = "✅ Enabled"
+                df.at[rows[0], "Weather_response"] = json.dumps(weather_json)
 
-        time.sleep(2)
+        # Update status column based on BOTH calls
+        for index in batch:
+            df.at[index, "status"] = "✅ Success" if index in enabled else "❌ Failed"
+        # Retries of the batch's requests (including split ones), on its first row
+        df.at[batch[0], "Retries"] = http.pop_retries()
+        results.record_frame(df.loc[batch], columns_to_check + ["Retries"])
 
     # Save output
     log("🎯 Processing completed. Saving output file...")
     try:
-        df.to_excel(output_excel_file, index=False)
+        write_table(df, output_excel_file)
+        results.close()
         log("File saved successfully.")
     except Exception as e:
         log(f"Error saving file: {e}")
@@ -4,24 +4,22 @@ Triggers a refresh of crop plans by fetching and re-submitting data.
 Inputs:
 Excel file with 'ca_id' column.
 """
-# ca_id is read from an Excel file. Each ca_id is processed using GET and PUT APIs with retries.
+# ca_id is read from an Excel file. Each ca_id is processed using GET and PUT APIs (retried by HttpClient).
 # The results are saved back to a new Excel file.
 
 import pandas as pd
-import requests
 import json
 import time
 import traceback
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-MAX_RETRIES = 1  # Number of retries for GET/PUT
-TIME_OUT = 5  # seconds
+from app.core.http import HttpClient
+from app.core.tables import read_table, write_table
 
-MAX_RETRIES = 1  # Number of retries for GET/PUT
 TIME_OUT = 5  # seconds
 
-WAIT_TIME = 1  # seconds between PUT calls
+RATE_LIMIT = 8  # requests per second, shared by all threads
 MAX_WORKERS = 4  # number of threads
 # =================================================
 
@@ -36,6 +34,8 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         log("❌ No token provided in configuration.")
         return
 
+    http = HttpClient(config, concurrency=MAX_WORKERS, rate_limit=RATE_LIMIT)
+
     # Derive URLs from config
     # Default Base: https://cloud.cropin.in/services/farm/api/croppable-areas/
     base_url = config.get("post_api_url", "").strip().rstrip('/')
@@ -60,37 +60,28 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
 
     log(f"🔗 Configuration:\n   GET Base: {get_url_template}<ID>\n   PUT URL:  {put_url}")
 
-    def request_with_retry(method, url, headers=None, data=None, timeout=TIME_OUT, retries=MAX_RETRIES):
+    def send(method, url, headers=None, data=None):
         """
-        Generic request with retry mechanism.
+        Sends one request; HttpClient already retried transient failures.
+        Returns the response on 200/201, otherwise logs the failure and returns None.
         """
-        for attempt in range(1, retries + 1):
-            try:
-                if method.upper() == "GET":
-                    resp = requests.get(url, headers=headers, timeout=timeout)
-                elif method.upper() == "PUT":
-                    resp = requests.put(url, headers=headers, data=data, timeout=timeout)
-                else:
-                    raise ValueError("Unsupported HTTP method")
-
-                if resp.status_code in [200, 201]:
-                    return resp
-                else:
-                    log(f"⚠️ Attempt {attempt} failed for URL: {url} | Status Code: {resp.status_code}")
-            except Exception as e:
-                log(f"⚠️ Attempt {attempt} exception for URL: {url} | {e}")
-            time.sleep(1)  # wait 1 second before retry
+        try:
+            resp = http.request(method, url, headers=headers, data=data, timeout=TIME_OUT)
+            if resp.status_code in [200, 201]:
+                return resp
+            log(f"⚠️ Request failed for URL: {url} | Status Code: {resp.status_code}")
+        except Exception as e:
+            log(f"⚠️ Request exception for URL: {url} | {e}")
         return None
 
 
-    def process_croppable_area(ca_id, token, row_number=None):
+    def process_croppable_area(ca_id, row_number=None):
         """
         Fetch croppable area data using GET API and send it to the PUT API.
         Accepts an optional row_number to indicate which Excel row is being processed.
-        Returns a dict with CA_id, row_number, status, response, and timestamps.
+        Returns a dict with CA_id, row_number, status, response, retries, and timestamps.
         """
         headers = {
-            "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
         }
 
@@ -101,9 +92,9 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         log(f"🟢 Started processing CA_id: {ca_id} at {start_time} | Row: {row_number}")
 
         try:
-            # Step 1️⃣: GET croppable area data with retries
+            # Step 1️⃣: GET croppable area data
             get_url = f"{get_url_template}{ca_id}"
-            get_resp = request_with_retry("GET", get_url, headers=headers)
+            get_resp = send("GET", get_url, headers=headers)
 
             if not get_resp:
                 end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -113,7 +104,8 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
                     "ca_id": ca_id,
                     "row_number": row_number,
                     "status": "Failed",
-                    "response": f"GET failed after {MAX_RETRIES} attempts",
+                    "response": "GET failed",
+                    "retries": http.pop_retries(),
                     "start_time": start_time,
                     "end_time": end_time,
                     "duration_seconds": duration
@@ -121,17 +113,16 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
 
             ca_data = get_resp.json()
 
-            # Step 2️⃣: Wait before PUT call
-            time.sleep(WAIT_TIME)
-
             log(f"🟡 Sending PUT request for CA_id: {ca_id}...")
 
-            # Step 3️⃣: PUT API call with retries
+            # Step 2️⃣: PUT API call
             # put_url is from outer scope (run function)
-            put_resp = request_with_retry("PUT", put_url, headers=headers, data=json.dumps(ca_data))
+            # The entity goes back unchanged on purpose: the PUT itself is what
+            # triggers the plan refresh, so this script never skips it as "Unchanged".
+            put_resp = send("PUT", put_url, headers=headers, data=json.dumps(ca_data))
 
             end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            duration = round((time.time()-WAIT_TIME) - start_ts, 2)
+            duration = round(time.time() - start_ts, 2)
 
             if put_resp:
                 log(f"✅ Completed CA_id: {ca_id} | Status: Success | Duration: {duration}s")
@@ -140,6 +131,7 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
                     "row_number": row_number,
                     "status": "Success",
                     "response": put_resp.text,
+                    "retries": http.pop_retries(),
                     "start_time": start_time,
                     "end_time": end_time,
                     "duration_seconds": duration
@@ -150,7 +142,8 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
                     "ca_id": ca_id,
                     "row_number": row_number,
                     "status": "Failed",
-                    "response": f"PUT failed after {MAX_RETRIES} attempts",
+                    "response": "PUT failed",
+                    "retries": http.pop_retries(),
                     "start_time": start_time,
                     "end_time": end_time,
                     "duration_seconds": duration
@@ -159,13 +152,14 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         except Exception as e:
             traceback.print_exc()
             end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            duration = round((time.time()-WAIT_TIME) - start_ts, 2)
+            duration = round(time.time() - start_ts, 2)
             log(f"⚠️ Error processing CA_id: {ca_id} | Duration: {duration}s")
             return {
                 "ca_id": ca_id,
                 "row_number": row_number,
                 "status": "Failed",
                 "response": str(e),
+                "retries": http.pop_retries(),
                 "start_time": start_time,
                 "end_time": end_time,
                 "duration_seconds": duration
@@ -174,7 +168,7 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
 
     log("📘 Loading Excel file...")
     try:
-        df = pd.read_excel(input_excel_file)
+        df = read_table(input_excel_file)
     except Exception as e:
         log(f"Error reading Excel file: {e}")
         return
@@ -189,7 +183,7 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         # Pass the Excel row number (1-based) to the worker so it can print it.
         futures = {
-            executor.submit(process_croppable_area, ca_id, token, idx): ca_id
+            executor.submit(process_croppable_area, ca_id, idx): ca_id
             for idx, ca_id in enumerate(df["ca_id"], start=1)
         }
 
@@ -207,7 +201,7 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
     df = df.merge(results_df, how="left", on="ca_id")
 
     try:
-        df.to_excel(output_excel_file, index=False)
+        write_table(df, output_excel_file)
         log(f"📁 Execution complete. Output saved to: {output_excel_file}")
     except Exception as e:
         log(f"Error saving output file: {e}")
@@ -9,9 +9,13 @@ Excel file with:
 - split_count (Column 4)
 """
 import pandas as pd
-import requests
-import time
-import json
+
+from app.core.http import HttpClient
+from app.core.results import ResultLog
+from app.core.tables import read_table, write_table
+
+RATE_LIMIT = 1  # requests per second
+
 
 def run(input_excel_file, output_excel_file, config, log_callback=None):
     def log(msg):
@@ -28,6 +32,8 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         return
     log("✅ Access token loaded")
 
+    http = HttpClient(config, rate_limit=RATE_LIMIT)
+
     # =========================
     # API CONFIG
     # =========================
@@ -41,7 +47,6 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
         log(f"Using configured URL: {base_api_url}")
 
     headers = {
-        "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
     }
 
@@ -50,7 +55,7 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
     # =========================
     log(f"📘 Loading Excel file: {input_excel_file}")
     try:
-        df = pd.read_excel(input_excel_file)
+        df = read_table(input_excel_file)
     except Exception as e:
         log(f"❌ Error reading Excel file: {e}")
         return
@@ -61,10 +66,19 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
     if "Response" not in df.columns:
         df["Response"] = ""
 
+    # Splits are POSTs: on resume, areas that were already split are not split again
+    results = ResultLog(output_excel_file, input_excel_file, resume=config.get("resume"),
+                        job=config.get("client_id"))
+    done = results.restore(df)
+    if done:
+        log(f"⏭️ Resuming: {len(done)} areas were already split and are skipped")
+
     # =========================
     # PROCESS ROWS
     # =========================
     for i in range(len(df)):
+        if i in done:
+            continue
         try:
             # Using iloc as per user's original script requirement
             # Column 1 -> Index 0: croppable_area_id
@@ -135,7 +149,7 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
             log(f"➡ Processing Row {i+2} | Project {project_id}, CA {croppable_area_id}, Splits {split_count}")
             
             # API call
-            response = requests.post(url, json=payload, headers=headers)
+            response = http.post(url, json=payload, headers=headers)
             
             if response.status_code == 200:
                 log(f"✅ Successfully split CA {croppable_area_id}")
@@ -146,19 +160,21 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
                 df.at[i, "status"] = "❌ Failed"
                 df.at[i, "Response"] = f"{response.status_code} - {response.text}"
                 
-            time.sleep(2) # Reduced sleep a bit from 10s to 2s for efficiency, user can adjust if strictly needed.
-
         except Exception as e:
             log(f"❌ Error processing row {i+2}: {e}")
             df.at[i, "status"] = "❌ Error"
             df.at[i, "Response"] = str(e)
+        finally:
+            df.at[i, "Retries"] = http.pop_retries()
+            results.record_frame(df.loc[[i]], ["status", "Response", "Retries"])
 
     # =========================
     # SAVE EXCEL
     # =========================
     log("💾 Writing results to Excel...")
     try:
-        df.to_excel(output_excel_file, index=False)
+        write_table(df, output_excel_file)
+        results.close()
         log(f"🎯 Done. Excel updated successfully at: {output_excel_file}")
     except Exception as e:
         log(f"❌ Error saving output: {e}")
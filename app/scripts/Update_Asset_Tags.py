@@ -6,129 +6,58 @@ Inputs:
 Excel file with 'asset_id' and 'tags' (list or comma-separated).
 """
 
-import json
-import requests
-import time
 import pandas as pd
-
-from concurrent.futures import ThreadPoolExecutor
 import ast
 
-def process_chunk(df_chunk, api_url, token, thread_id, log_callback=None, timeout=30):
-    
-    def log(msg):
-        if log_callback:
-            log_callback(msg)
-        else:
-            print(msg)
-
-    headers = {"Authorization": f"Bearer {token}"}
-    results = []
+from app.core import preflight
+from app.core.engine import SkipRow, concurrency_from, get_modify_put
+from app.core.results import ResultLog
+from app.core.tables import read_table, write_table
 
-    for index, row in df_chunk.iterrows():
-        # log(f"[Thread {thread_id}] Processing row index: {index}") # Optional verbose log
+RATE_LIMIT = 100  # requests per second
 
-        try:
-            asset_id = row.iloc[0]  # Column A: Asset ID
-            raw_tags = row.iloc[2]  # Column C: Tags, Example: " [1, 2, 3] "
-        except IndexError:
-             status = "Skipped: Row missing columns"
-             results.append((index, status, "IndexError"))
-             continue
-
-        status = ""
-        response_str = ""
-
-        # Convert string to actual list
-        asset_tags = []
-        if pd.isna(raw_tags):
-             asset_tags = [] # Or skip? User code didn't explicitly handle NaN tags well, but ast.literal_eval on NaN might fail.
-        elif isinstance(raw_tags, str):
-            try:
-                asset_tags = ast.literal_eval(raw_tags.strip())
-            except Exception:
-                asset_tags = [] # Fallback
-        else:
-            # If it's already a list or number (pandas sometimes infers)
-            if isinstance(raw_tags, list):
-                asset_tags = raw_tags
-            else:
-                 # Try wrapping single value? User code: asset_tags = raw_tags
-                 asset_tags = raw_tags
-
-        if pd.isna(asset_id):
-            status = "Skipped: Missing Asset ID"
-            results.append((index, status, response_str))
-            continue
 
+def parse_asset_tags(raw_tags):
+    """Converts the tags cell (e.g. " [1, 2, 3] ") to a list."""
+    if pd.isna(raw_tags):
+        return [] # Or skip? User code didn't explicitly handle NaN tags well, but ast.literal_eval on NaN might fail.
+    if isinstance(raw_tags, str):
         try:
-            # log(f"[Thread {thread_id}] Getting asset for: {asset_id}")
-            get_response = requests.get(f"{api_url}/{asset_id}", headers=headers, timeout=timeout)
-            get_response.raise_for_status()
-            asset_data = get_response.json()
-
-            if "data" in asset_data and isinstance(asset_data["data"], dict):
-                existing_tags = asset_data["data"].get("tags", [])
-                if existing_tags is None:
-                    existing_tags = []
-                
-                # Merge logic: Append new tags if they don't exist
-                # Logic: Keep all existing, add new ones unique
-                # Assuming simple scalars (int/str) or check equality
-                
-                # Normalize types to avoid duplicates like "123" vs 123 if needed
-                # But assets tags can be whatever. Let's assume standard equality check.
-                
-                updated_tags = list(existing_tags)
-                to_add = []
-                for tag in asset_tags:
-                    if tag not in existing_tags:
-                        to_add.append(tag)
-                        updated_tags.append(tag)
-                
-                if not to_add:
-                    status = "Skipped: All IDs already present"
-                    results.append((index, status, response_str))
-                    continue
-
-                asset_data["data"]["tags"] = updated_tags
-            else:
-                status = "Failed: No data property in response"
-                results.append((index, status, response_str))
-                continue
-
-            time.sleep(0.2)
-
-            multipart_data = {
-                "dto": (None, json.dumps(asset_data), "application/json")
-            }
-
-            # PUT to base URL as per user code: requests.put(api_url, ...)
-            # This implies api_url is the collection resource, and the DTO contains the ID or the update is handled via DTO.
-            # In user code: requests.put(api_url, ...)
-            put_response = requests.put(api_url, headers=headers, files=multipart_data, timeout=timeout)
-            
-            if put_response.status_code in [200, 201, 204]:
-                status = "Success"
-                response_str = put_response.text[:500]
-                log(f"[Thread {thread_id}] Updated Asset {asset_id}")
-            else:
-                status = f"Failed: {put_response.status_code}"
-                response_str = put_response.text[:500]
-                log(f"[Thread {thread_id}] Failed to update Asset {asset_id}: {put_response.status_code}")
-
-        except requests.exceptions.RequestException as e:
-            status = f"Failed: {str(e)}"
-            if hasattr(e, 'response') and e.response is not None:
-                response_str = f"{e.response.status_code} - {e.response.text}"
-            else:
-                response_str = str(e)
-            log(f"[Thread {thread_id}] Error for asset {asset_id}: {response_str[:100]}")
-
-        time.sleep(0.2)
-        results.append((index, status, response_str))
-
-    return results
+            return ast.literal_eval(raw_tags.strip())
+        except Exception:
+            return [] # Fallback
+    # If it's already a list or number (pandas sometimes infers)
+    # Try wrapping single value? User code: asset_tags = raw_tags
+    return raw_tags
+
+def add_tags(asset_data, asset_tags):
+    """Appends the new tags to the asset JSON; raises SkipRow when there is nothing to PUT."""
+    if "data" not in asset_data or not isinstance(asset_data["data"], dict):
+        raise SkipRow("Failed: No data property in response")
+
+    existing_tags = asset_data["data"].get("tags", [])
+    if existing_tags is None:
+        existing_tags = []
+
+    # Merge logic: Append new tags if they don't exist
+    # Logic: Keep all existing, add new ones unique
+    # Assuming simple scalars (int/str) or check equality
+
+    # Normalize types to avoid duplicates like "123" vs 123 if needed
+    # But assets tags can be whatever. Let's assume standard equality check.
+
+    updated_tags = list(existing_tags)
+    to_add = []
+    for tag in asset_tags:
+        if tag not in existing_tags:
+            to_add.append(tag)
+            updated_tags.append(tag)
+
+    if not to_add:
+        raise SkipRow("Skipped: All IDs already present")
+
+    asset_data["data"]["tags"] = updated_tags
+    return asset_data
 
 def run(input_excel_file, output_excel_file, config, log_callback=None):
     
@@ -150,7 +79,7 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
 
     log(f"Reading input file: {input_excel_file}")
     try:
-        df = pd.read_excel(input_excel_file)
+        df = read_table(input_excel_file)
     except Exception as e:
         log(f"Failed to read Excel: {e}")
         return
@@ -162,43 +91,64 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
 
     n = len(df)
     log(f"Total rows to process: {n}")
-    
-    # Split into maximum 4 chunks (User used 2, but 4 is generally fine, let's stick to user preference if desired, but 4 is safe)
-    max_workers = 4
-    chunk_size = (n + max_workers - 1) // max_workers # ceiling division
-    
-    chunks = []
-    # If n=0, this loop won't run, check n>0
-    if n > 0:
-        for i in range(0, n, chunk_size):
-            chunks.append(df.iloc[i:i + chunk_size])
-    else:
+
+    if n == 0:
         log("No data to process.")
-        df.to_excel(output_excel, index=False)
+        write_table(df, output_excel_file)
         return
 
-    # Adjust workers
-    workers = min(len(chunks), max_workers)
-    
-    log(f"Starting execution with {workers} threads...")
-
-    all_results = []
-    with ThreadPoolExecutor(max_workers=workers) as ex:
-        futures = []
-        for i, chunk in enumerate(chunks):
-            futures.append(ex.submit(process_chunk, chunk, api_url, token, i+1, log_callback))
-        
-        for f in futures:
-            try:
-                all_results.extend(f.result())
-            except Exception as e:
-                log(f"Thread failed: {e}")
+    # Each row's result is appended as it finishes; the output file is written once at the end
+    results = ResultLog(output_excel_file, input_excel_file, resume=config.get("resume"),
+                        job=config.get("client_id"))
+    done = results.restore(df)
+    if done:
+        log(f"⏭️ Resuming: {len(done)} rows already succeeded and are skipped")
+
+    check = preflight.Preflight(df)
+    if len(df.columns) < 3:
+        check.reject(True, "Skipped: Row missing columns")
+        asset_ids = asset_tags = None
+    else:
+        asset_ids = preflight.ids(df.iloc[:, 0])  # Column A: Asset ID
+        # Column C: Tags, Example: " [1, 2, 3] "; a single tag (5 or "5") becomes [5]
+        asset_tags = df.iloc[:, 2].map(parse_asset_tags)
+        asset_tags = asset_tags.map(lambda tags: list(tags) if isinstance(tags, (list, tuple)) else [tags])
+        check.reject(asset_ids == "", "Skipped: Missing Asset ID")
+        check.reject(asset_tags.str.len() == 0, "Skipped: No tags to add")
+
+    rejected = check.rejected.drop(list(done), errors="ignore")
+    df.loc[rejected.index, "Status"] = rejected
+    df.loc[rejected.index, "Retries"] = 0
+    if not rejected.empty:
+        log(check.summary())
+        results.record_frame(df.loc[rejected.index], ["Status", "Retries"])
+
+    items = [(index, asset_ids[index], asset_tags[index]) for index in check.clean if index not in done]
+
+    concurrency = concurrency_from(config)
+    log(f"Starting execution with up to {concurrency} requests in flight...")
+
+    # PUT to base URL as per user code: requests.put(api_url, ...)
+    # This implies api_url is the collection resource, and the DTO contains the ID or the update is handled via DTO.
+    outcomes = get_modify_put(
+        items,
+        get_url=lambda asset_id: f"{api_url}/{asset_id}",
+        put_url=api_url,
+        modify=add_tags,
+        config=config,
+        concurrency=concurrency,
+        rate_limit=RATE_LIMIT,
+        log=log,
+        on_result=lambda idx, status, resp, retries: results.record(idx, Status=status, Response=resp, Retries=retries),
+    )
 
     # Apply results
-    for idx, status, resp in all_results:
+    for idx, status, resp, retries in outcomes:
         df.at[idx, "Status"] = status
         df.at[idx, "Response"] = resp
+        df.at[idx, "Retries"] = retries
 
     log(f"Saving output to {output_excel_file}")
-    df.to_excel(output_excel_file, index=False)
+    write_table(df, output_excel_file)
+    results.close()
     log("Task Completed.")
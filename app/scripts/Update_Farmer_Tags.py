@@ -6,138 +6,36 @@ Inputs:
 Excel file with 'farmer_id' and 'tags' (comma-separated IDs).
 """
 
-import json
-import requests
-import time
-import pandas as pd
-
-from concurrent.futures import ThreadPoolExecutor
-
-def parse_comma_ids(cell):
-    """
-    Accept input formats like:
-      "121,122" or "121"
-    Returns list of ints. Empty list for NaN/empty.
-    """
-    if pd.isna(cell):
-        return []
-    s = str(cell).strip()
-    if s == "":
-        return []
-    parts = [p.strip() for p in s.split(",") if p.strip() != ""]
-    ids = []
-    for p in parts:
-        try:
-            ids.append(int(p))
-        except ValueError:
-            # ignore non-integer parts
-            continue
-    return ids
+from app.core import preflight
+from app.core.engine import SkipRow, concurrency_from, get_modify_put
+from app.core.results import ResultLog
+from app.core.tables import read_table, write_table
 
-def process_chunk(df_chunk, api_url, token, thread_id, log_callback=None, timeout=30):
-    
-    def log(msg):
-        if log_callback:
-            log_callback(msg)
-        else:
-            print(msg)
+RATE_LIMIT = 100  # requests per second
 
-    headers = {"Authorization": f"Bearer {token}"}
-    results = []
 
-    for index, row in df_chunk.iterrows():
-        # log(f"[Thread {thread_id}] Processing row index: {index}") # too verbose for websocket maybe?
-        
-        # User script used iloc positions: 0 -> Farmer ID, 2 -> Tags
+def add_tags(farmer_json, new_ids):
+    """Appends the new tag IDs to the farmer JSON; raises SkipRow when all are already present."""
+    data = farmer_json.get("data", {})
+    existing_tags = data.get("tags", []) or []
+    # normalize existing tags to ints when possible
+    existing_ints = []
+    for t in existing_tags:
         try:
-            farmer_id = row.iloc[0]   # Column A: Farmer ID
-            raw_tags_cell = row.iloc[2]  # Column C : Farmer Tag IDs
-        except IndexError:
-             status = "Skipped: Row missing columns"
-             results.append((index, status, "IndexError"))
-             continue
-
-        status = ""
-        response_str = ""
-
-        if pd.isna(farmer_id):
-            status = "Skipped: Missing Farmer ID"
-            results.append((index, status, response_str))
+            existing_ints.append(int(t))
+        except Exception:
+            # ignore non-integer existing tags
             continue
 
-        new_ids = parse_comma_ids(raw_tags_cell)
-        if not new_ids:
-            status = "Skipped: No tag IDs to add"
-            results.append((index, status, response_str))
-            continue
+    # determine which IDs to actually add (skip those already present)
+    to_add = [i for i in new_ids if i not in existing_ints]
+    if not to_add:
+        raise SkipRow("Skipped: All IDs already present")
 
-        try:
-            # GET existing farmer
-            # Assuming api_url is the base collection URL, e.g. .../farmers
-            get_url = f"{api_url}/{farmer_id}"
-            get_resp = requests.get(get_url, headers=headers, timeout=timeout)
-            get_resp.raise_for_status()
-            farmer_json = get_resp.json()
-
-            data = farmer_json.get("data", {})
-            existing_tags = data.get("tags", []) or []
-            # normalize existing tags to ints when possible
-            existing_ints = []
-            for t in existing_tags:
-                try:
-                    existing_ints.append(int(t))
-                except Exception:
-                    # ignore non-integer existing tags
-                    continue
-
-            # determine which IDs to actually add (skip those already present)
-            to_add = [i for i in new_ids if i not in existing_ints]
-            if not to_add:
-                status = "Skipped: All IDs already present"
-                results.append((index, status, response_str))
-                continue
-
-            # update data["tags"] by appending new ints
-            updated_tags = existing_ints + to_add
-            data["tags"] = updated_tags
-            farmer_json["data"] = data
-
-            # prepare multipart dto and PUT to specific farmer URL
-            # Wait, the user script had: requests.put(f"{api_url}", ...) 
-            # This looks wrong if api_url is ".../farmers". Usually PUT is to ".../farmers/{id}" OR ".../farmers" if it's a bulk update?
-            # User script: requests.put(f"{api_url}", headers=headers, files=multipart, timeout=timeout)
-            # The API usually is PUT /farmers to update ONE farmer if the payload contains the ID, or PUT /farmers/{id}.
-            # Let's look closely at user script.
-            # user script: get_resp = requests.get(f"{api_url}/{farmer_id}", ...)
-            # user script: put_resp = requests.put(f"{api_url}", ...)
-            # If the user says so, I will stick to it. But it might be updating the *collection*? 
-            # Or maybe api_url should include connection? 
-            # In Cropin APIs, usually PUT /farmers accepts a multipart DTO for creation/update.
-            
-            multipart = {"dto": (None, json.dumps(farmer_json), "application/json")}
-            put_resp = requests.put(f"{api_url}", headers=headers, files=multipart, timeout=timeout)
-            
-            if put_resp.status_code in [200, 201, 204]:
-                put_resp_json = put_resp.json() if put_resp.content else {}
-                # Check for business logic errors in 200 OK responses sometimes
-                status = "Success"
-                response_str = str(put_resp_json)[:500]
-                log(f"[Thread {thread_id}] Farmer {farmer_id} updated, added IDs: {to_add}")
-            else:
-                 put_resp.raise_for_status() # Trigger except block
-
-        except requests.exceptions.RequestException as e:
-            status = f"Failed: {str(e)}"
-            if hasattr(e, 'response') and e.response is not None:
-                response_str = f"{e.response.status_code} - {e.response.text}"
-            else:
-                response_str = str(e)
-            log(f"[Thread {thread_id}] Request error for farmer {farmer_id}: {response_str[:100]}")
-
-        time.sleep(0.5)
-        results.append((index, status, response_str))
-
-    return results
+    # update data["tags"] by appending new ints
+    data["tags"] = existing_ints + to_add
+    farmer_json["data"] = data
+    return farmer_json
 
 def run(input_excel_file, output_excel_file, config, log_callback=None):
     
@@ -159,7 +57,7 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
 
     log(f"Reading input file: {input_excel_file}")
     try:
-        df = pd.read_excel(input_excel_file)
+        df = read_table(input_excel_file)
     except Exception as e:
         log(f"Failed to read Excel: {e}")
         return
@@ -171,41 +69,63 @@ def run(input_excel_file, output_excel_file, config, log_callback=None):
 
     n = len(df)
     log(f"Total rows to process: {n}")
-    
-    # Split into maximum 4 chunks
-    max_workers = 4
-    chunk_size = (n + max_workers - 1) // max_workers # ceiling division
-    
-    chunks = []
-    for i in range(0, n, chunk_size):
-        chunks.append(df.iloc[i:i + chunk_size])
-    
-    # Adjust workers if fewer chunks
-    workers = min(len(chunks), max_workers)
-    if workers == 0:
+
+    if n == 0:
         log("No data to process.")
         return
 
-    log(f"Starting execution with {workers} threads...")
-
-    all_results = []
-    with ThreadPoolExecutor(max_workers=workers) as ex:
-        futures = []
-        for i, chunk in enumerate(chunks):
-            futures.append(ex.submit(process_chunk, chunk, api_url, token, i+1, log_callback))
-        
-        for f in futures:
-            try:
-                all_results.extend(f.result())
-            except Exception as e:
-                log(f"Thread failed: {e}")
+    # Each row's result is appended as it finishes; the output file is written once at the end
+    results = ResultLog(output_excel_file, input_excel_file, resume=config.get("resume"),
+                        job=config.get("client_id"))
+    done = results.restore(df)
+    if done:
+        log(f"⏭️ Resuming: {len(done)} rows already succeeded and are skipped")
+
+    # User script used iloc positions: 0 -> Farmer ID, 2 -> Tags (comma-separated IDs)
+    check = preflight.Preflight(df)
+    if len(df.columns) < 3:
+        check.reject(True, "Skipped: Row missing columns")
+        farmer_ids = tag_ids = None
+    else:
+        farmer_ids = preflight.ids(df.iloc[:, 0])  # Column A: Farmer ID
+        tag_ids = preflight.id_lists(df.iloc[:, 2])  # Column C : Farmer Tag IDs
+        check.reject(farmer_ids == "", "Skipped: Missing Farmer ID")
+        check.reject(tag_ids.str.len() == 0, "Skipped: No tag IDs to add")
+
+    rejected = check.rejected.drop(list(done), errors="ignore")
+    df.loc[rejected.index, "Status"] = rejected
+    df.loc[rejected.index, "Retries"] = 0
+    if not rejected.empty:
+        log(check.summary())
+        results.record_frame(df.loc[rejected.index], ["Status", "Retries"])
+
+    items = [(index, farmer_ids[index], tag_ids[index]) for index in check.clean if index not in done]
+
+    concurrency = concurrency_from(config)
+    log(f"Starting execution with up to {concurrency} requests in flight...")
+
+    # GET /farmers/{id}, PUT the multipart dto to /farmers (the payload carries the ID),
+    # exactly as the original user script did
+    outcomes = get_modify_put(
+        items,
+        get_url=lambda farmer_id: f"{api_url}/{farmer_id}",
+        put_url=api_url,
+        modify=add_tags,
+        config=config,
+        concurrency=concurrency,
+        rate_limit=RATE_LIMIT,
+        log=log,
+        on_result=lambda idx, status, resp, retries: results.record(idx, Status=status, Response=resp, Retries=retries),
+    )
 
     # Apply results back to DF
-    # Results are (index, status, resp)
-    for idx, status, resp in all_results:
+    # Results are (index, status, resp, retries)
+    for idx, status, resp, retries in outcomes:
         df.at[idx, "Status"] = status
         df.at[idx, "Response"] = resp
+        df.at[idx, "Retries"] = retries
 
     log(f"Saving output to {output_excel_file}")
-    df.to_excel(output_excel_file, index=False)
+    write_table(df, output_excel_file)
+    results.close()
     log("Task Completed.")
@@ -108,7 +108,7 @@ document.addEventListener('DOMContentLoaded', () => {
         // Reset Drop Zone text
         const dropText = dropZone.querySelector('.drop-text');
         if (dropText) {
-            dropText.innerHTML = `<strong>Drag and drop file here</strong><p>Limit 200MB per file • XLSX</p>`;
+            dropText.innerHTML = `<strong>Drag and drop file here</strong><p>Limit 200MB per file • XLSX, CSV, Parquet</p>`;
         }
         // Clear file input so 'change' event fires even if same file selected again
         fileInput.value = '';
@@ -211,6 +211,36 @@ document.addEventListener('DOMContentLoaded', () => {
                 }
             }
 
+            // Toggle Batch Size Config (scripts sending IDs to batch endpoints)
+            const batchConfig = document.getElementById('batch-config');
+            if (batchConfig) {
+                const batchScripts = ['PR_Enablement.py', 'PR_and_Weather_Enablement.py', 'PR_Enablement_Bulk.py'];
+                // Scripts that send several batches at once
+                const parallelBatchScripts = ['PR_Enablement_Bulk.py', 'Bulk_Delete_Farmers.py', 'Bulk_Delete_Assets.py', 'Delete_Users.py', 'Enable_Cropin_Connect.py'];
+                const sizesBatches = batchScripts.includes(selectedScript.name);
+                const sendsInParallel = parallelBatchScripts.includes(selectedScript.name);
+                batchConfig.style.display = (sizesBatches || sendsInParallel) ? 'block' : 'none';
+                const sizeGroup = document.getElementById('batch-size-group');
+                if (sizeGroup) {
+                    sizeGroup.style.display = sizesBatches ? 'block' : 'none';
+                }
+                const inFlightGroup = document.getElementById('batches-in-flight-group');
+                if (inFlightGroup) {
+                    inFlightGroup.style.display = sendsInParallel ? 'block' : 'none';
+                }
+            }
+
+            // Toggle Concurrency Config (scripts running on the asyncio engine)
+            const engineConfig = document.getElementById('engine-config');
+            if (engineConfig) {
+                const engineScripts = ['Update_Farmer_Details.py', 'Update_Asset_Details.py', 'Update_Farmer_Address.py', 'Update_Asset_Address.py', 'Update_Farmer_Tags.py', 'Update_Asset_Tags.py', 'Update_Farmer_Additional_Attribute.py', 'Update_Asset_Additional_Attribute.py', 'Add_Cropstages_to_Variety.py', 'Add_Seed_Grades_to_Variety.py', 'Edit_Plans_in_Variety_with_or_without_recurring.py'];
+                if (engineScripts.includes(selectedScript.name)) {
+                    engineConfig.style.display = 'block';
+                } else {
+                    engineConfig.style.display = 'none';
+                }
+            }
+
             // Logic for Attribute Count Dropdown
             const attrCountSelect = document.getElementById('attr-count-select');
             if (attrCountSelect) {
@@ -479,9 +509,16 @@ document.addEventListener('DOMContentLoaded', () => {
         };
 
         evtSource.onmessage = (event) => {
+            // One event carries a batch of log lines
+            for (const line of event.data.split('\n')) {
+                if (handleLogLine(line) === false) break;
+            }
+        };
+
+        function handleLogLine(data) {
             // Check for Special Events
-            if (event.data.startsWith('JOB_COMPLETED::')) {
-                const filename = event.data.split('::')[1];
+            if (data.startsWith('JOB_COMPLETED::')) {
+                const filename = data.split('::')[1];
 
                 const finishLine = document.createElement('div');
                 finishLine.className = 'console-line';
@@ -493,7 +530,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 localStorage.setItem('is_script_running', 'false');
 
                 // Trigger Download
-                window.location.href = '/api/download/' + filename;
+                window.location.href = '/api/download/' + filename + '?client_id=' + encodeURIComponent(clientId);
 
                 statusArea.innerHTML = '<div style="color: green;">Success! Check downloads.</div>';
                 runBtn.disabled = false;
@@ -510,11 +547,11 @@ document.addEventListener('DOMContentLoaded', () => {
                 closeLine.style.color = 'green';
                 closeLine.textContent = '> Connection closed. Job Done.';
                 consoleContent.appendChild(closeLine);
-                return;
+                return false;
             }
 
-            if (event.data.startsWith('JOB_FAILED::')) {
-                const errorMsg = event.data.split('::')[1];
+            if (data.startsWith('JOB_FAILED::')) {
+                const errorMsg = data.split('::')[1];
                 const errLine = document.createElement('div');
                 errLine.className = 'console-line';
                 errLine.style.color = '#ff4444';
@@ -533,10 +570,10 @@ document.addEventListener('DOMContentLoaded', () => {
             // Normal Log
             const logLine = document.createElement('div');
             logLine.className = 'console-line';
-            logLine.textContent = '> ' + event.data;
+            logLine.textContent = '> ' + data;
             consoleContent.appendChild(logLine);
             consoleContent.scrollTop = consoleContent.scrollHeight; // Auto-scroll
-        };
+        }
 
         evtSource.onerror = (err) => {
             console.error("SSE Error:", err);
@@ -826,7 +863,11 @@ document.addEventListener('DOMContentLoaded', () => {
                 use_farmer_id: useFarmerId,
                 attr_keys: attrKeys,
                 unit: areaUnit,
-                force_crop_audited: forceCropAuditedVal
+                force_crop_audited: forceCropAuditedVal,
+                concurrency: document.getElementById('concurrency') ? parseInt(document.getElementById('concurrency').value) || null : null,
+                batch_size: document.getElementById('batch-size') ? parseInt(document.getElementById('batch-size').value) || null : null,
+                batches_in_flight: document.getElementById('batches-in-flight') ? parseInt(document.getElementById('batches-in-flight').value) || null : null,
+                output_format: document.getElementById('output-format') ? document.getElementById('output-format').value || null : null
             };
 
             const formData = new FormData();
@@ -836,6 +877,8 @@ document.addEventListener('DOMContentLoaded', () => {
             }
             formData.append('config', JSON.stringify(config));
             formData.append('client_id', clientId);
+            const resumeRun = document.getElementById('resume-run');
+            formData.append('resume', resumeRun && resumeRun.checked ? 'true' : 'false');
 
             // Execute (Background Task)
             fetch('/api/execute', {